@@ -0,0 +1,23 @@
+"""Загрузка модуля бота для бенчмарков (имя файла бота не является именем модуля)"""
+import importlib
+import os
+import sys
+
+APP_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BOT_PATH = os.path.join(APP_DIR, 'model2 — копия.py')
+CORPUS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'corpus')
+
+if APP_DIR not in sys.path:
+    sys.path.insert(0, APP_DIR)
+
+def load_bot_module(name='pushkin_bot'):
+    """
+    Импортирует ядро бота (pushkin_bot) или модуль режима работы (bot_async, bot_webhook, ...)
+    без запуска polling; журнал и кэш анализов включает bot_module.init_bot()
+    """
+    return importlib.import_module(name)
+
+def load_answers():
+    """Читает корпус ответов модели (ответы разделены строкой '=====')"""
+    with open(os.path.join(CORPUS_DIR, 'answers.txt'), encoding='utf-8') as corpus:
+        return [answer.strip('\n') for answer in corpus.read().split('\n=====\n') if answer.strip()]
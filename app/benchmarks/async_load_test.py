@@ -0,0 +1,99 @@
+"""
+Нагрузочный тест асинхронного режима (AsyncTeleBot + AsyncOpenAI)
+на локальных фейковых серверах Telegram и модели.
+
+Каждый пользователь отправляет один запрос на анализ; тест измеряет время
+от появления обновления до завершения обработчика и общую пропускную способность.
+
+Пул соединений с моделью (LLM_POOL_SIZE, по умолчанию здесь 500) ограничивает
+число одновременных генераций: при задержке модели L пропускная способность
+не превысит LLM_POOL_SIZE / L запросов в секунду.
+
+Запуск: python benchmarks/async_load_test.py --users 50 100 200 --latency 2.0
+"""
+import argparse
+import asyncio
+import os
+import statistics
+import tempfile
+import threading
+import time
+
+from fake_llm import start_in_process
+from fake_telegram import FakeTelegramServer
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+async def run_round(bot_async, telegram, users, first_chat_id):
+    """Отправляет запросы от users пользователей и ждет завершения всех обработчиков"""
+    started = {}
+    finished = {}
+    all_done = asyncio.Event()
+    original_handler = bot_async.async_text_handler
+    
+    async def timed_handler(message):
+        await original_handler(message)
+        finished[message.chat.id] = time.time()
+        if len(finished) == users:
+            all_done.set()
+    
+    # Обработчики регистрируются заново, чтобы подставить измеряющую обертку
+    bot_async.async_text_handler = timed_handler
+    bot_async.create_async_bot()
+    bot_async.async_text_handler = original_handler
+    
+    polling = asyncio.create_task(bot_async.async_bot.polling(non_stop=True, interval=0, timeout=1))
+    round_started = time.time()
+    for chat_id in range(first_chat_id, first_chat_id + users):
+        started[chat_id] = time.time()
+        telegram.push_message(chat_id, f"Произведение номер {chat_id}, Автор {chat_id}")
+    
+    await asyncio.wait_for(all_done.wait(), timeout=600)
+    elapsed = time.time() - round_started
+    
+    polling.cancel()
+    try:
+        await polling
+    except asyncio.CancelledError:
+        pass
+    await bot_async.async_bot.close_session()
+    await bot_async.async_llm_gateway.http_client.aclose()
+    
+    latencies = [finished[chat_id] - started[chat_id] for chat_id in started]
+    return elapsed, latencies
+
+def main():
+    parser = argparse.ArgumentParser(description='Нагрузочный тест асинхронного режима')
+    parser.add_argument('--users', type=int, nargs='+', default=[10, 50, 200], help='число одновременных пользователей')
+    parser.add_argument('--latency', type=float, default=2.0, help='задержка модели до первого токена, с')
+    parser.add_argument('--token-delay', type=float, default=0.002, help='задержка между токенами, с')
+    args = parser.parse_args()
+    
+    llm_process, llm_base_url = start_in_process(latency=args.latency, token_delay=args.token_delay)
+    telegram = FakeTelegramServer().start()
+    os.environ.update(LLM_BASE_URL=llm_base_url, ANALYSIS_CACHE_PATH=':memory:', LLM_POOL_SIZE=os.getenv('LLM_POOL_SIZE', '500'),
+                      LOG_PATH=os.path.join(tempfile.mkdtemp(prefix='bench-'), 'bot.log.jsonl'))
+    # Измеряется пропускная способность самого бота, а не лимиты Telegram
+    os.environ.setdefault('TELEGRAM_RATE_LIMIT', '0')
+    
+    from _bot import load_bot_module
+    load_bot_module().init_bot()
+    bot_async = load_bot_module('bot_async')
+    import telebot.asyncio_helper
+    telebot.asyncio_helper.API_URL = telegram.api_url
+    
+    print(f"Модель: задержка {args.latency} с, {args.token_delay * 1000:.0f} мс на токен")
+    print(f"{'польз.':>7} {'время, с':>9} {'сообщ/с':>8} {'p50, с':>7} {'p95, с':>7} {'p99, с':>7} {'потоков':>8}")
+    first_chat_id = 1
+    for users in args.users:
+        elapsed, latencies = asyncio.run(run_round(bot_async, telegram, users, first_chat_id))
+        first_chat_id += users
+        print(f"{users:>7} {elapsed:>9.2f} {users / elapsed:>8.1f} {statistics.median(latencies):>7.2f} "
+              f"{percentile(latencies, 0.95):>7.2f} {percentile(latencies, 0.99):>7.2f} {threading.active_count():>8}")
+    
+    llm_process.terminate()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,91 @@
+"""
+Проверка предварительного фильтра запросов (LiteratureClassifier): точность
+и полнота на размеченной выборке corpus/prompts_labeled.tsv и стоимость
+одного вызова в микросекундах.
+
+Положительный класс - литературный запрос. Полнота важнее точности: пропущенный
+литературный запрос получает ложный отказ, а лишний посторонний стоит лишь
+одного обращения к модели, которое было и без фильтра.
+
+Запуск: python benchmarks/classifier_benchmark.py [--repeat N] [--min-recall 0.97] [--verbose]
+"""
+import argparse
+import os
+import sys
+import time
+
+from _bot import CORPUS_DIR, load_bot_module
+
+def load_sample(path):
+    """Читает строки "метка<TAB>текст", пропуская комментарии"""
+    sample = []
+    with open(path, encoding='utf-8') as labeled:
+        for line in labeled:
+            if not line.strip() or line.startswith('#'):
+                continue
+            label, text = line.rstrip('\n').split('\t', 1)
+            sample.append((label == 'lit', text))
+    return sample
+
+def measure(classifier, texts, repeat, cold):
+    """Возвращает лучшее среднее время одного вызова, мкс (cold - без кэша слов)"""
+    best = float('inf')
+    for _ in range(repeat):
+        if cold:
+            classifier._match_cache.clear()
+        started = time.perf_counter()
+        for text in texts:
+            classifier.classify(text)
+        best = min(best, (time.perf_counter() - started) / len(texts))
+    return best * 1e6
+
+def main():
+    parser = argparse.ArgumentParser(description='Точность, полнота и стоимость фильтра запросов')
+    parser.add_argument('--file', default=os.path.join(CORPUS_DIR, 'prompts_labeled.tsv'), help='размеченная выборка')
+    parser.add_argument('--repeat', type=int, default=50, help='число повторов замера')
+    parser.add_argument('--min-precision', type=float, default=0.0, help='минимальная точность (иначе код 1)')
+    parser.add_argument('--min-recall', type=float, default=0.0, help='минимальная полнота (иначе код 1)')
+    parser.add_argument('--verbose', action='store_true', help='показать ошибки классификации')
+    args = parser.parse_args()
+
+    bot_module = load_bot_module()
+    classifier = bot_module.LiteratureClassifier()
+    sample = load_sample(args.file)
+
+    true_positive = false_positive = false_negative = true_negative = 0
+    errors = []
+    for expected, text in sample:
+        predicted, reason = classifier.classify(text)
+        if predicted and expected:
+            true_positive += 1
+        elif predicted:
+            false_positive += 1
+            errors.append(('лишний вызов модели', reason, text))
+        elif expected:
+            false_negative += 1
+            errors.append(('ложный отказ', reason, text))
+        else:
+            true_negative += 1
+
+    precision = true_positive / (true_positive + false_positive) if true_positive + false_positive else 0.0
+    recall = true_positive / (true_positive + false_negative) if true_positive + false_negative else 0.0
+    off_topic = false_positive + true_negative
+
+    texts = [text for _, text in sample]
+    cold = measure(classifier, texts, args.repeat, cold=True)
+    warm = measure(classifier, texts, args.repeat, cold=False)
+
+    print(f"Выборка: {len(sample)} запросов (литературных {true_positive + false_negative}, посторонних {off_topic})")
+    print(f"Каталог: {classifier.get_stats()['catalog_words']} слов, {classifier.get_stats()['catalog_titles']} названий")
+    print(f"Точность: {precision:.3f}, полнота: {recall:.3f}")
+    print(f"Отсечено посторонних без модели: {true_negative} из {off_topic}, ложных отказов: {false_negative}")
+    print(f"Стоимость вызова: {cold:.1f} мкс без кэша слов, {warm:.1f} мкс с кэшем")
+    if args.verbose:
+        for kind, reason, text in errors:
+            print(f"  {kind} ({reason}): {text}")
+
+    if precision < args.min_precision or recall < args.min_recall:
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,191 @@
+"""
+Локальный OpenAI-совместимый сервер для бенчмарков и ручной проверки.
+
+Отдает /v1/chat/completions (обычный и потоковый режим) и /v1/models с настраиваемой
+задержкой, долей медленных ответов, скоростью выдачи токенов, долей ошибок 429/503
+и долей отказов "занимаюсь только разбором литературных произведений" (по умолчанию нет).
+
+Запуск: python benchmarks/fake_llm.py --port 8081 --latency 2.0
+"""
+import argparse
+import json
+import multiprocessing
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from _bot import load_answers
+
+class FakeLLMServer(ThreadingHTTPServer):
+    """HTTP-сервер, имитирующий OpenAI-совместимый API модели"""
+    
+    daemon_threads = True
+    request_queue_size = 1024
+    
+    def handle_error(self, request, client_address):
+        # Обрывы соединений клиентом при завершении теста не важны
+        pass
+    
+    def __init__(self, port=0, latency=0.5, token_delay=0.0, error_rate=0.0, answers=None,
+                 slow_rate=0.0, slow_latency=0.0, refusal_rate=0.0):
+        super().__init__(('127.0.0.1', port), FakeLLMHandler)
+        self.latency = latency
+        # Доля "хвостовых" запросов, которые ждут slow_latency вместо latency
+        self.slow_rate = slow_rate
+        self.slow_latency = slow_latency
+        self.token_delay = token_delay
+        self.error_rate = error_rate
+        # Отказы из корпуса отдаются только с долей refusal_rate: на запросы о произведениях модель отвечает анализом
+        answers = answers or load_answers()
+        self.refusals = [answer for answer in answers if 'разбором литературных' in answer]
+        self.answers = [answer for answer in answers if answer not in self.refusals] or answers
+        self.refusal_rate = refusal_rate
+        self.requests = 0
+        self.connections = 0
+        self._lock = threading.Lock()
+    
+    @property
+    def base_url(self):
+        return f"http://127.0.0.1:{self.server_address[1]}/v1"
+    
+    def start(self):
+        """Запускает сервер в фоновом потоке"""
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+    
+    def get_request(self):
+        connection = super().get_request()
+        with self._lock:
+            self.connections += 1
+        return connection
+
+class FakeLLMHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    
+    def log_message(self, format, *args):
+        pass
+    
+    def _send_json(self, status, payload, headers=None):
+        body = json.dumps(payload, ensure_ascii=False).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+    
+    def do_GET(self):
+        # Список моделей - на него отвечает проверка доступности API в боте
+        if self.path.endswith('/models'):
+            self._send_json(200, {'object': 'list', 'data': [{'id': 'fake', 'object': 'model', 'owned_by': 'fake'}]})
+        else:
+            self._send_json(404, {'error': {'message': 'not found'}})
+    
+    def do_POST(self):
+        server = self.server
+        length = int(self.headers.get('Content-Length', 0))
+        request = json.loads(self.rfile.read(length) or b'{}')
+        with server._lock:
+            server.requests += 1
+        
+        if not self.path.endswith('/chat/completions'):
+            self._send_json(404, {'error': {'message': 'not found'}})
+            return
+        
+        if server.error_rate and random.random() < server.error_rate:
+            status = random.choice((429, 503))
+            self._send_json(status, {'error': {'message': 'fake overload'}}, {'Retry-After': '0'})
+            return
+        
+        prompt = request['messages'][-1]['content']
+        if server.refusals and server.refusal_rate and random.random() < server.refusal_rate:
+            answer = random.choice(server.refusals)
+        else:
+            answer = server.answers[sum(map(ord, prompt)) % len(server.answers)]
+        completion_tokens = len(answer.split())
+        time.sleep(server.slow_latency if server.slow_rate and random.random() < server.slow_rate else server.latency)
+        
+        if request.get('stream'):
+            self._stream(request, answer)
+            return
+        
+        self._send_json(200, {
+            'id': 'chatcmpl-fake',
+            'object': 'chat.completion',
+            'created': int(time.time()),
+            'model': request.get('model', 'fake'),
+            'choices': [{'index': 0, 'finish_reason': 'stop',
+                         'message': {'role': 'assistant', 'content': answer}}],
+            'usage': {'prompt_tokens': len(prompt.split()), 'completion_tokens': completion_tokens,
+                      'total_tokens': len(prompt.split()) + completion_tokens},
+        })
+    
+    def _stream(self, request, answer):
+        """Отдает ответ в формате server-sent events, по слову на чанк"""
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+        
+        def write_event(payload):
+            data = f"data: {payload}\n\n".encode('utf-8')
+            self.wfile.write(f"{len(data):x}\r\n".encode() + data + b"\r\n")
+            self.wfile.flush()
+        
+        for token in answer.split(' '):
+            chunk = {'id': 'chatcmpl-fake', 'object': 'chat.completion.chunk', 'created': int(time.time()),
+                     'model': request.get('model', 'fake'),
+                     'choices': [{'index': 0, 'delta': {'content': token + ' '}, 'finish_reason': None}]}
+            write_event(json.dumps(chunk, ensure_ascii=False))
+            if self.server.token_delay:
+                time.sleep(self.server.token_delay)
+        
+        write_event(json.dumps({'id': 'chatcmpl-fake', 'object': 'chat.completion.chunk', 'created': int(time.time()),
+                                'model': request.get('model', 'fake'),
+                                'choices': [{'index': 0, 'delta': {}, 'finish_reason': 'stop'}]}))
+        if (request.get('stream_options') or {}).get('include_usage'):
+            prompt_tokens = len(request['messages'][-1]['content'].split())
+            completion_tokens = len(answer.split())
+            write_event(json.dumps({'id': 'chatcmpl-fake', 'object': 'chat.completion.chunk', 'created': int(time.time()),
+                                    'model': request.get('model', 'fake'), 'choices': [],
+                                    'usage': {'prompt_tokens': prompt_tokens, 'completion_tokens': completion_tokens,
+                                              'total_tokens': prompt_tokens + completion_tokens}}))
+        write_event('[DONE]')
+        self.wfile.write(b"0\r\n\r\n")
+        self.wfile.flush()
+
+def _serve(port_queue, kwargs):
+    server = FakeLLMServer(**kwargs)
+    port_queue.put(server.server_address[1])
+    server.serve_forever()
+
+def start_in_process(**kwargs):
+    """
+    Запускает сервер в отдельном процессе, чтобы генерация токенов
+    не конкурировала за GIL с измеряемым ботом. Возвращает (процесс, base_url).
+    """
+    port_queue = multiprocessing.Queue()
+    process = multiprocessing.Process(target=_serve, args=(port_queue, kwargs), daemon=True)
+    process.start()
+    return process, f"http://127.0.0.1:{port_queue.get(timeout=30)}/v1"
+
+def main():
+    parser = argparse.ArgumentParser(description='Фейковый OpenAI-совместимый сервер')
+    parser.add_argument('--port', type=int, default=8081)
+    parser.add_argument('--latency', type=float, default=0.5, help='задержка до первого токена, с')
+    parser.add_argument('--token-delay', type=float, default=0.0, help='задержка между токенами, с')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='доля ответов 429/503')
+    parser.add_argument('--slow-rate', type=float, default=0.0, help='доля медленных ответов')
+    parser.add_argument('--slow-latency', type=float, default=0.0, help='задержка медленного ответа, с')
+    parser.add_argument('--refusal-rate', type=float, default=0.0, help='доля отказов "не о литературе"')
+    args = parser.parse_args()
+    
+    server = FakeLLMServer(args.port, args.latency, args.token_delay, args.error_rate,
+                           slow_rate=args.slow_rate, slow_latency=args.slow_latency, refusal_rate=args.refusal_rate)
+    print(f"Фейковая модель слушает {server.base_url}")
+    server.serve_forever()
+
+if __name__ == '__main__':
+    main()
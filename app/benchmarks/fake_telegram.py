@@ -0,0 +1,149 @@
+"""
+Локальная имитация Telegram Bot API для бенчмарков.
+
+Поддерживает getUpdates (long polling), sendMessage, editMessageText,
+deleteMessage, sendChatAction, sendPhoto и getMe. Все исходящие вызовы бота
+записываются с отметкой времени, чтобы считать задержки по чатам.
+"""
+import email.parser
+import json
+import threading
+import time
+from collections import defaultdict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qsl, urlsplit
+
+class FakeTelegramServer(ThreadingHTTPServer):
+    """HTTP-сервер с минимальной реализацией Bot API"""
+    
+    daemon_threads = True
+    request_queue_size = 1024
+    
+    def handle_error(self, request, client_address):
+        # Обрывы соединений клиентом при завершении теста не важны
+        pass
+    
+    def __init__(self, port=0, latency=0.0):
+        super().__init__(('127.0.0.1', port), FakeTelegramHandler)
+        self.latency = latency
+        self.calls = []
+        self.calls_by_chat = defaultdict(list)
+        self._updates = []
+        self._next_update_id = 1
+        self._next_message_id = 1
+        self._next_file_id = 1
+        self._condition = threading.Condition()
+    
+    @property
+    def api_url(self):
+        """Шаблон адреса для telebot.apihelper.API_URL / asyncio_helper.API_URL"""
+        return f"http://127.0.0.1:{self.server_address[1]}/bot{{0}}/{{1}}"
+    
+    def start(self):
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+    
+    def push_message(self, chat_id, text, user_id=None):
+        """Добавляет входящее сообщение пользователя, возвращает update_id"""
+        with self._condition:
+            update_id = self._next_update_id
+            self._next_update_id += 1
+            message = {
+                'message_id': self._new_message_id(),
+                'date': int(time.time()),
+                'chat': {'id': chat_id, 'type': 'private'},
+                'from': {'id': user_id or chat_id, 'is_bot': False, 'first_name': f'user{chat_id}', 'username': f'user{chat_id}'},
+                'text': text,
+            }
+            if text.startswith('/'):
+                message['entities'] = [{'type': 'bot_command', 'offset': 0, 'length': len(text.split()[0])}]
+            self._updates.append({'update_id': update_id, 'message': message})
+            self._condition.notify_all()
+        return update_id
+    
+    def _new_message_id(self):
+        message_id = self._next_message_id
+        self._next_message_id += 1
+        return message_id
+    
+    def get_updates(self, offset, timeout):
+        """Отдает обновления начиная с offset, ожидая до timeout секунд"""
+        deadline = time.time() + timeout
+        with self._condition:
+            self._updates = [update for update in self._updates if update['update_id'] >= offset]
+            while not self._updates and time.time() < deadline:
+                self._condition.wait(max(0.0, deadline - time.time()))
+            return list(self._updates[:100])
+    
+    def record(self, method, params):
+        """Запоминает исходящий вызов бота и формирует ответ API"""
+        chat_id = params.get('chat_id')
+        chat_id = int(chat_id) if chat_id not in (None, '') else None
+        with self._condition:
+            if method in ('sendMessage', 'sendPhoto'):
+                message_id = self._new_message_id()
+            else:
+                message_id = int(params.get('message_id') or 0)
+            call = {'time': time.time(), 'method': method, 'chat_id': chat_id,
+                    'message_id': message_id, 'text': params.get('text', '')}
+            self.calls.append(call)
+            if chat_id is not None:
+                self.calls_by_chat[chat_id].append(call)
+        
+        if method in ('sendMessage', 'editMessageText', 'sendPhoto'):
+            result = {'message_id': message_id, 'date': int(time.time()),
+                      'chat': {'id': chat_id, 'type': 'private'}, 'text': params.get('text', '')}
+            if method == 'sendPhoto':
+                with self._condition:
+                    file_id = f'fake-photo-{self._next_file_id}'
+                    self._next_file_id += 1
+                result['photo'] = [{'file_id': file_id, 'file_unique_id': file_id, 'width': 512, 'height': 512}]
+            return result
+        if method == 'getMe':
+            return {'id': 1, 'is_bot': True, 'first_name': 'Pushkin AI', 'username': 'pushkin_ai_bot'}
+        return True
+
+class FakeTelegramHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    
+    def log_message(self, format, *args):
+        pass
+    
+    def _params(self):
+        url = urlsplit(self.path)
+        params = dict(parse_qsl(url.query))
+        length = int(self.headers.get('Content-Length', 0))
+        body = self.rfile.read(length) if length else b''
+        content_type = self.headers.get('Content-Type', '')
+        if content_type.startswith('application/x-www-form-urlencoded'):
+            params.update(parse_qsl(body.decode('utf-8')))
+        elif content_type.startswith('application/json'):
+            params.update(json.loads(body or b'{}'))
+        elif content_type.startswith('multipart/form-data'):
+            message = email.parser.BytesParser().parsebytes(
+                f'Content-Type: {content_type}\r\n\r\n'.encode() + body)
+            for part in message.get_payload():
+                name = part.get_param('name', header='content-disposition')
+                if part.get_filename() is None:
+                    params[name] = part.get_payload(decode=True).decode('utf-8')
+        return url.path.rsplit('/', 1)[-1], params
+    
+    def _handle(self):
+        method, params = self._params()
+        server = self.server
+        if method == 'getUpdates':
+            result = server.get_updates(int(params.get('offset') or 0), float(params.get('timeout') or 0))
+        else:
+            if server.latency:
+                time.sleep(server.latency)
+            result = server.record(method, params)
+        
+        body = json.dumps({'ok': True, 'result': result}, ensure_ascii=False).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+    
+    do_GET = _handle
+    do_POST = _handle
@@ -0,0 +1,124 @@
+"""
+Микро-бенчмарк format_ai_response: сравнивает однопроходный форматтер
+с прежней многопроходной реализацией на корпусе ответов модели.
+
+Запуск: python benchmarks/format_benchmark.py [--repeat N] [--scale K]
+"""
+import argparse
+import re
+import time
+
+from _bot import load_answers, load_bot_module
+
+def legacy_format_ai_response(text):
+    """Прежняя реализация format_ai_response (эталон для сравнения)"""
+    try:
+        text = re.sub(r'\n\s*\n\s*\n', '\n\n', text)
+        text = re.sub(r'^(#+)\s*(.+)$', lambda m: f"<b>{m.group(2)}</b>\n", text, flags=re.MULTILINE)
+        text = re.sub(r'^(\d+\.\s+[^:\n]+:|[А-Я][^:\n]+:)\s*$', lambda m: f"<b>{m.group(1)}</b>", text, flags=re.MULTILINE)
+        
+        lines = text.split('\n')
+        formatted_lines = []
+        
+        for i, line in enumerate(lines):
+            if not line.strip():
+                formatted_lines.append('')
+                continue
+            
+            list_match = re.match(r'^(\s*[-•*]\s+)(.+)', line)
+            if list_match:
+                prefix, content = list_match.groups()
+                formatted_lines.append(f"• {content}")
+                continue
+            
+            num_match = re.match(r'^(\s*\d+\.\s+)(.+)', line)
+            if num_match:
+                prefix, content = num_match.groups()
+                formatted_lines.append(f"{content}")
+                continue
+            
+            term_match = re.match(r'^([^-\n]+)\s+-\s+(.+)$', line)
+            if term_match:
+                term, definition = term_match.groups()
+                formatted_lines.append(f"<b>{term.strip()}</b> - {definition}")
+                continue
+            
+            if '«' in line or '"' in line or "'" in line:
+                def format_quote(match):
+                    return f"<i>{match.group(0)}</i>"
+                
+                line = re.sub(r'«[^»]+»', format_quote, line)
+                line = re.sub(r'"[^"]+"', format_quote, line)
+                line = re.sub(r"'[^']+'", format_quote, line)
+                formatted_lines.append(line)
+                continue
+            
+            formatted_lines.append(line)
+        
+        text = '\n'.join(formatted_lines)
+        
+        key_terms = re.findall(r'\b([А-ЯЁA-Z][а-яёa-z]+(?:\s+[А-ЯЁA-Z][а-яёa-z]+)*)\b', text)
+        for term in set(key_terms):
+            if len(term.split()) <= 3:
+                text = re.sub(rf'\b{re.escape(term)}\b', f"<b>{term}</b>", text)
+        
+        text = re.sub(r'\b(Онегин|Татьяна|Раскольников|Соня|Мастер|Маргарита|Пьер|Наташа|Андрей)\b', 
+                     lambda m: f"<i>{m.group(1)}</i>", text, flags=re.IGNORECASE)
+        
+        literary_terms = ['композиция', 'сюжет', 'фабула', 'конфликт', 'образ', 'персонаж', 
+                         'характер', 'пейзаж', 'интерьер', 'диалог', 'монолог', 'символ', 
+                         'метафора', 'эпитет', 'гипербола', 'аллегория', 'антитеза', 
+                         'гротеск', 'ирония', 'сатира', 'лирика', 'эпос', 'драма']
+        
+        for term in literary_terms:
+            text = re.sub(rf'\b({term})\b', r"<b>\1</b>", text, flags=re.IGNORECASE)
+        
+        text = re.sub(r'\b(\d{4})(?:\s*года?)?\b', r'<code>\1</code>', text)
+        text = re.sub(r'«([^»]+)»', r'<i>«\1»</i>', text)
+        text = re.sub(r'"([^"]+)"', r'<i>"\1"</i>', text)
+        
+        return text
+        
+    except Exception as e:
+        print(f"[ERROR] Ошибка при форматировании текста: {e}")
+        return text
+
+def measure(function, answers, repeat):
+    """Возвращает лучшее время (в секундах) обработки всего корпуса"""
+    best = float('inf')
+    for _ in range(repeat):
+        started = time.perf_counter()
+        for answer in answers:
+            function(answer)
+        best = min(best, time.perf_counter() - started)
+    return best
+
+def main():
+    parser = argparse.ArgumentParser(description='Бенчмарк format_ai_response')
+    parser.add_argument('--repeat', type=int, default=20, help='число повторов замера')
+    parser.add_argument('--scale', type=int, default=1, help='во сколько раз удлинить каждый ответ')
+    args = parser.parse_args()
+    
+    bot_module = load_bot_module()
+    answers = ['\n\n'.join([answer] * args.scale) for answer in load_answers()]
+    
+    # Совпадение вывода. Прежняя версия перебирает ключевые термины в порядке set(),
+    # поэтому для вложенных терминов ("Александр Пушкин" и "Пушкин") её вывод
+    # зависит от PYTHONHASHSEED; новая версия всегда выделяет сначала длинный термин.
+    mismatches = sum(
+        1 for answer in answers
+        if bot_module.format_ai_response(answer) != legacy_format_ai_response(answer)
+    )
+    
+    total_chars = sum(len(answer) for answer in answers)
+    legacy_time = measure(legacy_format_ai_response, answers, args.repeat)
+    new_time = measure(bot_module.format_ai_response, answers, args.repeat)
+    
+    print(f"Ответов: {len(answers)}, символов: {total_chars}")
+    print(f"Совпадение вывода: {len(answers) - mismatches} из {len(answers)}")
+    print(f"Прежняя версия: {legacy_time * 1000:.2f} мс ({legacy_time / len(answers) * 1000:.3f} мс/ответ)")
+    print(f"Новая версия:   {new_time * 1000:.2f} мс ({new_time / len(answers) * 1000:.3f} мс/ответ)")
+    print(f"Ускорение: x{legacy_time / new_time:.1f}")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,103 @@
+"""
+Проверка пула моделей (LLMBackendPool): хвост задержки первого токена с одной
+моделью и с двумя моделями и дублированием медленных запросов, доля
+продублированных запросов и отказоустойчивость, когда одна из моделей недоступна
+(отключенная после ошибок модель не должна получать дублей).
+
+У каждой фейковой модели небольшая доля "хвостовых" ответов (--slow-rate), которые
+ждут --slow-latency секунд вместо --latency.
+
+Запуск: python benchmarks/hedge_benchmark.py [--requests 400] [--slow-rate 0.02] [--slow-latency 3]
+"""
+import argparse
+import os
+import statistics
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from fake_llm import FakeLLMServer
+
+PARAMS = {'messages': [{'role': 'user', 'content': 'Евгений Онегин, Пушкин'}], 'max_tokens': 100}
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+def run_load(pool, requests, concurrency):
+    """Потоковые запросы через пул; возвращает (задержки первого токена, ошибки)"""
+    def one(_):
+        started = time.perf_counter()
+        first = []
+        pool.run(dict(PARAMS), on_delta=lambda fragment: first or first.append(time.perf_counter() - started))
+        return first[0]
+
+    latencies = []
+    errors = 0
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        for future in [executor.submit(one, number) for number in range(requests)]:
+            try:
+                latencies.append(future.result())
+            except Exception:
+                errors += 1
+    return latencies, errors
+
+def describe(name, latencies, errors, pool):
+    stats = pool.get_stats()
+    print(f"{name}: p50 {statistics.median(latencies):.2f} с, p95 {percentile(latencies, 0.95):.2f} с, "
+          f"p99 {percentile(latencies, 0.99):.2f} с, максимум {max(latencies):.2f} с; ошибок {errors}, "
+          f"дублей {stats['hedged']} ({stats['hedged'] / stats['runs'] * 100:.1f}%), "
+          f"дубль первым {stats['hedge_wins']}, передано после ошибки {stats['failovers']}")
+    for backend in stats['backends']:
+        print(f"  {backend['name']}: ответил первым {backend['wins']}, попыток {backend['attempts']}, "
+              f"дублей {backend['hedges']}, отменено {backend['cancelled']}, ошибок {backend['failures']}, "
+              f"EWMA {backend['ewma']['first_token'] or 0:.2f} с, p95 {backend['p95']['first_token'] or 0:.2f} с")
+
+def main():
+    parser = argparse.ArgumentParser(description='Дублирование медленных запросов и переключение между моделями')
+    parser.add_argument('--requests', type=int, default=400, help='запросов в каждом прогоне')
+    parser.add_argument('--concurrency', type=int, default=16, help='одновременных запросов')
+    parser.add_argument('--latency', type=float, default=0.1, help='обычная задержка первого токена, с')
+    parser.add_argument('--slow-rate', type=float, default=0.02, help='доля медленных ответов каждой модели')
+    parser.add_argument('--slow-latency', type=float, default=3.0, help='задержка медленного ответа, с')
+    args = parser.parse_args()
+
+    # Потоки дублей считаются от числа одновременных генераций (LLM_HEDGE_WORKERS)
+    os.environ.update(ANALYSIS_CACHE_PATH=':memory:', LOG_PATH='', LOG_CONSOLE_LEVEL='error',
+                      LLM_HEDGE_DELAY='1', LLM_HEDGE_MIN_DELAY='0.2', ADMISSION_MAX_ACTIVE=str(args.concurrency))
+    from _bot import load_bot_module
+    bot_module = load_bot_module()
+
+    servers = [FakeLLMServer(latency=args.latency, slow_rate=args.slow_rate, slow_latency=args.slow_latency).start()
+               for _ in range(2)]
+
+    def backend(name, base_url):
+        gateway = bot_module.LLMGateway(base_url=base_url, api_key='fake', pool_size=args.concurrency * 2, max_retries=0)
+        return bot_module.LLMBackend(name, 'fake', gateway)
+
+    single = bot_module.LLMBackendPool([backend('a', servers[0].base_url)])
+    latencies, errors = run_load(single, args.requests, args.concurrency)
+    describe('Одна модель', latencies, errors, single)
+    single_p99 = percentile(latencies, 0.99)
+
+    hedged = bot_module.LLMBackendPool([backend('a', servers[0].base_url), backend('b', servers[1].base_url)],
+                                       hedge=True)
+    latencies, errors = run_load(hedged, args.requests, args.concurrency)
+    describe('Две модели с дублированием', latencies, errors, hedged)
+    hedged_p99 = percentile(latencies, 0.99)
+
+    # Первая модель недоступна (закрытый порт): запросы уходят второй, после нескольких ошибок она пропускается
+    dead = FakeLLMServer()
+    dead_url = dead.base_url
+    dead.server_close()
+    failover = bot_module.LLMBackendPool([backend('down', dead_url), backend('b', servers[1].base_url)], hedge=True)
+    latencies, failover_errors = run_load(failover, args.requests // 4, args.concurrency)
+    describe('Первая модель недоступна', latencies, failover_errors, failover)
+
+    # Отключенная модель не должна получать дублей: они только занимают потоки и соединения
+    dead_hedges = failover.get_stats()['backends'][0]['hedges']
+    if hedged_p99 >= single_p99 or failover_errors or dead_hedges:
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
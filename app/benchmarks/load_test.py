@@ -0,0 +1,288 @@
+"""
+Сквозной нагрузочный тест потоковой версии бота (TeleBot + UpdateDispatcher)
+на локальных фейковых серверах Telegram и модели.
+
+Бот получает обновления через long polling фейкового Bot API, и их обрабатывают
+настоящие обработчики из model2 — копия.py. Синтетическая популяция
+пользователей задается сценарием:
+    unique  - каждый пользователь спрашивает о своем произведении (всегда запрос к модели)
+    popular - пользователи спрашивают о нескольких популярных произведениях
+              (распределение Ципфа: кэш и объединение одинаковых запросов)
+    mixed   - анализ (70%), /start с картинкой (20%) и слишком короткие сообщения (10%)
+
+Для каждого раунда выводятся сообщения/с, задержка от появления обновления
+до завершения обработчика (p50/p95/p99) и прирост памяти на один одновременно
+обрабатываемый запрос. С --output результаты сохраняются в JSON, а с --compare
+сравниваются с сохраненными ранее; при росте p95 или падении пропускной
+способности больше чем на --tolerance скрипт завершается с кодом 1.
+
+Запуск:
+    python benchmarks/load_test.py --scenario unique popular mixed --users 50 200
+    python benchmarks/load_test.py --users 100 --rate 20 --output baseline.json
+    python benchmarks/load_test.py --users 100 --rate 20 --compare baseline.json
+
+Настройки самого бота (ADMISSION_MAX_ACTIVE, DISPATCHER_WORKERS, LLM_POOL_SIZE
+и т.д.) берутся из переменных окружения, как при обычном запуске.
+"""
+import argparse
+import contextlib
+import json
+import os
+import random
+import statistics
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+from _bot import APP_DIR
+from fake_llm import start_in_process
+from fake_telegram import FakeTelegramServer
+
+SCENARIOS = ('unique', 'popular', 'mixed')
+
+WORKS = [
+    'Евгений Онегин, Александр Пушкин', 'Капитанская дочка, Александр Пушкин',
+    'Преступление и наказание, Федор Достоевский', 'Война и мир, Лев Толстой',
+    'Мастер и Маргарита, Михаил Булгаков', 'Отцы и дети, Иван Тургенев',
+    'Мертвые души, Николай Гоголь', 'Герой нашего времени, Михаил Лермонтов',
+    'Горе от ума, Александр Грибоедов', 'Вишневый сад, Антон Чехов',
+]
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+def build_population(scenario, users, rng):
+    """Возвращает список текстов сообщений, по одному на пользователя"""
+    texts = []
+    # Веса Ципфа: первое произведение спрашивают чаще всего
+    weights = [1 / rank for rank in range(1, len(WORKS) + 1)]
+    for index in range(users):
+        if scenario == 'unique':
+            texts.append(f"Произведение номер {rng.randrange(10 ** 9)}, Автор {index}")
+        elif scenario == 'popular':
+            texts.append(rng.choices(WORKS, weights)[0])
+        else:
+            roll = rng.random()
+            if roll < 0.7:
+                texts.append(rng.choices(WORKS, weights)[0])
+            elif roll < 0.9:
+                texts.append('/start')
+            else:
+                texts.append('Онег')
+    return texts
+
+class MemorySampler:
+    """Фоновый замер памяти процесса и числа одновременно обрабатываемых обновлений"""
+    
+    def __init__(self, in_flight, use_tracemalloc, interval=0.02):
+        self.in_flight = in_flight
+        self.use_tracemalloc = use_tracemalloc
+        self.interval = interval
+        self.samples = []
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+    
+    def current(self):
+        if self.use_tracemalloc:
+            return tracemalloc.get_traced_memory()[0]
+        return psutil.Process().memory_info().rss
+    
+    def start(self):
+        self.baseline = self.current()
+        self._thread.start()
+        return self
+    
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.samples.append((self.in_flight(), self.current()))
+    
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+    
+    def per_request(self):
+        """Прирост памяти в пике, деленный на пиковое число одновременных обновлений"""
+        peak_in_flight = max((count for count, _ in self.samples), default=0)
+        peak_memory = max((memory for _, memory in self.samples), default=self.baseline)
+        if not peak_in_flight:
+            return peak_in_flight, 0.0
+        return peak_in_flight, max(0, peak_memory - self.baseline) / peak_in_flight
+
+def run_round(bot_module, telegram, texts, first_chat_id, rate, use_tracemalloc, verbose):
+    """Отправляет сообщения популяции и ждет, пока диспетчер обработает все обновления"""
+    pushed = {}
+    finished = {}
+    lock = threading.Lock()
+    all_done = threading.Event()
+    dispatcher = bot_module.bot.dispatcher
+    original_handler = dispatcher.handler
+    
+    def timed_handler(update):
+        try:
+            original_handler(update)
+        finally:
+            with lock:
+                finished[update.update_id] = time.time()
+                if len(finished) == len(texts):
+                    all_done.set()
+    
+    def in_flight():
+        with lock:
+            return len(pushed) - len(finished)
+    
+    def rejected():
+        stats = bot_module.admission.get_stats()
+        return stats['rejected_rate'] + stats['rejected_user'] + stats['rejected_queue']
+    
+    rejected_before = rejected()
+    dispatcher.handler = timed_handler
+    sampler = MemorySampler(in_flight, use_tracemalloc).start()
+    output = contextlib.nullcontext() if verbose else contextlib.redirect_stdout(open(os.devnull, 'w'))
+    try:
+        with output:
+            round_started = time.time()
+            for offset, text in enumerate(texts):
+                if rate:
+                    # Равномерное поступление с заданной частотой вместо одновременного всплеска
+                    time.sleep(max(0.0, round_started + offset / rate - time.time()))
+                pushed_at = time.time()
+                update_id = telegram.push_message(first_chat_id + offset, text)
+                with lock:
+                    pushed[update_id] = pushed_at
+            completed = all_done.wait(timeout=600)
+            elapsed = time.time() - round_started
+    finally:
+        sampler.stop()
+        dispatcher.handler = original_handler
+    
+    if not completed:
+        print(f"[WARNING] Обработано только {len(finished)} из {len(texts)} обновлений")
+    latencies = [finished[update_id] - pushed[update_id] for update_id in finished]
+    peak_in_flight, memory_per_request = sampler.per_request()
+    return {
+        'messages': len(finished),
+        'elapsed': elapsed,
+        'throughput': len(finished) / elapsed,
+        'p50': statistics.median(latencies),
+        'p95': percentile(latencies, 0.95),
+        'p99': percentile(latencies, 0.99),
+        # Отказы допуска к модели отвечают быстро и занижают задержку
+        'rejected': rejected() - rejected_before,
+        'peak_in_flight': peak_in_flight,
+        'memory_per_request': memory_per_request,
+    }
+
+def start_bot(telegram, llm_base_url):
+    """Загружает модуль бота, направляет его на фейковые серверы и запускает long polling"""
+    os.environ.update(LLM_BASE_URL=llm_base_url, ANALYSIS_CACHE_PATH=':memory:',
+                      LOG_PATH=os.path.join(tempfile.mkdtemp(prefix='bench-'), 'bot.log.jsonl'))
+    # Измеряется пропускная способность самого бота, а не лимиты Telegram
+    os.environ.setdefault('TELEGRAM_RATE_LIMIT', '0')
+    
+    from _bot import load_bot_module
+    bot_module = load_bot_module()
+    bot_module.init_bot()
+    import telebot.apihelper
+    telebot.apihelper.API_URL = telegram.api_url
+    # Кэш file_id картинки не должен попадать в рабочий media_cache.json
+    bot_module.MEDIA_CACHE_PATH = os.path.join(tempfile.mkdtemp(), 'media_cache.json')
+    bot_module.WELCOME_IMAGE_PATH = os.path.join(APP_DIR, 'main.png')
+    
+    threading.Thread(target=bot_module.bot.polling, kwargs={'non_stop': True, 'interval': 0, 'timeout': 1},
+                     daemon=True).start()
+    return bot_module
+
+def compare(results, baseline_path, tolerance):
+    """Печатает изменения относительно сохраненных результатов, возвращает число регрессий"""
+    with open(baseline_path, encoding='utf-8') as baseline_file:
+        baseline = {(row['scenario'], row['users']): row for row in json.load(baseline_file)['results']}
+    
+    regressions = 0
+    print(f"\nСравнение с {baseline_path} (допуск {tolerance:.0%}):")
+    for row in results:
+        old = baseline.get((row['scenario'], row['users']))
+        if old is None:
+            continue
+        throughput_change = row['throughput'] / old['throughput'] - 1
+        p95_change = row['p95'] / old['p95'] - 1 if old['p95'] else 0.0
+        regressed = throughput_change < -tolerance or p95_change > tolerance
+        regressions += regressed
+        print(f"  {row['scenario']:>8} {row['users']:>6}: сообщ/с {throughput_change:+.1%}, p95 {p95_change:+.1%}"
+              f"{'  <- регрессия' if regressed else ''}")
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description='Сквозной нагрузочный тест потоковой версии бота')
+    parser.add_argument('--scenario', nargs='+', choices=SCENARIOS, default=['unique', 'popular', 'mixed'],
+                        help='популяции пользователей')
+    parser.add_argument('--users', type=int, nargs='+', default=[20, 100], help='число пользователей в раунде')
+    parser.add_argument('--rate', type=float, default=0.0,
+                        help='сообщений в секунду (0 - все сообщения одновременно)')
+    parser.add_argument('--latency', type=float, default=0.5, help='задержка модели до первого токена, с')
+    parser.add_argument('--token-delay', type=float, default=0.001, help='задержка между токенами, с')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='доля ответов модели 429/503')
+    parser.add_argument('--telegram-latency', type=float, default=0.0, help='задержка ответа Bot API, с')
+    parser.add_argument('--tracemalloc', action='store_true',
+                        help='считать память по tracemalloc (кучу Python) вместо RSS')
+    parser.add_argument('--seed', type=int, default=0, help='зерно генератора популяций')
+    parser.add_argument('--output', help='сохранить результаты в JSON')
+    parser.add_argument('--compare', help='сравнить с результатами из JSON')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='допустимое ухудшение при сравнении')
+    parser.add_argument('--verbose', action='store_true', help='не скрывать журнал бота')
+    args = parser.parse_args()
+    
+    use_tracemalloc = args.tracemalloc or psutil is None
+    if use_tracemalloc:
+        tracemalloc.start()
+    
+    llm_process, llm_base_url = start_in_process(latency=args.latency, token_delay=args.token_delay,
+                                                 error_rate=args.error_rate)
+    telegram = FakeTelegramServer(latency=args.telegram_latency).start()
+    bot_module = start_bot(telegram, llm_base_url)
+    rng = random.Random(args.seed)
+    
+    print(f"Модель: задержка {args.latency} с, {args.token_delay * 1000:.0f} мс на токен; "
+          f"поступление: {f'{args.rate:g} сообщ/с' if args.rate else 'одновременно'}; "
+          f"память: {'tracemalloc' if use_tracemalloc else 'RSS'}")
+    print(f"{'сценарий':>8} {'польз.':>6} {'время, с':>9} {'сообщ/с':>8} {'p50, с':>7} {'p95, с':>7} "
+          f"{'p99, с':>7} {'отказов':>8} {'пик':>5} {'КБ/запрос':>10}")
+    
+    results = []
+    first_chat_id = 1
+    for scenario in args.scenario:
+        for users in args.users:
+            texts = build_population(scenario, users, rng)
+            row = run_round(bot_module, telegram, texts, first_chat_id, args.rate, use_tracemalloc, args.verbose)
+            first_chat_id += users
+            row.update(scenario=scenario, users=users)
+            results.append(row)
+            print(f"{scenario:>8} {users:>6} {row['elapsed']:>9.2f} {row['throughput']:>8.1f} {row['p50']:>7.2f} "
+                  f"{row['p95']:>7.2f} {row['p99']:>7.2f} {row['rejected']:>8} {row['peak_in_flight']:>5} "
+                  f"{row['memory_per_request'] / 1024:>10.1f}")
+    
+    print(f"\nКэш: {bot_module.analysis_cache.get_stats()}")
+    print(f"Объединение запросов: {bot_module.answer_flights.get_stats()}")
+    print(f"Допуск к модели: {bot_module.admission.get_stats()}")
+    print(f"Диспетчер: {bot_module.bot.dispatcher.get_stats()}")
+    
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as output_file:
+            json.dump({'args': vars(args), 'results': results}, output_file, ensure_ascii=False, indent=2)
+        print(f"Результаты сохранены в {args.output}")
+    
+    regressions = compare(results, args.compare, args.tolerance) if args.compare else 0
+    
+    bot_module.bot.stop_polling()
+    llm_process.terminate()
+    sys.exit(1 if regressions else 0)
+
+if __name__ == '__main__':
+    main()
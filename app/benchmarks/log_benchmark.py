@@ -0,0 +1,123 @@
+"""
+Проверка журнала (LogPipeline): стоимость записи для обработчика по сравнению
+с синхронным print в файл, размер пачек при записи на диск, поведение при
+медленном диске (очередь переполнена - обработчик не ждет, отладочные записи
+прореживаются), ротация по размеру и кодировка UTF-8.
+
+Запуск: python benchmarks/log_benchmark.py [--records 50000] [--slow-disk 0.05]
+"""
+import argparse
+import json
+import os
+import tempfile
+import threading
+import time
+
+from _bot import load_bot_module
+
+MESSAGE = "Получен запрос от пользователя 12345: Евгений Онегин, Александр Пушкин..."
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+def measure_print(path, records):
+    """Прежний способ: print в файл из потока обработчика"""
+    latencies = []
+    with open(path, 'w', encoding='utf-8') as target:
+        for number in range(records):
+            started = time.perf_counter()
+            print(f"[LOG] {MESSAGE} {number}", file=target, flush=True)
+            latencies.append(time.perf_counter() - started)
+    return latencies
+
+def measure_pipeline(pipeline, records, threads=4, debug_share=0.0, rate=0.0):
+    """Записи из нескольких потоков (rate - записей в секунду на все потоки, 0 - без пауз); задержки emit"""
+    latencies = []
+    lock = threading.Lock()
+
+    def worker(count):
+        own = []
+        began = time.perf_counter()
+        for number in range(count):
+            if rate:
+                delay = began + number * threads / rate - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+            level = 'debug' if number % 2 and debug_share else 'info'
+            started = time.perf_counter()
+            pipeline.emit(level, MESSAGE, number=number)
+            own.append(time.perf_counter() - started)
+        with lock:
+            latencies.extend(own)
+
+    workers = [threading.Thread(target=worker, args=(records // threads,)) for _ in range(threads)]
+    for thread in workers:
+        thread.start()
+    for thread in workers:
+        thread.join()
+    pipeline.flush(timeout=60)
+    return latencies
+
+def describe(name, latencies):
+    print(f"{name}: p50 {percentile(latencies, 0.5) * 1e6:.1f} мкс, p99 {percentile(latencies, 0.99) * 1e6:.1f} мкс, "
+          f"максимум {max(latencies) * 1e6:.0f} мкс")
+
+def main():
+    parser = argparse.ArgumentParser(description='Проверка неблокирующего журнала')
+    parser.add_argument('--records', type=int, default=50000, help='число записей')
+    parser.add_argument('--rate', type=float, default=20000, help='записей в секунду при обычной нагрузке')
+    parser.add_argument('--slow-disk', type=float, default=0.05, help='задержка одной записи на диск, с')
+    args = parser.parse_args()
+
+    bot_module = load_bot_module()
+    LogPipeline = bot_module.LogPipeline
+    workdir = tempfile.mkdtemp(prefix='logbench-')
+
+    describe('print в файл', measure_print(os.path.join(workdir, 'print.log'), args.records))
+
+    path = os.path.join(workdir, 'fast.jsonl')
+    pipeline = LogPipeline(path=path, level='debug', console_level='error').start()
+    latencies = measure_pipeline(pipeline, args.records, rate=args.rate)
+    describe(f'LogPipeline, {args.rate:.0f} записей/с', latencies)
+    stats = pipeline.get_stats()
+    pipeline.close()
+    print(f"  записей на диске: {sum(1 for _ in open(path, encoding='utf-8'))} из {args.records}, пачек: {stats['batches']}, "
+          f"в среднем {stats['written'] / stats['batches']:.0f} записей на запись, наибольшая {stats['max_batch']}")
+
+    # Медленный диск и поток записей без пауз: очередь переполняется, обработчик не ждет
+    path = os.path.join(workdir, 'slow.jsonl')
+    pipeline = LogPipeline(path=path, level='debug', console_level='error', queue_size=1000).start()
+    write_file = pipeline._write_file
+
+    def slow_write(data):
+        time.sleep(args.slow_disk)
+        write_file(data)
+
+    pipeline._write_file = slow_write
+    latencies = measure_pipeline(pipeline, args.records, debug_share=0.5)
+    describe(f'LogPipeline без пауз, диск {args.slow_disk * 1000:.0f} мс на запись', latencies)
+    stats = pipeline.get_stats()
+    pipeline.close()
+    with open(path, encoding='utf-8') as written:
+        levels = [json.loads(line)['level'] for line in written]
+    print(f"  сохранено: info {levels.count('info')}, debug {levels.count('debug')} из {args.records // 2} каждого; "
+          f"пропущено {stats['dropped']}, пачек {stats['batches']}")
+
+    # Ротация по размеру и UTF-8
+    path = os.path.join(workdir, 'rotate.jsonl')
+    pipeline = LogPipeline(path=path, level='debug', console_level='error', max_bytes=64 * 1024, backups=3).start()
+    for number in range(3000):
+        pipeline.info(MESSAGE, number=number)
+        if number % 500 == 0:
+            pipeline.flush()
+    pipeline.close()
+    files = sorted(name for name in os.listdir(workdir) if name.startswith('rotate.jsonl'))
+    with open(path, encoding='utf-8') as current:
+        first = json.loads(current.readline())
+    print(f"Ротация: {pipeline.get_stats()['rotations']} раз, файлов осталось {len(files)} (текущий и 3 старых), "
+          f"текст в UTF-8 читается: {first['msg'] == MESSAGE}")
+    print(f"Файлы: {workdir}")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,94 @@
+"""
+Прогон пакетной подготовки анализов (--precompute) на фейковой модели.
+
+Готовит список произведений из corpus/prompt_variants.tsv (с дубликатами и,
+по желанию, синтетическими произведениями), запускает run_precompute,
+повторяет запуск (все уже готово - ни одного обращения к модели) и проверяет,
+что бот отвечает на разные формулировки тех же произведений из кэша без
+обращения к модели и без форматирования.
+
+Запуск: python benchmarks/precompute_run.py [--workers 8] [--extra 200] [--error-rate 0.05]
+"""
+import argparse
+import csv
+import os
+import statistics
+import sys
+import tempfile
+import time
+
+from _bot import CORPUS_DIR
+from fake_llm import FakeLLMServer
+from resolver_benchmark import load_variants
+
+def write_work_list(path, variants, extra):
+    """CSV с заголовком title,author: по строке на произведение, дубликат каждой и синтетические"""
+    rows = []
+    for expected in dict.fromkeys(expected for expected, _ in variants if expected):
+        title, author = expected.split('|')
+        rows.append((title.capitalize(), author.title()))
+        rows.append((title.upper(), author))
+    rows += [(f"Произведение номер {number}", f"Автор {number}") for number in range(extra)]
+    with open(path, 'w', encoding='utf-8', newline='') as target:
+        writer = csv.writer(target)
+        writer.writerow(('title', 'author'))
+        writer.writerows(rows)
+    return len(rows)
+
+def main():
+    parser = argparse.ArgumentParser(description='Прогон пакетной подготовки анализов на фейковой модели')
+    parser.add_argument('--file', default=os.path.join(CORPUS_DIR, 'prompt_variants.tsv'), help='выборка формулировок')
+    parser.add_argument('--workers', type=int, default=8, help='одновременных запросов к модели')
+    parser.add_argument('--extra', type=int, default=100, help='синтетических произведений сверх выборки')
+    parser.add_argument('--latency', type=float, default=0.2, help='задержка фейковой модели, с')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='доля ответов 429/503 фейковой модели')
+    args = parser.parse_args()
+
+    llm = FakeLLMServer(latency=args.latency, error_rate=args.error_rate).start()
+    workdir = tempfile.mkdtemp(prefix='precompute-')
+    os.environ.update(LLM_BASE_URL=llm.base_url, ANALYSIS_CACHE_PATH=os.path.join(workdir, 'cache.sqlite3'),
+                      LOG_PATH=os.path.join(workdir, 'bot.log.jsonl'), PRECOMPUTE_PROGRESS_INTERVAL='1')
+
+    from _bot import load_bot_module
+    bot_module = load_bot_module()
+    bot_module.init_bot()
+    run_precompute = load_bot_module('bot_precompute').run_precompute
+    variants = load_variants(args.file)
+    work_list = os.path.join(workdir, 'works.csv')
+    rows = write_work_list(work_list, variants, args.extra)
+
+    started = time.perf_counter()
+    code = run_precompute(['--precompute', work_list, '--workers', str(args.workers)])
+    first_run = time.perf_counter() - started
+    requests_first = llm.requests
+
+    code_again = run_precompute(['--precompute', work_list, '--workers', str(args.workers)])
+    requests_again = llm.requests - requests_first
+
+    # Разные формулировки тех же произведений: ответ и HTML из кэша
+    requests_before = llm.requests
+    latencies = []
+    formatted_ready = 0
+    for expected, prompt in variants:
+        if not expected:
+            continue
+        started = time.perf_counter()
+        response, formatted = bot_module.get_cached_answer(prompt)
+        latencies.append(time.perf_counter() - started)
+        formatted_ready += formatted is not None
+    served_requests = llm.requests - requests_before
+    stats = bot_module.analysis_cache.get_stats()
+
+    print(f"Список: {rows} строк, первый запуск: {first_run:.2f} с, код {code}, обращений к модели {requests_first}")
+    print(f"Повторный запуск: код {code_again}, обращений к модели {requests_again}")
+    print(f"Кэш: записей {stats['entries']}, закреплено {stats['pinned']}")
+    print(f"Ответы на {len(latencies)} формулировок: обращений к модели {served_requests}, "
+          f"готовый HTML {formatted_ready}, p50 {statistics.median(latencies) * 1000:.2f} мс, "
+          f"максимум {max(latencies) * 1000:.2f} мс")
+    print(f"Журнал и кэш: {workdir}")
+
+    if served_requests or formatted_ready < len(latencies) or (code and not args.error_rate):
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,157 @@
+"""
+Проверка сопоставления запросов с произведениями (WorkResolver): сколько
+повторных запросов попадает в кэш с ключом по произведению и с прежним ключом
+normalize_prompt, нет ли ложных объединений разных запросов на выборке
+corpus/prompt_variants.tsv, и сколько стоит поиск в каталоге из десятков тысяч
+произведений.
+
+Запуск: python benchmarks/resolver_benchmark.py [--works 50000] [--queries 20000] [--verbose]
+"""
+import argparse
+import os
+import random
+import statistics
+import sys
+import time
+
+from _bot import CORPUS_DIR, load_bot_module
+
+_SYLLABLES = ['ба', 'ве', 'го', 'ду', 'жи', 'за', 'ки', 'ло', 'ма', 'не', 'по', 'ру', 'са', 'ти', 'фе', 'хо',
+              'ца', 'че', 'ша', 'ю', 'ра', 'ле', 'ми', 'но', 'ст', 'пр', 'тр', 'кр', 'гл', 'вл']
+_ENDINGS = ['а', 'ы', 'у', 'ой', 'ом', 'е', 'ого', 'ий']
+
+def load_variants(path):
+    """Читает строки "ожидаемый ID<TAB>запрос", пропуская комментарии"""
+    variants = []
+    with open(path, encoding='utf-8') as sample:
+        for line in sample:
+            if not line.strip() or line.startswith('#'):
+                continue
+            expected, prompt = line.rstrip('\n').split('\t', 1)
+            variants.append((None if expected == '-' else expected, prompt))
+    return variants
+
+def simulate_hits(keys):
+    """Доля запросов, ключ которых уже встречался раньше (попадание в кэш)"""
+    seen = set()
+    hits = 0
+    for key in keys:
+        hits += key in seen
+        seen.add(key)
+    return hits / len(keys)
+
+def random_word(rng):
+    return ''.join(rng.choice(_SYLLABLES) for _ in range(rng.randint(2, 4)))
+
+def synthetic_catalog(size, seed):
+    """Каталог из size случайных произведений, по пять на автора"""
+    rng = random.Random(seed)
+    works = []
+    for index in range(size):
+        if index % 5 == 0:
+            author = f"{random_word(rng).capitalize()} {random_word(rng).capitalize()}"
+        title = ' '.join(random_word(rng) for _ in range(rng.randint(1, 4))).capitalize()
+        works.append(([author], [title]))
+    return works
+
+def mutate(rng, text):
+    """Падежное окончание и изредка опечатка в каждом слове"""
+    words = []
+    for word in text.split():
+        if len(word) > 5 and rng.random() < 0.5:
+            word = word[:-1] + rng.choice(_ENDINGS)
+        if len(word) > 6 and rng.random() < 0.2:
+            position = rng.randrange(1, 5)
+            word = word[:position] + rng.choice('аеиоу') + word[position + 1:]
+        words.append(word)
+    return ' '.join(words)
+
+def main():
+    parser = argparse.ArgumentParser(description='Сопоставление запросов с произведениями каталога')
+    parser.add_argument('--file', default=os.path.join(CORPUS_DIR, 'prompt_variants.tsv'), help='выборка формулировок')
+    parser.add_argument('--works', type=int, default=50000, help='размер синтетического каталога')
+    parser.add_argument('--queries', type=int, default=20000, help='число запросов к синтетическому каталогу')
+    parser.add_argument('--seed', type=int, default=0, help='зерно генератора')
+    parser.add_argument('--verbose', action='store_true', help='показать несовпадения')
+    args = parser.parse_args()
+
+    bot_module = load_bot_module()
+    resolver = bot_module.WorkResolver()
+    variants = load_variants(args.file)
+
+    legacy_keys = [bot_module.normalize_prompt(prompt) for _, prompt in variants]
+    new_keys = []
+    correct = missed = wrong = 0
+    problems = []
+    for expected, prompt in variants:
+        outcome, work = resolver.match(prompt)
+        new_keys.append(f"work:{work[0]}" if work else bot_module.normalize_prompt(prompt))
+        if expected is None:
+            if work:
+                wrong += 1
+                problems.append(('лишнее объединение', prompt, work[0]))
+        elif work and work[0] == expected:
+            correct += 1
+        elif work:
+            wrong += 1
+            problems.append(('другое произведение', prompt, work[0]))
+        else:
+            missed += 1
+            problems.append(('не распознано', prompt, outcome))
+
+    # Ложное объединение: один ключ у запросов с разными ожидаемыми произведениями
+    owners = {}
+    false_merges = 0
+    for (expected, prompt), key in zip(variants, new_keys):
+        owner = expected or prompt
+        if owners.setdefault(key, owner) != owner:
+            false_merges += 1
+
+    rng = random.Random(args.seed)
+    stream = [index for index in range(len(variants)) for _ in range(3)]
+    rng.shuffle(stream)
+    legacy_hits = simulate_hits([legacy_keys[index] for index in stream])
+    new_hits = simulate_hits([new_keys[index] for index in stream])
+
+    expected_total = sum(1 for expected, _ in variants if expected)
+    print(f"Выборка: {len(variants)} запросов, из них {expected_total} с известным произведением")
+    print(f"Распознано верно: {correct}, не распознано: {missed}, ошибок: {wrong}, ложных объединений ключей: {false_merges}")
+    print(f"Различных ключей: прежних {len(set(legacy_keys))}, новых {len(set(new_keys))}")
+    print(f"Попадания в кэш на потоке из {len(stream)} запросов: прежний ключ {legacy_hits * 100:.1f}%, "
+          f"ключ по произведению {new_hits * 100:.1f}%")
+    if args.verbose:
+        for kind, prompt, detail in problems:
+            print(f"  {kind}: {prompt} ({detail})")
+
+    started = time.perf_counter()
+    catalog = synthetic_catalog(args.works, args.seed)
+    big = bot_module.WorkResolver(works=bot_module.LITERATURE_WORKS + catalog)
+    build_time = time.perf_counter() - started
+
+    queries = []
+    for _ in range(args.queries):
+        authors, titles = rng.choice(catalog)
+        text = titles[0] if rng.random() < 0.5 else f"{titles[0]} {authors[0]}"
+        queries.append((f"{titles[0].lower()}|{authors[0].lower()}", mutate(rng, text)))
+    queries += [(None, prompt) for _, prompt in variants]
+
+    latencies = []
+    found = 0
+    for expected, prompt in queries:
+        started = time.perf_counter()
+        _, work = big.match(prompt)
+        latencies.append(time.perf_counter() - started)
+        found += bool(work and expected and work[0] == expected)
+    latencies.sort()
+    p99 = latencies[min(len(latencies) - 1, int(0.99 * len(latencies)))]
+
+    stats = big.get_stats()
+    print(f"Синтетический каталог: {stats['works']} произведений, {stats['stems']} основ, построение {build_time:.2f} с")
+    print(f"Поиск: p50 {statistics.median(latencies) * 1e6:.0f} мкс, p99 {p99 * 1e6:.0f} мкс, "
+          f"максимум {latencies[-1] * 1e6:.0f} мкс; найдено верно {found} из {args.queries} искаженных запросов")
+
+    if false_merges or wrong:
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
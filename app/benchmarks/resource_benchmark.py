@@ -0,0 +1,100 @@
+"""
+Проверка фонового сбора показателей (ResourceSampler) и проверки API модели
+(LLMHealthProbe): стоимость одного замера с psutil и через /proc, постоянный
+объем памяти кольцевого буфера, время ответа /status по сравнению с прежними
+синхронными вызовами psutil и реакция проверки API на остановку сервера.
+
+Запуск: python benchmarks/resource_benchmark.py [--samples 20000]
+"""
+import argparse
+import math
+import os
+import statistics
+import time
+import tracemalloc
+from types import SimpleNamespace
+
+from fake_llm import FakeLLMServer
+
+def measure_calls(function, repeat):
+    latencies = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        function()
+        latencies.append(time.perf_counter() - started)
+    return statistics.median(latencies) * 1000, max(latencies) * 1000
+
+def legacy_status_probe():
+    """Прежний /status: импорт psutil и синхронные замеры в обработчике"""
+    import psutil
+    psutil.virtual_memory()
+    psutil.disk_usage('/')
+    psutil.cpu_percent()
+
+def main():
+    parser = argparse.ArgumentParser(description='Фоновый сбор показателей ресурсов и проверка API модели')
+    parser.add_argument('--samples', type=int, default=20000, help='число замеров для проверки памяти буфера')
+    parser.add_argument('--repeat', type=int, default=200, help='повторов замера времени')
+    args = parser.parse_args()
+
+    llm = FakeLLMServer(latency=0).start()
+    os.environ.update(LLM_BASE_URL=llm.base_url, ANALYSIS_CACHE_PATH=':memory:', LOG_PATH='')
+    from _bot import load_bot_module
+    bot_module = load_bot_module()
+
+    sampler = bot_module.ResourceSampler(interval=5, history_minutes=15)
+    sampler.sample()
+    median, worst = measure_calls(sampler.sample, args.repeat)
+    print(f"Замер (psutil): медиана {median:.3f} мс, максимум {worst:.3f} мс")
+
+    psutil_module = bot_module.psutil
+    bot_module.psutil = None
+    fallback = bot_module.ResourceSampler(interval=5, history_minutes=15)
+    fallback.sample()
+    median, worst = measure_calls(fallback.sample, args.repeat)
+    bot_module.psutil = psutil_module
+    current = fallback.summary()
+    print(f"Замер (/proc): медиана {median:.3f} мс, максимум {worst:.3f} мс; показателей с данными: "
+          f"{len(current)} из {len(fallback.SERIES)}")
+
+    # Буфер заполнен многократно: память не растет, окна считаются по времени замеров
+    tracemalloc.start()
+    now = time.time()
+    for number in range(sampler.capacity):
+        sampler.record({'cpu': 10.0, 'memory': 50.0}, now=now - (sampler.capacity - number) * sampler.interval)
+    before = tracemalloc.take_snapshot()
+    for number in range(args.samples):
+        sampler.record({'cpu': 50 + 50 * math.sin(number / 20), 'memory': 40.0 + number % 7},
+                       now=now + number * sampler.interval)
+    after = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+    growth = sum(stat.size_diff for stat in after.compare_to(before, 'filename'))
+    print(f"Буфер на {sampler.capacity} замеров: после еще {args.samples} замеров память изменилась на {growth} байт")
+
+    cpu = sampler.summary(now=now + args.samples * sampler.interval)['cpu']
+    averages = ' / '.join(f"{cpu['windows'][window][0]:.0f}" for window in sampler.WINDOWS)
+    print(f"CPU: сейчас {cpu['current']:.0f}%, средние {averages}, спарклайн {cpu['sparkline']}")
+
+    # /status целиком: фоновые данные против прежних синхронных замеров
+    bot_module.resource_sampler.start()
+    replies = []
+    bot_module.bot.send_message = lambda chat_id, text, **kwargs: replies.append(text)
+    message = SimpleNamespace(from_user=SimpleNamespace(id=int(bot_module.ADMIN_ID)), chat=SimpleNamespace(id=1))
+    median, worst = measure_calls(lambda: bot_module.status_handler(message), args.repeat)
+    print(f"/status: медиана {median:.3f} мс, максимум {worst:.3f} мс")
+    median, worst = measure_calls(legacy_status_probe, args.repeat)
+    print(f"Прежние синхронные вызовы psutil в /status: медиана {median:.3f} мс, максимум {worst:.3f} мс")
+    print('\n'.join(line for line in replies[-1].splitlines() if line.startswith('• ') and '<code>' in line))
+
+    probe = bot_module.LLMHealthProbe(bot_module.llm_gateway, interval=0, timeout=2)
+    healthy = probe.check()
+    print(f"Проверка API: {healthy}, {probe.status_text()}")
+    llm.shutdown()
+    # Шлюз с новым пулом: открытое keep-alive соединение с остановленным сервером еще обслуживается
+    probe.gateway = bot_module.LLMGateway(base_url=llm.base_url, api_key='fake', max_retries=0)
+    llm.server_close()
+    healthy = probe.check()
+    print(f"После остановки сервера: {healthy}, {probe.status_text().splitlines()[0]}")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,169 @@
+"""
+Проверка режима нескольких процессов (UpdateRouter): бот запускается отдельным
+процессом с --processes N против фейковых Telegram и модели. Сравниваются
+пропускная способность и задержки с одним процессом, проверяется, что все
+обновления чата обработал один обработчик и по порядку, и что при перезапуске
+обработчиков по /reset посреди нагрузки ни одно обновление не потеряно и не
+обработано дважды.
+
+Завершение обработки определяется по итоговым записям 'request' в журналах
+обработчиков (bot.worker{N}.jsonl).
+
+Запуск: python benchmarks/scaleout_test.py [--processes 1 4] [--users 300] [--messages 3]
+"""
+import argparse
+import glob
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+from _bot import BOT_PATH
+from fake_llm import start_in_process
+from fake_telegram import FakeTelegramServer
+
+ADMIN_ID = 999
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+def read_records(workdir):
+    """Записи журналов бота: {имя файла: [записи]}"""
+    records = {}
+    for path in glob.glob(os.path.join(workdir, 'bot*.jsonl')):
+        with open(path, encoding='utf-8') as log_file:
+            records[os.path.basename(path)] = [json.loads(line) for line in log_file if line.strip()]
+    return records
+
+def finished_requests(workdir):
+    """Итоговые записи обработки обновлений: [(файл журнала, запись)]"""
+    return [(name, record) for name, records in read_records(workdir).items()
+            for record in records if record.get('event') == 'request']
+
+def restarts_finished(workdir):
+    return sum(1 for records in read_records(workdir).values() for record in records
+               if 'Перезапуск обработчиков завершен' in record.get('msg', ''))
+
+def start_bot(processes, telegram, llm_base_url, workdir):
+    env = dict(os.environ, TELEGRAM_API_URL=telegram.api_url, LLM_BASE_URL=llm_base_url, TELEGRAM_RATE_LIMIT='0',
+               ANALYSIS_CACHE_PATH=os.path.join(workdir, 'cache.sqlite3'), LOG_PATH=os.path.join(workdir, 'bot.jsonl'),
+               LOG_CONSOLE_LEVEL='error', METRICS_PORT='0', ADMIN_ID=str(ADMIN_ID), LLM_POOL_SIZE='100',
+               ADMISSION_MAX_ACTIVE='400', ADMISSION_QUEUE_SIZE='2000', RELOAD_DRAIN_TIMEOUT='60')
+    env.pop('BOT_PROCESSES', None)
+    arguments = [sys.executable, BOT_PATH] + (['--processes', str(processes)] if processes > 1 else [])
+    # Рабочий каталог - временный: без .env приложения и без записи media_cache.json рядом с ботом
+    process = subprocess.Popen(arguments, env=env, cwd=workdir, stdout=subprocess.DEVNULL)
+    deadline = time.time() + 60
+    ready_line = 'принимает обновления' if processes > 1 else 'API модели доступен'
+    while time.time() < deadline:
+        ready = sum(1 for records in read_records(workdir).values()
+                    for record in records if ready_line in record.get('msg', ''))
+        if ready >= processes:
+            break
+        time.sleep(0.2)
+    else:
+        process.kill()
+        raise RuntimeError('бот не запустился за 60 с')
+    return process
+
+def run(processes, args, telegram, llm_base_url, reset=False):
+    workdir = tempfile.mkdtemp(prefix=f'scaleout-{processes}-')
+    process = start_bot(processes, telegram, llm_base_url, workdir)
+    pushed = {}
+    chats = {}
+    started = time.time()
+    try:
+        for round_number in range(args.messages):
+            for user in range(args.users):
+                chat_id = 1000 + user
+                update_id = telegram.push_message(chat_id, f"Произведение номер {round_number}-{user}, Автор {user}")
+                pushed[update_id] = time.time()
+                chats[update_id] = chat_id
+            if reset and round_number == 0:
+                # Перезапуск обработчиков по одному посреди нагрузки
+                telegram.push_message(ADMIN_ID, '/reset')
+        deadline = time.time() + 300
+        while time.time() < deadline:
+            done = {record['request_id'] for _, record in finished_requests(workdir) if record['request_id'] in pushed}
+            if len(done) >= len(pushed):
+                break
+            time.sleep(0.5)
+        elapsed = max(record['ts'] for _, record in finished_requests(workdir)) - started
+        # Последний обработчик перезапускается, когда нагрузка уже обработана: ждем завершения перезапуска
+        while reset and time.time() < deadline and not restarts_finished(workdir):
+            time.sleep(0.5)
+    finally:
+        process.terminate()
+        process.wait(timeout=120)
+
+    finished = [(name, record) for name, record in finished_requests(workdir) if record['request_id'] in pushed]
+    latencies = [record['ts'] - pushed[record['request_id']] for _, record in finished]
+    counts = {}
+    for _, record in finished:
+        counts[record['request_id']] = counts.get(record['request_id'], 0) + 1
+
+    # Порядок: обновления чата завершены по возрастанию update_id и в журнале одного обработчика
+    # (при /reset чат может перейти к новому процессу того же номера - его журнал тот же)
+    by_chat = {}
+    for name, record in sorted(finished, key=lambda item: item[1]['ts']):
+        by_chat.setdefault(chats[record['request_id']], []).append((name, record['request_id']))
+    out_of_order = sum(1 for items in by_chat.values() if [update_id for _, update_id in items] != sorted(update_id for _, update_id in items))
+    split_chats = sum(1 for items in by_chat.values() if len({name for name, _ in items}) > 1)
+    restarts = restarts_finished(workdir)
+    return {
+        'processes': processes,
+        'pushed': len(pushed),
+        'finished': len(counts),
+        'duplicates': sum(count - 1 for count in counts.values()),
+        'elapsed': elapsed,
+        'throughput': len(counts) / elapsed,
+        'p50': statistics.median(latencies),
+        'p95': percentile(latencies, 0.95),
+        'out_of_order': out_of_order,
+        'split_chats': split_chats,
+        'restarts': restarts,
+    }
+
+def describe(name, result):
+    print(f"{name}: обработано {result['finished']} из {result['pushed']} (дублей {result['duplicates']}) за "
+          f"{result['elapsed']:.1f} с, {result['throughput']:.0f} обновл/с, p50 {result['p50']:.2f} с, "
+          f"p95 {result['p95']:.2f} с; чатов не по порядку {result['out_of_order']}, "
+          f"чатов у нескольких обработчиков {result['split_chats']}"
+          + (f", перезапусков завершено {result['restarts']}" if result['restarts'] else ''))
+
+def main():
+    parser = argparse.ArgumentParser(description='Режим нескольких процессов: приемщик и обработчики')
+    parser.add_argument('--processes', type=int, nargs='+', default=[1, 4], help='число процессов-обработчиков')
+    parser.add_argument('--users', type=int, default=300, help='чатов')
+    parser.add_argument('--messages', type=int, default=3, help='сообщений от каждого чата')
+    parser.add_argument('--latency', type=float, default=0.2, help='задержка модели до первого токена, с')
+    parser.add_argument('--token-delay', type=float, default=0.0005, help='задержка между токенами, с')
+    args = parser.parse_args()
+
+    llm_process, llm_base_url = start_in_process(latency=args.latency, token_delay=args.token_delay)
+    telegram = FakeTelegramServer().start()
+    print(f"Чатов {args.users}, сообщений от каждого {args.messages}, процессор: {os.cpu_count()} ядер")
+
+    results = []
+    for processes in args.processes:
+        result = run(processes, args, telegram, llm_base_url)
+        describe(f"Процессов {processes}", result)
+        results.append(result)
+
+    largest = max(args.processes)
+    failed = any(result['finished'] < result['pushed'] or result['duplicates'] or result['out_of_order']
+                 or result['split_chats'] for result in results)
+    if largest > 1:
+        result = run(largest, args, telegram, llm_base_url, reset=True)
+        describe(f"Процессов {largest}, /reset посреди нагрузки", result)
+        failed = failed or result['finished'] < result['pushed'] or result['duplicates'] or result['out_of_order'] \
+            or result['restarts'] != 1
+    llm_process.terminate()
+    sys.exit(1 if failed else 0)
+
+if __name__ == '__main__':
+    main()
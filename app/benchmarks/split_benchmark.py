@@ -0,0 +1,98 @@
+"""
+Бенчмарк разбиения длинного ответа на сообщения: сравнивает split_html_message
+с прежним разбиением по абзацам (конкатенация строк и обрезка part[:4000]).
+Свойства нового разбиения на случайных текстах проверяет tests/test_split_message.py.
+
+Запуск: python benchmarks/split_benchmark.py [--repeat N] [--scale K]
+"""
+import argparse
+import html
+import re
+import time
+
+from _bot import load_answers, load_bot_module
+
+_TAG_RE = re.compile(r'<(/?)([a-zA-Z][a-zA-Z0-9-]*)[^<>]*>')
+
+def legacy_build_reply_parts(formatted_response, limit=4000):
+    """Прежнее разбиение из text_handler (эталон для сравнения)"""
+    if len(formatted_response) <= limit:
+        return [formatted_response]
+
+    parts = []
+    current_part = ""
+
+    for paragraph in formatted_response.split('\n\n'):
+        if len(current_part) + len(paragraph) + 2 < limit:
+            current_part += paragraph + '\n\n'
+        else:
+            parts.append(current_part)
+            current_part = paragraph + '\n\n'
+
+    if current_part:
+        parts.append(current_part)
+
+    messages = [parts[0][:limit]]
+    for i, part in enumerate(parts[1:], 1):
+        messages.append(f"<b>Часть {i+1}</b>\n\n{part[:limit]}")
+    return messages
+
+def is_balanced(text):
+    """Каждый закрывающий тег закрывает последний открытый, и в конце стек пуст"""
+    stack = []
+    for match in _TAG_RE.finditer(text):
+        if match.group(1):
+            if not stack or stack.pop() != match.group(2):
+                return False
+        else:
+            stack.append(match.group(2))
+    return not stack
+
+def visible_text(text):
+    return html.unescape(_TAG_RE.sub('', text))
+
+def measure(function, answers, repeat):
+    """Возвращает лучшее время (в секундах) разбиения всех ответов"""
+    best = float('inf')
+    for _ in range(repeat):
+        started = time.perf_counter()
+        for answer in answers:
+            function(answer)
+        best = min(best, time.perf_counter() - started)
+    return best
+
+def main():
+    parser = argparse.ArgumentParser(description='Бенчмарк разбиения ответа на сообщения')
+    parser.add_argument('--repeat', type=int, default=10, help='число повторов замера')
+    parser.add_argument('--scale', type=int, default=100, help='во сколько раз удлинить каждый ответ')
+    args = parser.parse_args()
+
+    bot_module = load_bot_module()
+    answers = [bot_module.format_ai_response('\n\n'.join([answer] * args.scale)) for answer in load_answers()]
+    # Те же ответы одним абзацем: прежняя версия обрезает такой абзац посреди тега
+    answers += [answer.replace('\n\n', '\n') for answer in answers]
+
+    def broken_and_lost(build):
+        broken = lost = 0
+        for answer in answers:
+            parts = build(answer)
+            broken += sum(1 for part in parts if not is_balanced(part))
+            kept = len(re.sub(r'\s+|Часть \d+', '', ''.join(visible_text(part) for part in parts)))
+            lost += len(re.sub(r'\s+', '', visible_text(answer))) - kept
+        return broken, lost
+
+    broken_legacy, lost_legacy = broken_and_lost(legacy_build_reply_parts)
+    broken_new, lost_new = broken_and_lost(bot_module.build_reply_parts)
+
+    total_chars = sum(len(answer) for answer in answers)
+    legacy_time = measure(legacy_build_reply_parts, answers, args.repeat)
+    new_time = measure(bot_module.build_reply_parts, answers, args.repeat)
+
+    print(f"Ответов: {len(answers)}, символов: {total_chars}")
+    print(f"Сообщений с незакрытыми тегами: прежняя версия {broken_legacy}, новая {broken_new}")
+    print(f"Потеряно символов текста: прежняя версия {lost_legacy}, новая {lost_new}")
+    print(f"Прежняя версия: {legacy_time * 1000:.2f} мс ({legacy_time / len(answers) * 1000:.3f} мс/ответ)")
+    print(f"Новая версия:   {new_time * 1000:.2f} мс ({new_time / len(answers) * 1000:.3f} мс/ответ)")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,124 @@
+"""
+Воспроизведение записанных обновлений Telegram через webhook.
+
+Отправляет POST-запросы с обновлениями из corpus/updates.jsonl на адрес webhook
+и измеряет время подтверждения. С --local поднимает встроенный WebhookServer бота
+на фейковых серверах Telegram и модели и ждет, пока все обновления будут обработаны.
+
+Запуск:
+    python benchmarks/webhook_replay.py --local --repeat 20
+    python benchmarks/webhook_replay.py --url http://127.0.0.1:8443/webhook --secret ...
+"""
+import argparse
+import json
+import os
+import statistics
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import httpx
+
+from _bot import CORPUS_DIR
+from fake_llm import start_in_process
+from fake_telegram import FakeTelegramServer
+
+def load_updates(path, repeat):
+    """Читает записанные обновления; каждый повтор получает свои update_id и ID пользователей"""
+    with open(path, encoding='utf-8') as recorded:
+        updates = [json.loads(line) for line in recorded if line.strip()]
+
+    result = []
+    for round_number in range(repeat):
+        for update in updates:
+            update = json.loads(json.dumps(update))
+            update['update_id'] = 1 + len(result)
+            message = update['message']
+            message['chat']['id'] += round_number * 100000
+            message['from']['id'] += round_number * 100000
+            result.append(update)
+    return result
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+def replay(url, secret, updates, concurrency):
+    """Отправляет обновления параллельно, возвращает (коды ответов, задержки подтверждения)"""
+    headers = {'X-Telegram-Bot-Api-Secret-Token': secret} if secret else {}
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+
+    with httpx.Client(limits=limits, timeout=10) as client:
+        def post(update):
+            started = time.perf_counter()
+            response = client.post(url, json=update, headers=headers)
+            return response.status_code, time.perf_counter() - started
+
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            results = list(executor.map(post, updates))
+
+    return [status for status, _ in results], [latency for _, latency in results]
+
+def start_local_bot():
+    """Поднимает фейковые Telegram и модель и встроенный webhook-сервер бота на свободном порту"""
+    llm_process, llm_base_url = start_in_process(latency=0.2, token_delay=0.001)
+    telegram = FakeTelegramServer().start()
+    os.environ.update(LLM_BASE_URL=llm_base_url, ANALYSIS_CACHE_PATH=':memory:',
+                      LOG_PATH=os.path.join(tempfile.mkdtemp(prefix='bench-'), 'bot.log.jsonl'))
+    os.environ.setdefault('TELEGRAM_RATE_LIMIT', '0')
+
+    from _bot import load_bot_module
+    bot_module = load_bot_module()
+    bot_module.init_bot()
+    import telebot.apihelper
+    telebot.apihelper.API_URL = telegram.api_url
+
+    server = load_bot_module('bot_webhook').WebhookServer(bot_module.bot, host='127.0.0.1', port=0, secret='local-secret')
+    threading.Thread(target=server.serve, daemon=True).start()
+    return bot_module, server, llm_process
+
+def main():
+    parser = argparse.ArgumentParser(description='Воспроизведение записанных обновлений через webhook')
+    parser.add_argument('--url', default='http://127.0.0.1:8443/webhook', help='адрес webhook')
+    parser.add_argument('--secret', default=os.getenv('WEBHOOK_SECRET', ''), help='секрет webhook')
+    parser.add_argument('--file', default=os.path.join(CORPUS_DIR, 'updates.jsonl'), help='файл с обновлениями (JSON lines)')
+    parser.add_argument('--repeat', type=int, default=1, help='сколько раз повторить запись')
+    parser.add_argument('--concurrency', type=int, default=8, help='число параллельных запросов')
+    parser.add_argument('--local', action='store_true', help='поднять бота на фейковых серверах')
+    args = parser.parse_args()
+
+    updates = load_updates(args.file, args.repeat)
+    url, secret = args.url, args.secret
+    if args.local:
+        bot_module, server, llm_process = start_local_bot()
+        url = f"http://127.0.0.1:{server.port}{server.webhook_path}"
+        secret = server.secret
+
+        # Запрос с неверным секретом должен быть отклонен
+        statuses, _ = replay(url, 'wrong-secret', updates[:1], 1)
+        print(f"Неверный секрет: HTTP {statuses[0]}")
+
+    started = time.perf_counter()
+    statuses, latencies = replay(url, secret, updates, args.concurrency)
+    elapsed = time.perf_counter() - started
+
+    codes = {status: statuses.count(status) for status in sorted(set(statuses))}
+    print(f"Обновлений: {len(updates)}, ответы: {codes}")
+    print(f"Подтверждение: {len(updates) / elapsed:.0f} запр/с, p50 {statistics.median(latencies) * 1000:.1f} мс, "
+          f"p99 {percentile(latencies, 0.99) * 1000:.1f} мс")
+
+    if args.local:
+        # Ждем, пока диспетчер обработает все принятые обновления
+        accepted = codes.get(200, 0)
+        deadline = time.time() + 120
+        while bot_module.bot.dispatcher.get_stats()['processed'] < accepted and time.time() < deadline:
+            time.sleep(0.05)
+        processed = bot_module.bot.dispatcher.get_stats()['processed']
+        print(f"Обработано: {processed} из {accepted} за {time.perf_counter() - started:.2f} с")
+        print(f"Статистика webhook: {server.get_stats()}")
+        server.shutdown()
+        llm_process.terminate()
+
+if __name__ == '__main__':
+    main()
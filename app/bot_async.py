@@ -0,0 +1,595 @@
+"""
+Асинхронный режим бота: AsyncTeleBot и AsyncOpenAI в одном цикле событий
+(запуск с --async или BOT_RUNTIME=async). Кэш, допуск к модели, форматирование
+и административные команды общие с потоковой версией (pushkin_bot).
+"""
+import os
+import time
+import asyncio
+import functools
+import html
+import httpx
+import openai
+import telebot
+import pushkin_bot
+from pushkin_bot import (
+    ABOUT_TEXT, admin_handler, admission, AdmissionController, AdmissionRejected, analysis_cache,
+    build_reply_parts, cache_handler, cache_purge_handler, cache_seed_handler, cache_show_handler,
+    _cached_answer, _cached_file_id, create_llm_backends, _file_id_rejected, _forget_file_id,
+    format_ai_response, _InFlightCall, literature_classifier, LITERATURE_FILTER, LLMBackendPool, LLMGateway,
+    logger, metrics, OFF_TOPIC_TEXT, _photo_retry_delay, queue_position_text, _remember_file_id, reset_handler,
+    resolve_prompt, SingleFlight, status_handler, _store_answer, _stream_line_content, StreamingReply,
+    TECHNICAL_TASK, telegram_limiter, TELEGRAM_RATE_LIMIT, TELEGRAM_TOKEN, TYPING_INTERVAL, WELCOME_IMAGE_PATH,
+    WELCOME_TEXT,
+)
+from bot_supervisor import supervisor
+
+async_bot = None
+async_llm_gateway = None
+async_llm_pool = None
+async_loop = None
+
+class AsyncLLMGateway(LLMGateway):
+    """Асинхронный вариант LLMGateway: тот же пул соединений, повторы и счетчики"""
+    
+    def _create_clients(self, base_url, api_key, limits, timeout):
+        http_client = httpx.AsyncClient(
+            limits=limits,
+            timeout=timeout,
+            event_hooks={'request': [self._on_request_async], 'response': [self._on_response_async]},
+        )
+        client = openai.AsyncOpenAI(base_url=base_url, api_key=api_key, http_client=http_client, max_retries=0)
+        return http_client, client
+    
+    async def _on_request_async(self, request):
+        request.extensions['new_connection'] = False
+        
+        async def trace(event_name, info):
+            if event_name == 'connection.connect_tcp.started':
+                request.extensions['new_connection'] = True
+        
+        request.extensions['trace'] = trace
+    
+    async def _on_response_async(self, response):
+        self._on_response(response)
+    
+    async def complete(self, **params):
+        """Выполняет chat.completions.create с повторными попытками"""
+        with self._lock:
+            self.stats['requests'] += 1
+        
+        for attempt in range(self.max_retries + 1):
+            try:
+                completion = await self.client.chat.completions.create(**params)
+            except self.RETRYABLE_ERRORS as e:
+                await asyncio.sleep(self._retry_delay(attempt, e))
+                continue
+            except Exception:
+                with self._lock:
+                    self.stats['errors'] += 1
+                raise
+            if completion.usage is not None:
+                self._record_usage(completion.usage.prompt_tokens, completion.usage.completion_tokens)
+            return completion
+    
+    async def stream(self, **params):
+        """Асинхронный генератор фрагментов ответа; повторяет запрос до первого фрагмента"""
+        with self._lock:
+            self.stats['requests'] += 1
+        
+        self._stream_params(params)
+        for attempt in range(self.max_retries + 1):
+            received = False
+            usage = {}
+            try:
+                async with self.client.chat.completions.with_streaming_response.create(stream=True, **params) as response:
+                    async for line in response.iter_lines():
+                        content = _stream_line_content(line, response, usage)
+                        if content:
+                            received = True
+                            yield content
+                if usage:
+                    self._record_usage(usage.get('prompt_tokens'), usage.get('completion_tokens'))
+                return
+            except self.RETRYABLE_ERRORS as e:
+                if received:
+                    with self._lock:
+                        self.stats['errors'] += 1
+                    raise
+                await asyncio.sleep(self._retry_delay(attempt, e))
+            except Exception:
+                with self._lock:
+                    self.stats['errors'] += 1
+                raise
+
+class AsyncLLMBackendPool(LLMBackendPool):
+    """LLMBackendPool для корутин: попытки - задачи asyncio, проигравшая отменяется сразу"""
+    
+    def _start(self, candidates, params, kind, results, hedge=False):
+        attempt = self._new_attempt(candidates, hedge)
+        attempt.task = asyncio.ensure_future(self._attempt(attempt, params, kind, results))
+        return attempt
+    
+    async def _attempt(self, attempt, params, kind, results):
+        backend = attempt.backend
+        params = dict(params, model=backend.model)
+        try:
+            if kind == 'complete':
+                completion = await backend.gateway.complete(**params)
+                backend.record_success(kind, time.perf_counter() - attempt.started)
+                results.put_nowait(('done', attempt, completion.choices[0].message.content))
+                return
+            stream = backend.gateway.stream(**params)
+            try:
+                async for fragment in stream:
+                    if not attempt.answered:
+                        attempt.answered = True
+                        backend.record_success(kind, time.perf_counter() - attempt.started)
+                    results.put_nowait(('delta', attempt, fragment))
+            finally:
+                await stream.aclose()
+            results.put_nowait(('done', attempt, None))
+        except Exception as e:
+            backend.record_failure()
+            results.put_nowait(('error', attempt, e))
+    
+    async def run(self, params, on_delta=None):
+        """Возвращает текст ответа; on_delta - корутина, получающая фрагменты ответа победившей модели"""
+        kind = 'complete' if on_delta is None else 'first_token'
+        with self._lock:
+            self.stats['runs'] += 1
+        candidates = self.ranked(kind)
+        results = asyncio.Queue()
+        attempts = [self._start(candidates, params, kind, results)]
+        hedge_at = None
+        if self.hedge:
+            delay = attempts[0].backend.hedge_delay(kind)
+            hedge_at = attempts[0].started + delay if delay is not None else None
+        pending = set(attempts)
+        winner = None
+        fragments = []
+        
+        try:
+            while True:
+                timeout = max(0.0, hedge_at - time.perf_counter()) if hedge_at is not None and winner is None else None
+                try:
+                    event, attempt, payload = await asyncio.wait_for(results.get(), timeout)
+                except asyncio.TimeoutError:
+                    hedge_at = None
+                    if self._hedge_allowed(candidates):
+                        attempts.append(self._start(candidates, params, kind, results, hedge=True))
+                        pending.add(attempts[-1])
+                    continue
+                
+                if winner is not None and attempt is not winner:
+                    continue
+                if event == 'error':
+                    if attempt is winner:
+                        raise payload
+                    pending.discard(attempt)
+                    if self._failover(attempt, payload, candidates, pending):
+                        attempts.append(self._start(candidates, params, kind, results))
+                        pending.add(attempts[-1])
+                    elif not pending:
+                        raise payload
+                    continue
+                if winner is None:
+                    winner = attempt
+                    self._cancel_others(winner, pending, kind)
+                    if kind == 'first_token':
+                        metrics.observe('llm_first_token', time.perf_counter() - attempts[0].started)
+                if event == 'delta':
+                    fragments.append(payload)
+                    await on_delta(payload)
+                else:
+                    return payload if kind == 'complete' else ''.join(fragments)
+        finally:
+            for attempt in attempts:
+                attempt.cancelled.set()
+                if not attempt.task.done():
+                    attempt.task.cancel()
+
+async def get_answer_async(content, on_delta=None):
+    """Асинхронный get_answer; on_delta - корутина, получающая фрагменты потокового ответа"""
+    # Модель подставляет LLMBackendPool
+    params = dict(
+        messages=[{"role": "user", "content": f'{content} ({TECHNICAL_TASK})'}],
+        max_tokens=3500,
+        temperature=0.7,
+    )
+    
+    with metrics.time('llm'):
+        return await async_llm_pool.run(params, on_delta)
+
+class AsyncSingleFlight(SingleFlight):
+    """SingleFlight для корутин одного событийного цикла"""
+    
+    async def do(self, key, function, on_delta=None, on_progress=None):
+        call = self._calls.get(key)
+        if call is None:
+            call = self._calls[key] = _InFlightCall(asyncio.Condition())
+            self.stats['leaders'] += 1
+            return await self._lead(key, call, function, on_delta)
+        
+        call.followers += 1
+        self.stats['coalesced'] += 1
+        logger.debug(f"Запрос присоединен к уже выполняющейся генерации: {key}")
+        return await self._follow(call, on_delta, on_progress)
+    
+    def reporter(self, key, callback=None):
+        """Асинхронный reporter: callback - корутина"""
+        async def report(value):
+            call = self._calls.get(key)
+            if call is not None:
+                async with call.condition:
+                    call.progress = value
+                    call.condition.notify_all()
+            if callback:
+                await callback(value)
+        return report
+    
+    async def _lead(self, key, call, function, on_delta):
+        own_errors = []
+        
+        async def publish(fragment):
+            async with call.condition:
+                call.fragments.append(fragment)
+                call.condition.notify_all()
+            if not own_errors:
+                try:
+                    await on_delta(fragment)
+                except Exception as e:
+                    own_errors.append(e)
+        
+        try:
+            call.result = await function(publish if on_delta else None)
+        except Exception as e:
+            call.error = e
+            raise
+        except BaseException as e:
+            # Отмена задачи инициатора (CancelledError - не Exception) не отменяет присоединившихся:
+            # без ошибки они получили бы None вместо ответа
+            call.error = RuntimeError(f"генерация прервана: {type(e).__name__}")
+            raise
+        finally:
+            del self._calls[key]
+            call.finished = True
+            if call.error is not None:
+                self.stats['failed_calls'] += 1
+                self.stats['failed_followers'] += call.followers
+            async with call.condition:
+                call.condition.notify_all()
+        
+        if own_errors:
+            raise own_errors[0]
+        return call.result
+    
+    async def _follow(self, call, on_delta, on_progress=None):
+        delivered = 0
+        shown = None
+        while True:
+            async with call.condition:
+                while delivered == len(call.fragments) and not call.finished and call.progress == shown:
+                    await call.condition.wait()
+                fragments = call.fragments[delivered:]
+                finished = call.finished
+                progress = call.progress
+            delivered += len(fragments)
+            if progress != shown:
+                shown = progress
+                if on_progress:
+                    await on_progress(progress)
+            if on_delta:
+                for fragment in fragments:
+                    await on_delta(fragment)
+            if finished:
+                break
+        
+        if call.error is not None:
+            raise call.error
+        return call.result
+    
+    def get_stats(self):
+        stats = dict(self.stats)
+        stats['in_flight'] = len(self._calls)
+        return stats
+
+async_answer_flights = AsyncSingleFlight()
+
+async def _generate_and_store_async(content, key, on_delta=None, slot=None):
+    if slot is not None:
+        async with slot:
+            return await _generate_and_store_async(content, key, on_delta)
+    response = await get_answer_async(content, on_delta=on_delta)
+    formatted = format_ai_response(response) if on_delta is None else None
+    _store_answer(content, key, response, formatted)
+    return response, formatted
+
+async def get_cached_answer_async(content, on_delta=None, slot=None):
+    """Асинхронный get_cached_answer"""
+    key, content = resolve_prompt(content)
+    with metrics.time('cache'):
+        cached = analysis_cache.get(key)
+    if cached is not None:
+        return _cached_answer(key, cached)
+    
+    show_position = slot.on_position if slot is not None else None
+    on_position = show_position and (lambda position: AdmissionController._notify_async(show_position, position))
+    if slot is not None:
+        slot.on_position = async_answer_flights.reporter(key, show_position)
+    while True:
+        try:
+            return await async_answer_flights.do(
+                key, lambda on_fragment: _generate_and_store_async(content, key, on_fragment, slot), on_delta, on_position
+            )
+        except AdmissionRejected:
+            if slot is None or slot.ticket is not None:
+                raise
+            logger.debug(f"Инициатору генерации отказано в допуске, запрос повторяется: {key}")
+
+class AsyncStreamingReply(StreamingReply):
+    """StreamingReply, отправляющий правки через AsyncTeleBot"""
+    
+    async def feed(self, fragment):
+        self._consume(fragment)
+        for index, text in self._due_updates():
+            await self._deliver(index, text)
+    
+    async def finish(self):
+        self._close()
+        for index, text in self._due_updates(force=True):
+            await self._deliver(index, text)
+    
+    async def _deliver(self, index, text):
+        message_id = self._message_ids[index]
+        try:
+            with metrics.time('send_message' if message_id is None else 'edit_message'):
+                if message_id is None:
+                    message_id = (await async_bot.send_message(self.chat_id, text, parse_mode='HTML')).message_id
+                else:
+                    await async_bot.edit_message_text(text, self.chat_id, message_id, parse_mode='HTML')
+        except telebot.asyncio_helper.ApiTelegramException as e:
+            if 'message is not modified' not in str(e):
+                raise
+        self._delivered(index, message_id, text)
+
+async def _typing_loop(chat_id):
+    """Показывает индикатор печати, пока задача не отменена"""
+    while True:
+        try:
+            await async_bot.send_chat_action(chat_id, 'typing')
+        except Exception as e:
+            logger.warning(f"Не удалось отправить индикатор печати в чат {chat_id}: {e}")
+            return
+        await asyncio.sleep(TYPING_INTERVAL)
+
+@metrics.timed('send_photo')
+async def async_send_cached_photo(chat_id, image_path, timeout=30):
+    """Асинхронный send_cached_photo"""
+    digest, file_id = _cached_file_id(image_path)
+    
+    if file_id:
+        try:
+            return await async_bot.send_photo(chat_id, file_id, timeout=timeout)
+        except telebot.asyncio_helper.ApiTelegramException as e:
+            if not _file_id_rejected(e):
+                raise
+            _forget_file_id(image_path, digest, file_id, e)
+    
+    with open(image_path, 'rb') as photo:
+        sent_msg = await async_bot.send_photo(chat_id, photo, timeout=timeout)
+    _remember_file_id(image_path, digest, sent_msg)
+    return sent_msg
+
+@metrics.timed('welcome')
+async def async_send_welcome_with_image(chat_id, max_retries=3):
+    """Асинхронный send_welcome_with_image: паузы между попытками не блокируют другие чаты"""
+    try:
+        await async_bot.send_message(chat_id, WELCOME_TEXT, parse_mode='HTML')
+        logger.info(f"Текстовое приветствие отправлено в чат {chat_id}")
+    except Exception as e:
+        logger.error(f"Ошибка при отправке текста: {e}")
+    
+    if not os.path.exists(WELCOME_IMAGE_PATH):
+        logger.warning(f"Файл {WELCOME_IMAGE_PATH} не найден.")
+        return
+    
+    for attempt in range(max_retries):
+        try:
+            await async_send_cached_photo(chat_id, WELCOME_IMAGE_PATH, timeout=30)
+            logger.info(f"Изображение успешно отправлено в чат {chat_id}")
+            return
+        except Exception as e:
+            logger.error(f"Ошибка при отправке изображения (попытка {attempt + 1}): {type(e).__name__}: {e}")
+            wait_time = _photo_retry_delay(e, attempt)
+            if wait_time is None:
+                return
+            if attempt < max_retries - 1:
+                await asyncio.sleep(wait_time)
+    logger.error(f"Не удалось отправить изображение после {max_retries} попыток")
+
+async def async_start_handler(message):
+    """Асинхронный обработчик /start и /help"""
+    logger.info(f"Получена команда /start от пользователя {message.from_user.id}")
+    await async_send_welcome_with_image(message.chat.id)
+
+async def async_image_handler(message):
+    """Асинхронный обработчик /image"""
+    try:
+        if os.path.exists(WELCOME_IMAGE_PATH):
+            await async_send_cached_photo(message.chat.id, WELCOME_IMAGE_PATH, timeout=30)
+        else:
+            await async_bot.send_message(message.chat.id, "Изображение не найдено на сервере.")
+    except Exception as e:
+        logger.error(f"Ошибка при отправке изображения: {e}")
+        await async_bot.send_message(message.chat.id, "Ошибка при отправке изображения.")
+
+async def async_about_handler(message):
+    """Асинхронный обработчик /about"""
+    await async_bot.send_message(message.chat.id, ABOUT_TEXT, parse_mode='HTML')
+
+def _async_request_scope(handler):
+    """Обработчик AsyncTeleBot в области журнала; ID запроса - "чат:сообщение" (update_id сюда не доходит)"""
+    @functools.wraps(handler)
+    async def run(message):
+        with logger.request(f"{message.chat.id}:{message.message_id}", chat_id=message.chat.id):
+            return await handler(message)
+    return run
+
+def _sync_handler(handler):
+    """Выполняет редкие административные обработчики в отдельном потоке"""
+    async def run(message):
+        await asyncio.to_thread(handler, message)
+    run.__name__ = f"async_{handler.__name__}"
+    return run
+
+@metrics.timed('request')
+async def async_text_handler(message):
+    """Асинхронный обработчик текстовых сообщений"""
+    user_id = message.from_user.id
+    chat_id = message.chat.id
+    prompt = str(message.text)
+    
+    logger.info(f"Получен запрос от пользователя {user_id}: {prompt[:50]}...", user_id=user_id)
+    
+    if len(prompt) < 5:
+        await async_bot.send_message(
+            chat_id,
+            "Пожалуйста, укажите полное название произведения и автора для анализа.\n\n" +
+            "<i>Пример:</i> 'Война и мир, Лев Толстой'",
+            parse_mode='HTML'
+        )
+        return
+    
+    if LITERATURE_FILTER and not literature_classifier.is_literature(prompt):
+        await async_bot.send_message(chat_id, OFF_TOPIC_TEXT, parse_mode='HTML')
+        logger.info(f"Запрос пользователя {user_id} не похож на литературный, модель не вызывается")
+        return
+    
+    try:
+        admission.check(user_id)
+    except AdmissionRejected as e:
+        await async_bot.send_message(chat_id, f"⏳ {e}")
+        logger.info(f"Запрос пользователя {user_id} отклонен: {e}")
+        return
+    
+    status_msg = await async_bot.send_message(chat_id, queue_position_text(0), parse_mode='HTML')
+    typing_task = asyncio.create_task(_typing_loop(chat_id))
+    streaming_reply = AsyncStreamingReply(chat_id, status_msg.message_id) if pushkin_bot.STREAM_RESPONSES else None
+    
+    async def show_queue_position(position):
+        await async_bot.edit_message_text(queue_position_text(position), chat_id, status_msg.message_id, parse_mode='HTML')
+    
+    try:
+        response, formatted = await get_cached_answer_async(
+            prompt,
+            on_delta=streaming_reply.feed if streaming_reply else None,
+            slot=admission.slot(user_id, on_position=show_queue_position)
+        )
+        typing_task.cancel()
+        
+        if streaming_reply and streaming_reply.started:
+            await streaming_reply.finish()
+            logger.info(f'Ответ выдан потоково пользователю {user_id}, длина: {len(response)} символов, сообщений: {len(streaming_reply.message_ids)}')
+            return
+        
+        try:
+            await async_bot.delete_message(chat_id, status_msg.message_id)
+        except Exception:
+            pass
+        
+        for part in build_reply_parts(formatted or format_ai_response(response)):
+            with metrics.time('send_message'):
+                await async_bot.send_message(chat_id, part, parse_mode='HTML')
+        logger.info(f'Ответ успешно отправлен пользователю {user_id}, длина: {len(response)} символов')
+    
+    except AdmissionRejected as e:
+        typing_task.cancel()
+        try:
+            await async_bot.edit_message_text(f"⏳ {html.escape(str(e))}", chat_id, status_msg.message_id, parse_mode='HTML')
+        except Exception:
+            pass
+        logger.info(f"Запрос пользователя {user_id} отклонен: {e}")
+    
+    except Exception as e:
+        typing_task.cancel()
+        if not (streaming_reply and streaming_reply.started):
+            try:
+                await async_bot.delete_message(chat_id, status_msg.message_id)
+            except Exception:
+                pass
+        
+        logger.error(f"Ошибка при обработке запроса: {e}")
+        try:
+            await async_bot.send_message(
+                chat_id,
+                f"Произошла ошибка при анализе произведения:\n\n<code>{html.escape(str(e)[:200])}</code>",
+                parse_mode='HTML'
+            )
+        except Exception:
+            pass
+
+def create_async_bot():
+    """Создает AsyncTeleBot и регистрирует асинхронные обработчики"""
+    global async_bot, async_llm_gateway, async_llm_pool
+    # aiohttp нужен только асинхронному режиму, поэтому импорт здесь
+    from telebot.async_telebot import AsyncTeleBot
+    
+    async_bot = AsyncTeleBot(TELEGRAM_TOKEN)
+    if TELEGRAM_RATE_LIMIT and not getattr(telebot.asyncio_helper._process_request, 'rate_limited', False):
+        telebot.asyncio_helper._process_request = telegram_limiter.wrap_async(telebot.asyncio_helper._process_request)
+    async_llm_pool = AsyncLLMBackendPool(create_llm_backends(AsyncLLMGateway))
+    async_llm_gateway = async_llm_pool.primary.gateway
+    
+    def register(handler, **filters):
+        async_bot.register_message_handler(_async_request_scope(handler), **filters)
+    
+    register(async_start_handler, commands=["start", "help"])
+    register(_sync_handler(reset_handler), commands=["reset"])
+    register(async_image_handler, commands=["image"])
+    register(async_about_handler, commands=["about"])
+    register(_sync_handler(admin_handler), commands=["admin"])
+    register(_sync_handler(status_handler), commands=["status"])
+    register(_sync_handler(cache_handler), commands=["cache"])
+    register(_sync_handler(cache_show_handler), commands=["cache_show"])
+    register(_sync_handler(cache_purge_handler), commands=["cache_purge"])
+    register(_sync_handler(cache_seed_handler), commands=["cache_seed"])
+    register(async_text_handler, func=lambda message: True)
+    return async_bot
+
+async def _drain_async_tasks(timeout):
+    """Дожидается запущенных обработчиков, чтобы asyncio.run не отменил их при выходе"""
+    tasks = [task for task in asyncio.all_tasks() if task is not asyncio.current_task()]
+    if tasks:
+        await asyncio.wait(tasks, timeout=timeout)
+
+def stop_async_polling():
+    """Останавливает прием обновлений асинхронного бота из другого потока"""
+    # У AsyncTeleBot нет stop_polling: цикл polling проверяет флаг _polling после каждого getUpdates
+    async_loop.call_soon_threadsafe(setattr, async_bot, '_polling', False)
+
+def async_last_update_id():
+    """ID последнего обновления, полученного асинхронным ботом"""
+    return async_bot.offset - 1 if async_bot is not None and async_bot.offset else 0
+
+async def run_async_bot():
+    """Точка входа асинхронного режима"""
+    global async_loop
+    create_async_bot()
+    async_loop = asyncio.get_running_loop()
+    if supervisor.resume_update_id:
+        async_bot.offset = supervisor.resume_update_id + 1
+    try:
+        while True:
+            await async_bot.polling(non_stop=True, interval=1, timeout=30)
+            if not supervisor.handing_off:
+                break
+            if supervisor.hand_over(async_last_update_id()):
+                await _drain_async_tasks(supervisor.drain_timeout)
+                break
+            # Новый процесс не принял работу - продолжаем прием в этом же цикле событий
+            logger.info("Прием обновлений возобновлен в прежнем процессе")
+    finally:
+        await async_bot.close_session()
+        for backend in async_llm_pool.backends:
+            await backend.gateway.http_client.aclose()
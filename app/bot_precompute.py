@@ -0,0 +1,204 @@
+"""
+Пакетная подготовка анализов к пиковым периодам (начало четверти, списки литературы):
+python "model2 — копия.py" --precompute works.csv [--workers N]
+"""
+import os
+import time
+import csv
+import json
+import threading
+import argparse
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from pushkin_bot import (
+    analysis_cache, format_ai_response, get_answer, is_model_refusal, llm_pool, logger, resolve_prompt,
+)
+
+PRECOMPUTE_WORKERS = int(os.getenv('PRECOMPUTE_WORKERS', '4'))
+PRECOMPUTE_PROGRESS_INTERVAL = float(os.getenv('PRECOMPUTE_PROGRESS_INTERVAL', '5'))
+
+def _work_list_prompt(item):
+    """Текст запроса из записи списка: prompt или "название, автор" """
+    if isinstance(item, str):
+        return item
+    return item.get('prompt') or ', '.join(
+        value.strip() for value in (item.get('title'), item.get('author')) if value and value.strip()
+    )
+
+def load_work_list(path):
+    """
+    Читает список произведений: JSON lines ({"title", "author"} или {"prompt"}),
+    CSV с заголовком title/author или prompt, либо CSV без заголовка (название, автор)
+    """
+    with open(path, encoding='utf-8-sig', newline='') as source:
+        if path.endswith(('.jsonl', '.json')):
+            items = [json.loads(line) for line in source if line.strip()]
+        else:
+            rows = [row for row in csv.reader(source) if any(cell.strip() for cell in row)]
+            header = [cell.strip().lower() for cell in rows[0]] if rows else []
+            if 'prompt' in header or 'title' in header:
+                items = [dict(zip(header, row)) for row in rows[1:]]
+            else:
+                items = [', '.join(cell.strip() for cell in row if cell.strip()) for row in rows]
+    return [prompt.strip() for prompt in map(_work_list_prompt, items) if prompt and prompt.strip()]
+
+class PrecomputeCheckpoint:
+    """Журнал пакетной подготовки (JSON lines): что и когда подготовлено, с ошибками"""
+    
+    def __init__(self, path):
+        self.path = path
+        self.done = set()
+        self._lock = threading.Lock()
+        if os.path.exists(path):
+            with open(path, encoding='utf-8') as journal:
+                for line in journal:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        # Строка, недописанная при аварийной остановке
+                        continue
+                    if record.get('status') == 'done':
+                        self.done.add(record['key'])
+        self._file = open(path, 'a', encoding='utf-8')
+    
+    def record(self, key, status, **details):
+        with self._lock:
+            self._file.write(json.dumps({'key': key, 'status': status, 'time': time.time(), **details},
+                                        ensure_ascii=False) + '\n')
+            self._file.flush()
+            if status == 'done':
+                self.done.add(key)
+    
+    def close(self):
+        self._file.close()
+
+def precompute_analysis(key, content, pinned=True):
+    """Генерирует анализ, готовит HTML для Telegram и сохраняет оба в кэш"""
+    response = get_answer(content)
+    if is_model_refusal(response):
+        raise RuntimeError("модель отказалась: запрос не распознан как литературное произведение")
+    formatted = format_ai_response(response)
+    analysis_cache.put(content, response, key=key, formatted=formatted, pinned=pinned)
+    return response
+
+def run_precompute(argv):
+    """
+    Пакетный режим: python "model2 — копия.py" --precompute works.csv [--workers N]
+    Для прогона на фейковой модели достаточно LLM_BASE_URL (см. benchmarks/fake_llm.py).
+    Возвращает код завершения: 0 - все готово, 1 - есть ошибки, 2 - список не помещается
+    в лимиты кэша, 130 - прервано.
+    """
+    parser = argparse.ArgumentParser(prog='model2 — копия.py --precompute',
+                                     description='Заранее готовит анализы произведений и сохраняет их в кэш бота')
+    parser.add_argument('--precompute', required=True, metavar='FILE', help='список произведений (CSV или JSON lines)')
+    parser.add_argument('--workers', type=int, default=PRECOMPUTE_WORKERS, help='одновременных запросов к модели')
+    parser.add_argument('--checkpoint', help='журнал для продолжения (по умолчанию FILE.checkpoint.jsonl)')
+    parser.add_argument('--limit', type=int, default=0, help='обработать не больше N произведений')
+    parser.add_argument('--force', action='store_true', help='перегенерировать уже сохраненные анализы')
+    parser.add_argument('--no-pin', action='store_true', help='не закреплять записи (обычные TTL и вытеснение)')
+    args = parser.parse_args(argv)
+    
+    # Одинаковые произведения в списке (с разной записью) готовятся один раз
+    jobs = {}
+    prompts = load_work_list(args.precompute)
+    for prompt in prompts:
+        key, content = resolve_prompt(prompt)
+        jobs.setdefault(key, content)
+    
+    # Готовым считается только то, что есть в кэше: записи из журнала могли быть удалены (/cache, purge)
+    checkpoint = PrecomputeCheckpoint(args.checkpoint or args.precompute + '.checkpoint.jsonl')
+    entries = {key: analysis_cache.get_entry(key) for key in jobs}
+    pending = [
+        (key, content) for key, content in jobs.items()
+        if args.force or entries[key] is None
+    ]
+    if args.limit:
+        pending = pending[:args.limit]
+    lost = sum(1 for key in checkpoint.done if key in jobs and entries[key] is None)
+    logger.info(f"Список: {len(prompts)} строк, произведений: {len(jobs)}, уже готово: {len(jobs) - len(pending)}, "
+                f"к подготовке: {len(pending)}, потоков: {args.workers}"
+                + (f"; из журнала нет в кэше: {lost}" if lost else ''))
+    
+    # Закрепленные записи не вытесняются, а обычные вытесняли бы друг друга: не начинаем то, что не поместится
+    if args.no_pin:
+        capacity, needed = analysis_cache.max_entries, len(pending)
+    else:
+        capacity = analysis_cache.pinned_max_entries
+        needed = analysis_cache.get_stats()['pinned'] + sum(
+            1 for key, _ in pending if entries[key] is None or not entries[key]['pinned'])
+    if needed > capacity:
+        logger.error(f"Список не помещается в кэш: нужно записей {needed}, лимит {capacity} "
+                     f"({'ANALYSIS_CACHE_MAX_ENTRIES' if args.no_pin else 'ANALYSIS_CACHE_PINNED_MAX_ENTRIES'}); "
+                     f"уменьшите список или --limit")
+        checkpoint.close()
+        return 2
+    
+    tokens_before = llm_pool.get_stats()
+    started = last_report = time.time()
+    done = 0
+    failures = []
+    
+    def report(final=False):
+        stats = llm_pool.get_stats()
+        prompt_tokens = stats['prompt_tokens'] - tokens_before['prompt_tokens']
+        completion_tokens = stats['completion_tokens'] - tokens_before['completion_tokens']
+        elapsed = time.time() - started
+        finished = done + len(failures)
+        rate = finished / elapsed if elapsed else 0.0
+        remaining = (len(pending) - finished) / rate if rate else 0.0
+        logger.info(f"{'Итого' if final else 'Подготовка'}: {done} из {len(pending)} готово, ошибок: {len(failures)}, "
+                    f"{rate:.2f} анализа/с, токены: запрос {prompt_tokens}, ответ {completion_tokens}"
+                    + (f", прошло {elapsed:.0f} с" if final else f", осталось ~{remaining:.0f} с"))
+    
+    # Заданий в пуле не больше, чем потоков: прерывание не оставляет длинного хвоста
+    executor = ThreadPoolExecutor(max_workers=args.workers, thread_name_prefix='precompute')
+    in_flight = {}
+    queue_iter = iter(pending)
+    interrupted = False
+    try:
+        while True:
+            while len(in_flight) < args.workers:
+                job = next(queue_iter, None)
+                if job is None:
+                    break
+                in_flight[executor.submit(precompute_analysis, job[0], job[1], not args.no_pin)] = (job, time.time())
+            if not in_flight:
+                break
+            finished, _ = wait(in_flight, timeout=PRECOMPUTE_PROGRESS_INTERVAL, return_when=FIRST_COMPLETED)
+            for future in finished:
+                (key, content), job_started = in_flight.pop(future)
+                try:
+                    response = future.result()
+                except Exception as e:
+                    failures.append((key, e))
+                    checkpoint.record(key, 'failed', prompt=content, error=str(e)[:500])
+                    logger.error(f"Не удалось подготовить анализ {key}: {e}")
+                else:
+                    done += 1
+                    checkpoint.record(key, 'done', prompt=content, chars=len(response),
+                                      seconds=round(time.time() - job_started, 3))
+            if time.time() - last_report >= PRECOMPUTE_PROGRESS_INTERVAL:
+                last_report = time.time()
+                report()
+    except KeyboardInterrupt:
+        interrupted = True
+        logger.warning("Прервано: ожидаю уже начатые генерации, остальные будут подготовлены при следующем запуске")
+        for future, ((key, content), job_started) in in_flight.items():
+            try:
+                response = future.result()
+            except Exception as e:
+                failures.append((key, e))
+                checkpoint.record(key, 'failed', prompt=content, error=str(e)[:500])
+            else:
+                done += 1
+                checkpoint.record(key, 'done', prompt=content, chars=len(response),
+                                  seconds=round(time.time() - job_started, 3))
+    finally:
+        executor.shutdown(wait=True)
+        checkpoint.close()
+    
+    report(final=True)
+    for key, error in failures[:10]:
+        logger.error(f"  {key}: {str(error)[:200]}")
+    if failures or interrupted:
+        logger.info(f"Повторный запуск с тем же списком продолжит работу (журнал {checkpoint.path})")
+    return 130 if interrupted else 1 if failures else 0
@@ -0,0 +1,277 @@
+"""
+Перезапуск без простоя: резервный процесс по /reset и перезапуск приема
+обновлений после падений.
+"""
+import os
+import sys
+import time
+import json
+import html
+import hmac
+import secrets
+import threading
+import socket
+import subprocess
+import bot_webhook
+from pushkin_bot import bot, BOT_SCRIPT, logger, start_metrics_server
+
+RESTART_BACKOFF_INITIAL = float(os.getenv('RESTART_BACKOFF_INITIAL', '1'))
+RESTART_BACKOFF_MAX = float(os.getenv('RESTART_BACKOFF_MAX', '60'))
+# После стольких секунд работы без падений задержка перезапуска снова начинается с минимальной
+RESTART_STABLE_AFTER = float(os.getenv('RESTART_STABLE_AFTER', '300'))
+# Сколько ждать готовности нового процесса при /reset и дообработки начатых запросов старым
+RELOAD_STANDBY_TIMEOUT = float(os.getenv('RELOAD_STANDBY_TIMEOUT', '60'))
+RELOAD_DRAIN_TIMEOUT = float(os.getenv('RELOAD_DRAIN_TIMEOUT', '150'))
+
+class BotSupervisor:
+    """
+    Управляет приемом обновлений. После падения запускает его снова в этом же
+    процессе с экспоненциальной задержкой. Для /reset заранее запускает резервный
+    процесс: пока он загружается, текущий продолжает работать, а прием обновлений
+    переходит к новому процессу только после того, как текущий его остановил.
+    Начатые анализы текущий процесс дорабатывает и только потом завершается.
+    """
+    
+    def __init__(self, backoff_initial=RESTART_BACKOFF_INITIAL, backoff_max=RESTART_BACKOFF_MAX,
+                 stable_after=RESTART_STABLE_AFTER, standby_timeout=RELOAD_STANDBY_TIMEOUT,
+                 drain_timeout=RELOAD_DRAIN_TIMEOUT):
+        self.backoff_initial = backoff_initial
+        self.backoff_max = backoff_max
+        self.stable_after = stable_after
+        self.standby_timeout = standby_timeout
+        self.drain_timeout = drain_timeout
+        self._lock = threading.Lock()
+        self._stop_intake = None
+        self._reloading = False
+        # Соединение с готовым резервным процессом и сообщение администратора для отчета
+        self._handoff = None
+        self._handed_over = False
+        # Экспорт метрик остановлен, чтобы порт занял новый процесс
+        self._metrics_released = False
+        # Экспорт метрик этого процесса (запускается в __main__)
+        self.metrics_server = None
+        # ID последнего обновления, полученного предыдущим процессом (в резервном процессе)
+        self.resume_update_id = 0
+        self.started_at = time.time()
+        self.stats = {'crashes': 0, 'last_backoff': 0.0, 'handoffs': 0, 'failed_handoffs': 0, 'handoff_gap': None}
+    
+    @property
+    def handing_off(self):
+        return self._handoff is not None
+    
+    def run(self, serve, stop_intake, last_update_id=lambda: bot.last_update_id):
+        """
+        Выполняет serve() в текущем потоке, пока прием обновлений не будет передан
+        новому процессу; stop_intake() из другого потока заставляет serve() вернуться.
+        Если новый процесс не принял работу, serve() запускается снова.
+        last_update_id() - последнее полученное обновление, с него продолжит новый процесс.
+        """
+        self._stop_intake = stop_intake
+        failures = 0
+        while True:
+            started = time.monotonic()
+            try:
+                serve()
+            except Exception as e:
+                if not self.handing_off:
+                    if time.monotonic() - started >= self.stable_after:
+                        failures = 0
+                    delay = min(self.backoff_max, self.backoff_initial * 2 ** failures)
+                    failures += 1
+                    with self._lock:
+                        self.stats['crashes'] += 1
+                        self.stats['last_backoff'] = delay
+                    logger.error(f"Прием обновлений остановлен: {type(e).__name__}: {e}")
+                    logger.info(f"Перезапуск в этом же процессе через {delay:.1f} с...")
+                    time.sleep(delay)
+                    continue
+                logger.warning(f"Прием обновлений завершился с ошибкой: {type(e).__name__}: {e}")
+            
+            if not self.handing_off:
+                return
+            if self.hand_over(last_update_id()):
+                self._drain()
+                return
+            # Новый процесс не принял работу - продолжаем сами
+            logger.info("Прием обновлений возобновлен в прежнем процессе")
+    
+    def reload_code(self, notify=None):
+        """Запускает резервный процесс в фоне; False, если перезапуск уже идет или прием не запущен"""
+        with self._lock:
+            if self._reloading or self._stop_intake is None:
+                return False
+            self._reloading = True
+        threading.Thread(target=self._prepare_handoff, args=(notify,), name='reload', daemon=True).start()
+        return True
+    
+    def _notify(self, notify, text):
+        if notify is None:
+            return
+        try:
+            bot.edit_message_text(text, notify[0], notify[1], parse_mode='HTML')
+        except Exception as e:
+            logger.warning(f"Не удалось обновить сообщение о перезапуске: {e}")
+    
+    def _prepare_handoff(self, notify):
+        token = secrets.token_hex(16)
+        listener = socket.create_server(('127.0.0.1', 0))
+        listener.settimeout(0.5)
+        env = dict(os.environ, RELOAD_HANDOFF=f"127.0.0.1:{listener.getsockname()[1]}:{token}")
+        started = time.monotonic()
+        process = None
+        try:
+            process = subprocess.Popen([sys.executable, BOT_SCRIPT] + sys.argv[1:], env=env)
+            logger.info(f"Запущен резервный процесс {process.pid}, текущий продолжает работу")
+            connection = self._await_standby(listener, process, token, started)
+        except Exception as e:
+            if process is not None and process.poll() is None:
+                process.kill()
+            with self._lock:
+                self.stats['failed_handoffs'] += 1
+                self._reloading = False
+            logger.error(f"Перезапуск отменен: {e}")
+            self._notify(notify, f"<b>❌ Перезапуск отменен</b>\n\n<i>Причина:</i> {html.escape(str(e))}\n"
+                                 f"<i>Статус:</i> Бот продолжает работать в прежнем процессе")
+            return
+        finally:
+            listener.close()
+        
+        logger.info(f"Резервный процесс {process.pid} готов за {time.monotonic() - started:.1f} с, останавливаю прием обновлений")
+        self._notify(notify, "<b>🔄 Запущен процесс сброса системы...</b>\n\n"
+                             "<i>Статус:</i> Новый процесс готов, передаю ему прием обновлений...")
+        # Порт экспорта метрик нужен новому процессу; если он не примет работу, экспорт запускается снова
+        if self.metrics_server is not None:
+            self.metrics_server.shutdown()
+            self.metrics_server.server_close()
+            self.metrics_server = None
+            self._metrics_released = True
+        self._handoff = (connection, notify)
+        self._stop_intake()
+    
+    def _await_standby(self, listener, process, token, started):
+        """Ждет, пока резервный процесс загрузится и сообщит о готовности"""
+        deadline = started + self.standby_timeout
+        while True:
+            if process.poll() is not None:
+                raise RuntimeError(f"новый процесс завершился с кодом {process.returncode}")
+            if time.monotonic() > deadline:
+                raise TimeoutError(f"новый процесс не готов за {self.standby_timeout:.0f} с")
+            try:
+                connection, _ = listener.accept()
+            except socket.timeout:
+                continue
+            try:
+                connection.settimeout(max(0.1, deadline - time.monotonic()))
+                message = json.loads(connection.makefile('r', encoding='utf-8').readline() or '{}')
+            except (OSError, ValueError):
+                connection.close()
+                continue
+            if message.get('ready') and hmac.compare_digest(str(message.get('token', '')), token):
+                connection.settimeout(None)
+                return connection
+            connection.close()
+    
+    def hand_over(self, last_update_id):
+        """
+        Сообщает резервному процессу, что прием обновлений остановлен и с какого
+        обновления продолжать. False, если новый процесс не принял работу.
+        """
+        if self._handed_over:
+            return True
+        connection, notify = self._handoff
+        payload = {'last_update_id': last_update_id, 'stopped_at': time.time(), 'notify': notify}
+        try:
+            connection.sendall((json.dumps(payload) + '\n').encode('utf-8'))
+            # Отправка проходит и в уже завершившийся процесс: работа передана только после его ответа
+            connection.settimeout(10)
+            if not connection.makefile('r', encoding='utf-8').readline():
+                raise ConnectionError("соединение закрыто без подтверждения")
+        except OSError as e:
+            logger.error(f"Новый процесс не принял работу: {e}")
+            with self._lock:
+                self.stats['failed_handoffs'] += 1
+                self._handoff = None
+                self._reloading = False
+            if self._metrics_released:
+                self._metrics_released = False
+                self.metrics_server = start_metrics_server()
+            self._notify(notify, "<b>❌ Перезапуск отменен</b>\n\n<i>Причина:</i> новый процесс завершился\n"
+                                 "<i>Статус:</i> Бот продолжает работать в прежнем процессе")
+            return False
+        finally:
+            connection.close()
+        with self._lock:
+            self.stats['handoffs'] += 1
+            self._handed_over = True
+        logger.info(f"Прием обновлений передан новому процессу (последнее обновление {last_update_id})")
+        return True
+    
+    def _drain(self):
+        """Дожидается обработки уже принятых обновлений перед завершением процесса"""
+        deadline = time.monotonic() + self.drain_timeout
+        webhook_server = bot_webhook.webhook_server
+        if webhook_server is not None:
+            while not webhook_server.updates.empty() and time.monotonic() < deadline:
+                time.sleep(0.05)
+        if bot.dispatcher is not None and not bot.dispatcher.wait_idle(max(0.0, deadline - time.monotonic())):
+            logger.warning(f"За {self.drain_timeout:.0f} с не обработано обновлений: {bot.dispatcher.get_stats()['unfinished']}")
+            return False
+        logger.info("Начатые запросы обработаны, процесс завершается")
+        return True
+    
+    def wait_for_handoff(self):
+        """
+        В резервном процессе: сообщает о готовности и ждет, пока текущий процесс
+        остановит прием обновлений. Возвращает False, если процесс запущен не для перезапуска.
+        """
+        handoff = os.environ.pop('RELOAD_HANDOFF', '')
+        if not handoff:
+            return False
+        host, port, token = handoff.rsplit(':', 2)
+        
+        # Соединение с Bot API устанавливается заранее, пока работает текущий процесс
+        try:
+            bot.get_me()
+        except Exception as e:
+            logger.warning(f"Не удалось проверить соединение с Telegram: {e}")
+        
+        connection = socket.create_connection((host, int(port)))
+        connection.sendall((json.dumps({'token': token, 'ready': True}) + '\n').encode('utf-8'))
+        logger.info("Резервный процесс готов, жду остановки приема обновлений в текущем")
+        line = connection.makefile('r', encoding='utf-8').readline()
+        if not line:
+            connection.close()
+            logger.error("Текущий процесс отменил перезапуск")
+            sys.exit(1)
+        connection.sendall(b'{"accepted": true}\n')
+        connection.close()
+        
+        payload = json.loads(line)
+        self.resume_update_id = payload['last_update_id']
+        bot.last_update_id = self.resume_update_id
+        gap = time.time() - payload['stopped_at']
+        with self._lock:
+            self.stats['handoff_gap'] = gap
+        logger.info(f"Прием обновлений принят от предыдущего процесса, пауза {gap * 1000:.0f} мс")
+        if payload.get('notify'):
+            chat_id, message_id = payload['notify']
+            self._notify((chat_id, message_id), f"""
+<b>✅ Сброс системы выполнен успешно!</b>
+
+<i>Выполненные действия:</i>
+• Временные файлы очищены
+• Новый процесс (PID {os.getpid()}) принял обновления
+• Начатые анализы дорабатывает прежний процесс
+
+<i>Пауза в приеме обновлений:</i> {gap * 1000:.0f} мс
+<i>Время выполнения:</i> {time.strftime('%H:%M:%S')}
+            """)
+        return True
+    
+    def get_stats(self):
+        with self._lock:
+            stats = dict(self.stats)
+        stats['uptime'] = time.time() - self.started_at
+        return stats
+
+supervisor = BotSupervisor()
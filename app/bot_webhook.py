@@ -0,0 +1,159 @@
+"""
+Режим webhook: встроенный HTTP-сервер вместо long polling
+(запуск с --webhook или BOT_MODE=webhook).
+"""
+import os
+import json
+import hmac
+import queue
+import secrets
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pushkin_bot import bot, logger, parse_update
+
+# Публичный адрес, который регистрируется в Telegram (без него webhook настраивается вручную, например за прокси)
+WEBHOOK_URL = os.getenv('WEBHOOK_URL', '')
+WEBHOOK_HOST = os.getenv('WEBHOOK_HOST', '0.0.0.0')
+WEBHOOK_PORT = int(os.getenv('WEBHOOK_PORT', '8443'))
+WEBHOOK_PATH = os.getenv('WEBHOOK_PATH', '/webhook')
+WEBHOOK_SECRET = os.getenv('WEBHOOK_SECRET', '')
+WEBHOOK_QUEUE_SIZE = int(os.getenv('WEBHOOK_QUEUE_SIZE', '1000'))
+WEBHOOK_MAX_CONNECTIONS = int(os.getenv('WEBHOOK_MAX_CONNECTIONS', '40'))
+# Обновление Telegram - несколько килобайт; больше не читаем
+WEBHOOK_MAX_BODY = int(os.getenv('WEBHOOK_MAX_BODY', str(1024 * 1024)))
+
+webhook_server = None
+
+class WebhookRequestHandler(BaseHTTPRequestHandler):
+    """Принимает обновление, проверяет секрет и отвечает сразу, не дожидаясь обработки"""
+    protocol_version = 'HTTP/1.1'
+    
+    def do_POST(self):
+        server = self.server
+        try:
+            length = int(self.headers.get('Content-Length') or 0)
+        except ValueError:
+            length = -1
+        if not 0 <= length <= server.max_body:
+            # Тело не читаем: соединение закрывается вместе с ответом
+            server.count('too_large' if length > 0 else 'invalid')
+            self.close_connection = True
+            self._reply(413 if length > 0 else 400)
+            return
+        body = self.rfile.read(length)
+        
+        if self.path.split('?', 1)[0] != server.webhook_path:
+            self._reply(404)
+            return
+        token = self.headers.get('X-Telegram-Bot-Api-Secret-Token', '')
+        if server.secret and not hmac.compare_digest(token.encode(), server.secret.encode()):
+            server.count('rejected')
+            self._reply(403)
+            return
+        try:
+            server.updates.put_nowait(body)
+        except queue.Full:
+            # Telegram повторит доставку позже
+            server.count('dropped')
+            self._reply(503)
+            return
+        server.count('received')
+        self._reply(200)
+    
+    def _reply(self, status):
+        self.send_response(status)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+    
+    def log_message(self, format, *args):
+        pass
+
+class WebhookServer(ThreadingHTTPServer):
+    """
+    Встроенный HTTP-сервер webhook: запросы только складываются в очередь,
+    а отдельный поток разбирает обновления и передает их обработчикам бота
+    """
+    daemon_threads = True
+    request_queue_size = 128
+    
+    def __init__(self, bot, host=WEBHOOK_HOST, port=WEBHOOK_PORT, path=WEBHOOK_PATH,
+                 secret=WEBHOOK_SECRET, queue_size=WEBHOOK_QUEUE_SIZE, max_body=WEBHOOK_MAX_BODY):
+        super().__init__((host, port), WebhookRequestHandler)
+        self.bot = bot
+        self.webhook_path = path
+        self.secret = secret
+        self.max_body = max_body
+        self.updates = queue.Queue(maxsize=queue_size)
+        self._stats_lock = threading.Lock()
+        self.stats = {'received': 0, 'rejected': 0, 'dropped': 0, 'invalid': 0, 'too_large': 0}
+    
+    @property
+    def port(self):
+        return self.server_address[1]
+    
+    def count(self, key):
+        with self._stats_lock:
+            self.stats[key] += 1
+    
+    def serve(self):
+        """Запускает поток обработки очереди и принимает запросы до shutdown()"""
+        threading.Thread(target=self._consume, name='webhook-consumer', daemon=True).start()
+        self.serve_forever()
+    
+    def _consume(self):
+        while True:
+            body = self.updates.get()
+            try:
+                update = parse_update(json.loads(body))
+            except Exception as e:
+                self.count('invalid')
+                logger.warning(f"Некорректное обновление webhook: {e}")
+                continue
+            try:
+                self.bot.process_new_updates([update])
+            except Exception as e:
+                logger.error(f"Ошибка при обработке обновления webhook: {e}")
+    
+    def get_stats(self):
+        with self._stats_lock:
+            stats = dict(self.stats)
+        stats['queue_depth'] = self.updates.qsize()
+        return stats
+
+def webhook_config_error():
+    """
+    Причина, по которой webhook нельзя запускать, или None. Без секрета любой, кто
+    достучится до порта, может прислать обновление от имени администратора (/reset,
+    /cache_purge), поэтому без WEBHOOK_SECRET сервер слушает только локальный адрес.
+    При регистрации ботом (WEBHOOK_URL) секрет создается сам.
+    """
+    if WEBHOOK_SECRET or WEBHOOK_URL or WEBHOOK_HOST in ('127.0.0.1', 'localhost', '::1'):
+        return None
+    return (f"WEBHOOK_SECRET не задан, а webhook слушает {WEBHOOK_HOST}: задайте WEBHOOK_SECRET (и тот же "
+            f"secret_token при регистрации webhook за прокси) или WEBHOOK_HOST=127.0.0.1")
+
+def run_webhook():
+    """Регистрирует webhook в Telegram и обслуживает входящие обновления"""
+    global webhook_server
+    error = webhook_config_error()
+    if error:
+        raise RuntimeError(error)
+    # Без секрета запросы не проверяются - это допустимо только для сервера на локальном адресе
+    secret = WEBHOOK_SECRET or (secrets.token_urlsafe(32) if WEBHOOK_URL else '')
+    webhook_server = WebhookServer(bot, secret=secret)
+    
+    if WEBHOOK_URL:
+        bot.set_webhook(
+            url=WEBHOOK_URL.rstrip('/') + WEBHOOK_PATH,
+            secret_token=secret,
+            max_connections=WEBHOOK_MAX_CONNECTIONS
+        )
+        logger.info(f"Webhook зарегистрирован: {WEBHOOK_URL.rstrip('/')}{WEBHOOK_PATH}")
+    else:
+        logger.warning("WEBHOOK_URL не задан: webhook в Telegram не регистрируется")
+    
+    logger.info(f"Webhook принимает обновления на {WEBHOOK_HOST}:{webhook_server.port}{WEBHOOK_PATH}")
+    try:
+        webhook_server.serve()
+    finally:
+        webhook_server.server_close()
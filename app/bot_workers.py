@@ -0,0 +1,484 @@
+"""
+Несколько процессов: приемщик обновлений и N обработчиков
+(запуск с --processes N или BOT_PROCESSES=N).
+"""
+import os
+import sys
+import time
+import json
+import hmac
+import queue
+import secrets
+import threading
+import socket
+import subprocess
+from collections import deque
+from pushkin_bot import (
+    bot, BOT_SCRIPT, logger, parse_update, reload_settings, _update_chat_id, WORKER_COUNT, WORKER_INDEX,
+)
+from bot_supervisor import RELOAD_DRAIN_TIMEOUT, RESTART_BACKOFF_INITIAL, RESTART_BACKOFF_MAX, RESTART_STABLE_AFTER
+
+# Обновлений в очереди к одному обработчику (пока он перезапускается или занят); при переполнении приемщик ждет
+WORKER_QUEUE_SIZE = int(os.getenv('WORKER_QUEUE_SIZE', '2000'))
+# Управляющее соединение обработчика с приемщиком: "host:port:token" (задает приемщик)
+BOT_INGESTER = os.getenv('BOT_INGESTER', '')
+
+class _WorkerProcess:
+    """Процесс-обработчик и переданные ему обновления, которые он еще не обработал"""
+    
+    def __init__(self, popen):
+        self.popen = popen
+        # update_id -> (chat_id, update_id, строка) в порядке передачи; received - прочитанные процессом
+        self.unfinished = {}
+        self.received = set()
+        self.chats = {}
+        self.reader = None
+        # Процесс завершился, и его незавершенные обновления уже разобраны (_read_finished)
+        self.exited = False
+        # Когда процесс последний раз завершил обновление: по нему видно, что дообработка не зависла
+        self.progress_at = time.monotonic()
+    
+    def track(self, item):
+        chat_id, update_id, _ = item
+        self.unfinished[update_id] = item
+        self.chats[chat_id] = self.chats.get(chat_id, 0) + 1
+    
+    def finish(self, update_id):
+        """Отмечает обновление обработанным; возвращает чат, если у него больше нет обновлений в процессе"""
+        if update_id not in self.unfinished:
+            return None
+        chat_id = self.unfinished.pop(update_id)[0]
+        self.received.discard(update_id)
+        self.progress_at = time.monotonic()
+        self.chats[chat_id] -= 1
+        if self.chats[chat_id]:
+            return None
+        del self.chats[chat_id]
+        return chat_id
+
+class _WorkerSlot:
+    """Доля чатов одного обработчика: текущий процесс, прежний (дорабатывает после перезапуска) и очередь"""
+    
+    def __init__(self, index, queue_size):
+        self.index = index
+        self.current = None
+        self.draining = None
+        self.lines = queue.Queue(maxsize=queue_size)
+        # Обновления чатов, которые еще обрабатывает прежний процесс: ждут, чтобы не нарушить порядок
+        self.deferred = {}
+        self.ready = deque()
+        self.write_lock = threading.Lock()
+        self.started_at = 0.0
+        self.failures = 0
+        # Время запланированного перезапуска упавшего процесса (time.monotonic()) или None
+        self.restart_at = None
+        self.stats = {'forwarded': 0, 'restarts': 0, 'crashes': 0, 'lost': 0, 'redelivered': 0, 'deferred': 0}
+
+class UpdateRouter:
+    """
+    Процесс-приемщик режима нескольких процессов: получает обновления (long polling
+    или webhook) и передает их N процессам-обработчикам через stdin, по строке JSON
+    на обновление; обработчик сообщает о прочитанных и обработанных обновлениях
+    через stdout.
+    Чат всегда попадает к одному обработчику (ID чата по модулю N), поэтому его
+    обновления обрабатываются по порядку, а лимиты чата и пользователя остаются
+    точными. Кэш анализов общий - файл SQLite, общие лимиты бота
+    (TELEGRAM_GLOBAL_RATE, ADMISSION_*) делятся между обработчиками (worker_share).
+    
+    Упавший обработчик запускается заново с экспоненциальной задержкой, пока его
+    обновления ждут в очереди; обновления, которые он не успел прочитать из канала,
+    получит новый процесс, а начатые не повторяются (повтор мог бы отправить ответ
+    дважды или снова уронить процесс) - их чатам уходит просьба повторить запрос. Перезапуск по /reset идет по одному обработчику:
+    новый процесс сразу получает обновления, прежний дорабатывает начатое (пока
+    обновления у него завершаются, его не останавливают), а новые
+    обновления чатов, которые он еще обрабатывает, придерживаются до их завершения.
+    """
+    
+    def __init__(self, processes, queue_size=WORKER_QUEUE_SIZE, backoff_initial=RESTART_BACKOFF_INITIAL,
+                 backoff_max=RESTART_BACKOFF_MAX, stable_after=RESTART_STABLE_AFTER):
+        self.slots = [_WorkerSlot(index, queue_size) for index in range(processes)]
+        self.backoff_initial = backoff_initial
+        self.backoff_max = backoff_max
+        self.stable_after = stable_after
+        self._lock = threading.Lock()
+        # Оповещает потоки передачи о замене процесса слота
+        self._replaced = threading.Condition(self._lock)
+        self._restart_lock = threading.Lock()
+        self._stopping = False
+        self._token = secrets.token_hex(16)
+        self._control = None
+        self.stats = {'routed': 0, 'rolling_restarts': 0}
+    
+    def _spawn(self, slot):
+        """Запускает процесс-обработчик слота: stdin - обновления, stdout - номера прочитанных и обработанных"""
+        env = dict(os.environ, BOT_WORKER=f"{slot.index}/{len(self.slots)}",
+                   BOT_INGESTER=f"127.0.0.1:{self._control.getsockname()[1]}:{self._token}")
+        env.pop('RELOAD_HANDOFF', None)
+        worker = _WorkerProcess(subprocess.Popen([sys.executable, BOT_SCRIPT], env=env,
+                                                 stdin=subprocess.PIPE, stdout=subprocess.PIPE))
+        worker.reader = threading.Thread(target=self._read_finished, args=(slot, worker),
+                                         name=f'router-finished-{slot.index + 1}', daemon=True)
+        worker.reader.start()
+        slot.started_at = time.monotonic()
+        logger.info(f"Запущен обработчик {slot.index + 1} из {len(self.slots)} (PID {worker.popen.pid})")
+        return worker
+    
+    def start(self):
+        """Запускает обработчики, потоки передачи обновлений, наблюдение за процессами и управляющий порт"""
+        self._control = socket.create_server(('127.0.0.1', 0))
+        for slot in self.slots:
+            slot.current = self._spawn(slot)
+            threading.Thread(target=self._feed, args=(slot,), name=f'router-feed-{slot.index + 1}', daemon=True).start()
+        threading.Thread(target=self._watch, name='router-watch', daemon=True).start()
+        threading.Thread(target=self._serve_control, name='router-control', daemon=True).start()
+        return self
+    
+    def slot_for(self, chat_id):
+        """Обработчик чата; обновления без чата идут первому"""
+        return self.slots[chat_id % len(self.slots) if chat_id is not None else 0]
+    
+    def route(self, update):
+        """Ставит обновление в очередь обработчика его чата (ждет, если очередь заполнена)"""
+        chat_id = _update_chat_id(update)
+        line = json.dumps(update.raw, ensure_ascii=False, separators=(',', ':')).encode('utf-8') + b'\n'
+        self.slot_for(chat_id).lines.put((chat_id, update.update_id, line))
+        with self._lock:
+            self.stats['routed'] += 1
+    
+    def broadcast(self, control):
+        """Управляющее сообщение всем обработчикам - в общем порядке с обновлениями"""
+        line = json.dumps({'control': control}).encode('utf-8') + b'\n'
+        for slot in self.slots:
+            slot.lines.put((None, None, line))
+    
+    def _feed(self, slot):
+        """Передает обновления слота текущему процессу; отпущенные после перезапуска - первыми"""
+        while True:
+            with self._lock:
+                released = slot.deferred.pop(slot.ready.popleft(), []) if slot.ready else None
+            if released is not None:
+                for item in released:
+                    self._deliver(slot, item)
+                continue
+            item = slot.lines.get()
+            if item is not None:
+                self._deliver(slot, item)
+    
+    def _deliver(self, slot, item):
+        chat_id, update_id, line = item
+        while True:
+            with self._lock:
+                if slot.draining is not None and chat_id is not None and (
+                        chat_id in slot.deferred or chat_id in slot.draining.chats):
+                    slot.deferred.setdefault(chat_id, []).append(item)
+                    slot.stats['deferred'] += 1
+                    return
+                worker = slot.current
+                if worker.exited:
+                    # Упавший процесс еще не запущен заново: ждем замены, а не пишем в закрытый канал
+                    if self._stopping:
+                        return
+                    self._replaced.wait(1)
+                    continue
+                if update_id is not None:
+                    worker.track(item)
+            try:
+                with slot.write_lock:
+                    worker.popen.stdin.write(line)
+                    worker.popen.stdin.flush()
+            except (OSError, ValueError):
+                # Процесс завершился или заменяется: строку получит следующий
+                with self._lock:
+                    if worker.exited and update_id is not None:
+                        # Уже передана заново вместе с непрочитанными
+                        return
+                    if update_id is not None:
+                        worker.finish(update_id)
+                if self._stopping:
+                    return
+                continue
+            with self._lock:
+                slot.stats['forwarded'] += 1
+            return
+    
+    def _read_finished(self, slot, worker):
+        """
+        Номера прочитанных ("+ID") и обработанных ("ID") обновлений от процесса; при его
+        завершении отпускает придержанные чаты и передает заново непрочитанные обновления
+        """
+        for line in worker.popen.stdout:
+            try:
+                received = line.startswith(b'+')
+                update_id = int(line.lstrip(b'+'))
+            except ValueError:
+                continue
+            with self._lock:
+                if received:
+                    if update_id in worker.unfinished:
+                        worker.received.add(update_id)
+                    continue
+                chat_id = worker.finish(update_id)
+                if worker is slot.draining and chat_id in slot.deferred:
+                    slot.ready.append(chat_id)
+                    wake = True
+                else:
+                    wake = False
+            if wake:
+                self._wake(slot)
+        
+        # Строки, записанные до конца процесса, попадут в непрочитанные, после - не запишутся
+        worker.popen.wait()
+        with self._lock:
+            worker.exited = True
+            unread = [item for update_id, item in worker.unfinished.items() if update_id not in worker.received]
+            abandoned = [item for update_id, item in worker.unfinished.items() if update_id in worker.received]
+            lost = len(abandoned)
+            slot.stats['lost'] += lost
+            slot.stats['redelivered'] += len(unread)
+            # Непрочитанные обновления старше придержанных - идут перед ними
+            for item in reversed(unread):
+                slot.deferred.setdefault(item[0], []).insert(0, item)
+            if worker is slot.draining:
+                slot.draining = None
+            slot.ready.extend(chat_id for chat_id in slot.deferred if chat_id not in slot.ready)
+        if lost or unread:
+            logger.error(f"Обработчик {slot.index + 1} (PID {worker.popen.pid}) завершился: не завершено начатых "
+                         f"обновлений {lost}, передаю заново непрочитанные {len(unread)}")
+        self._wake(slot)
+        self._reply_abandoned(abandoned)
+    
+    def _reply_abandoned(self, items):
+        """Сообщает чатам, что начатые для них обновления не будут обработаны (ответа иначе не будет)"""
+        for chat_id in dict.fromkeys(chat_id for chat_id, _, _ in items if chat_id is not None):
+            try:
+                bot.send_message(chat_id, "Не удалось обработать ваш запрос: обработчик был перезапущен. "
+                                          "Пожалуйста, отправьте его еще раз.")
+            except Exception as e:
+                logger.warning(f"Не удалось сообщить чату {chat_id} о необработанном запросе: {e}")
+    
+    def _wake(self, slot):
+        # Пустая запись будит поток передачи; если очередь полна, он и так не ждет
+        try:
+            slot.lines.put_nowait(None)
+        except queue.Full:
+            pass
+    
+    def _watch(self):
+        """
+        Запускает заново завершившиеся обработчики с экспоненциальной задержкой;
+        задержка у каждого слота своя и не задерживает проверку остальных
+        """
+        while not self._stopping:
+            time.sleep(0.2)
+            for slot in self.slots:
+                process = slot.current.popen
+                if self._stopping or process.poll() is None:
+                    continue
+                now = time.monotonic()
+                if slot.restart_at is None:
+                    if now - slot.started_at >= self.stable_after:
+                        slot.failures = 0
+                    delay = min(self.backoff_max, self.backoff_initial * 2 ** slot.failures)
+                    slot.failures += 1
+                    slot.restart_at = now + delay
+                    with self._lock:
+                        slot.stats['crashes'] += 1
+                    logger.error(f"Обработчик {slot.index + 1} (PID {process.pid}) завершился с кодом {process.returncode}, "
+                                 f"перезапуск через {delay:.1f} с; обновлений в очереди: {slot.lines.qsize()}")
+                if now >= slot.restart_at:
+                    slot.restart_at = None
+                    worker = self._spawn(slot)
+                    with self._lock:
+                        slot.current = worker
+                        self._replaced.notify_all()
+    
+    def restart(self, index=None):
+        """
+        Перезапускает обработчики по одному (или только index): новый процесс сразу
+        получает обновления, прежний по концу stdin дорабатывает начатое и завершается
+        """
+        if not self._restart_lock.acquire(blocking=False):
+            return False
+        
+        def run():
+            try:
+                for slot in self.slots if index is None else [self.slots[index]]:
+                    worker = self._spawn(slot)
+                    with self._lock:
+                        old = slot.current
+                        old.progress_at = time.monotonic()
+                        slot.draining = old
+                        slot.current = worker
+                        slot.stats['restarts'] += 1
+                        self._replaced.notify_all()
+                    with slot.write_lock:
+                        try:
+                            old.popen.stdin.close()
+                        except OSError:
+                            pass
+                    self._wait_drained(slot, old)
+                    old.reader.join(timeout=10)
+                with self._lock:
+                    self.stats['rolling_restarts'] += 1
+                logger.info("Перезапуск обработчиков завершен", category='admin')
+            finally:
+                self._restart_lock.release()
+        
+        threading.Thread(target=run, name='router-restart', daemon=True).start()
+        return True
+    
+    def _wait_drained(self, slot, worker):
+        """
+        Ждет, пока прежний процесс дообработает начатое: сколько угодно долго, пока
+        он завершает обновления; останавливается только процесс, который за
+        RELOAD_DRAIN_TIMEOUT + 10 с не завершил ни одного
+        """
+        while True:
+            try:
+                worker.popen.wait(timeout=1)
+                return
+            except subprocess.TimeoutExpired:
+                pass
+            with self._lock:
+                stalled = time.monotonic() - worker.progress_at
+            if stalled > RELOAD_DRAIN_TIMEOUT + 10:
+                logger.warning(f"Обработчик {slot.index + 1} (PID {worker.popen.pid}) {stalled:.0f} с не завершил "
+                               f"ни одного обновления (осталось {len(worker.unfinished)}), останавливаю")
+                worker.popen.kill()
+                worker.popen.wait()
+                return
+    
+    def _serve_control(self):
+        """Команды от обработчиков (строка JSON с токеном): stats, restart, reload_config"""
+        while True:
+            try:
+                connection, _ = self._control.accept()
+            except OSError:
+                return
+            with connection:
+                try:
+                    connection.settimeout(5)
+                    stream = connection.makefile('rw', encoding='utf-8')
+                    request = json.loads(stream.readline() or '{}')
+                    if not hmac.compare_digest(str(request.get('token', '')), self._token):
+                        continue
+                    command = request.get('command')
+                    if command == 'stats':
+                        reply = self.get_stats()
+                    elif command == 'restart':
+                        worker = request.get('worker')
+                        if worker is not None and not 0 <= worker < len(self.slots):
+                            reply = {'error': f'нет обработчика {worker + 1}, их {len(self.slots)}'}
+                        else:
+                            reply = {'started': self.restart(worker)}
+                    elif command == 'reload_config':
+                        self.broadcast('reload_config')
+                        reply = {'started': True}
+                    else:
+                        reply = {'error': f'неизвестная команда {command!r}'}
+                    stream.write(json.dumps(reply) + '\n')
+                    stream.flush()
+                except (OSError, ValueError) as e:
+                    logger.warning(f"Ошибка управляющего соединения обработчика: {e}")
+    
+    def stop(self, timeout=RELOAD_DRAIN_TIMEOUT):
+        """Закрывает stdin обработчиков и ждет, пока они дообработают начатое"""
+        deadline = time.monotonic() + timeout
+        for slot in self.slots:
+            while (slot.lines.qsize() or slot.deferred) and slot.current.popen.poll() is None \
+                    and time.monotonic() < deadline:
+                time.sleep(0.05)
+        with self._lock:
+            self._stopping = True
+            self._replaced.notify_all()
+        processes = [worker.popen for slot in self.slots for worker in (slot.current, slot.draining) if worker]
+        for process in processes:
+            try:
+                process.stdin.close()
+            except OSError:
+                pass
+        for process in processes:
+            try:
+                process.wait(timeout=max(0.1, deadline - time.monotonic()))
+            except subprocess.TimeoutExpired:
+                process.kill()
+        self._control.close()
+    
+    def get_stats(self):
+        with self._lock:
+            stats = dict(self.stats)
+            stats['workers'] = [dict(slot.stats, pid=slot.current.popen.pid, alive=slot.current.popen.poll() is None,
+                                     queue_depth=slot.lines.qsize(), unfinished=len(slot.current.unfinished),
+                                     waiting=sum(len(items) for items in slot.deferred.values()),
+                                     draining=slot.draining is not None) for slot in self.slots]
+        return stats
+
+def ingester_request(command, **fields):
+    """В процессе-обработчике: команда процессу-приемщику, возвращает его ответ"""
+    host, port, token = BOT_INGESTER.rsplit(':', 2)
+    with socket.create_connection((host, int(port)), timeout=5) as connection:
+        stream = connection.makefile('rw', encoding='utf-8')
+        stream.write(json.dumps(dict(fields, command=command, token=token)) + '\n')
+        stream.flush()
+        return json.loads(stream.readline() or '{}')
+
+def run_worker():
+    """
+    Точка входа процесса-обработчика: читает из stdin обновления своей доли чатов
+    и обрабатывает их обычным пулом потоков. Конец stdin (перезапуск или остановка
+    приемщика) - сигнал дообработать начатое и завершиться.
+    """
+    # stdout - канал номеров прочитанных и обработанных обновлений для приемщика; вывод в консоль уходит в stderr
+    sys.stdout.flush()
+    finished = os.fdopen(os.dup(sys.stdout.fileno()), 'w', encoding='ascii')
+    os.dup2(sys.stderr.fileno(), sys.stdout.fileno())
+    finished_lock = threading.Lock()
+    
+    def report(mark):
+        try:
+            with finished_lock:
+                finished.write(f"{mark}\n")
+                finished.flush()
+        except (OSError, ValueError):
+            pass
+    
+    if bot.dispatcher is not None:
+        process_update = bot.dispatcher.handler
+        
+        def handler(update):
+            try:
+                process_update(update)
+            finally:
+                report(update.update_id)
+        
+        bot.dispatcher.handler = handler
+    
+    logger.info(f"Обработчик {WORKER_INDEX + 1} из {WORKER_COUNT} (PID {os.getpid()}) принимает обновления")
+    for line in sys.stdin.buffer:
+        try:
+            data = json.loads(line)
+        except ValueError as e:
+            logger.warning(f"Некорректная строка от приемщика: {e}")
+            continue
+        if data.get('control') == 'reload_config':
+            reload_settings()
+            continue
+        update = parse_update(data)
+        # Прочитанное обновление приемщик уже не передаст другому процессу, даже если этот упадет
+        report(f"+{update.update_id}")
+        bot.process_new_updates([update])
+        if bot.dispatcher is None:
+            report(update.update_id)
+    
+    logger.info(f"Обработчик {WORKER_INDEX + 1}: прием завершен, дообрабатываю начатые запросы")
+    if bot.dispatcher is None:
+        return
+    # Под нагрузкой дообработка бывает дольше RELOAD_DRAIN_TIMEOUT: ждем, пока обновления завершаются,
+    # и выходим раньше, только если за это время не завершилось ни одно (о брошенных сообщит приемщик)
+    unfinished = bot.dispatcher.get_stats()['unfinished']
+    while not bot.dispatcher.wait_idle(RELOAD_DRAIN_TIMEOUT):
+        remaining = bot.dispatcher.get_stats()['unfinished']
+        if remaining >= unfinished:
+            logger.warning(f"За {RELOAD_DRAIN_TIMEOUT:.0f} с не завершено ни одного обновления, осталось: {remaining}")
+            return
+        unfinished = remaining
@@ -2,13 +2,43 @@ import os
 import re
 import sys
 import time
-import subprocess
+import asyncio
+import bisect
+import functools
+import json
+import hashlib
+import sqlite3
+import html
+import random
+import heapq
+import math
+import itertools
+import queue
+import threading
+import socket
+import atexit
+import contextvars
+import glob
+import shutil
+from array import array
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import httpcore
+import httpx
+import openai
 from openai import OpenAI
 import telebot
 from dotenv import load_dotenv
 import requests
 from io import BytesIO
 
+try:
+    import psutil
+except ImportError:
+    # Без psutil показатели ресурсов читаются из /proc (Linux)
+    psutil = None
+
 # Загружаем переменные окружения из файла .env
 load_dotenv()
 
@@ -18,13 +48,1015 @@ HUGGINGFACE_TOKEN = os.getenv('HUGGINGFACE_TOKEN', 'hf_OPeiftAWgWGqdqNyFAgaDkDFF
 # ID администратора (укажите свой Telegram ID)
 ADMIN_ID = os.getenv('ADMIN_ID', '8219171639') 
 
+# Процесс-обработчик в режиме нескольких процессов: "номер/число" задает процесс-приемщик (см. UpdateRouter в bot_workers)
+BOT_WORKER = os.getenv('BOT_WORKER', '')
+WORKER_INDEX, WORKER_COUNT = map(int, BOT_WORKER.split('/')) if BOT_WORKER else (None, 1)
+
+# Режимы работы (модули bot_async, bot_webhook, bot_workers): asyncio вместо потоков,
+# webhook вместо long polling и число процессов-обработчиков
+BOT_RUNTIME = 'async' if '--async' in sys.argv else os.getenv('BOT_RUNTIME', 'sync')
+BOT_MODE = 'webhook' if '--webhook' in sys.argv else os.getenv('BOT_MODE', 'polling')
+BOT_PROCESSES = (int(sys.argv[sys.argv.index('--processes') + 1]) if '--processes' in sys.argv
+                 else int(os.getenv('BOT_PROCESSES', '0')))
+# Файл бота: его запускают резервный процесс при /reset и процессы-обработчики
+BOT_SCRIPT = os.path.abspath(__file__)
+
+def worker_share(limit):
+    """Доля общего для бота лимита на один процесс-обработчик (целые лимиты - не меньше 1)"""
+    share = limit / WORKER_COUNT
+    return max(1, math.ceil(share)) if isinstance(limit, int) else share
+
+# Настройки журнала: JSON lines в файл (LOG_PATH='' - без файла) и краткие строки в консоль
+LOG_PATH = os.getenv('LOG_PATH', 'bot.log.jsonl')
+if WORKER_INDEX is not None and LOG_PATH:
+    # У каждого обработчика свой файл: ротация одного файла из нескольких процессов теряла бы записи
+    LOG_PATH = '{0}.worker{2}{1}'.format(*os.path.splitext(LOG_PATH), WORKER_INDEX + 1)
+LOG_LEVEL = os.getenv('LOG_LEVEL', 'debug')
+LOG_CONSOLE_LEVEL = os.getenv('LOG_CONSOLE_LEVEL', 'info')
+LOG_MAX_MB = float(os.getenv('LOG_MAX_MB', '50'))
+LOG_ROTATE_HOURS = float(os.getenv('LOG_ROTATE_HOURS', '24'))
+LOG_BACKUPS = int(os.getenv('LOG_BACKUPS', '10'))
+LOG_QUEUE_SIZE = int(os.getenv('LOG_QUEUE_SIZE', '10000'))
+# Доля отладочных записей, которые сохраняются, когда очередь заполнена больше чем наполовину
+LOG_DEBUG_SAMPLE = float(os.getenv('LOG_DEBUG_SAMPLE', '0.1'))
+LOG_FLUSH_INTERVAL = float(os.getenv('LOG_FLUSH_INTERVAL', '0.2'))
+
+_LOG_LEVELS = {'debug': 10, 'info': 20, 'warning': 30, 'error': 40}
+_CONSOLE_TAGS = {'debug': 'DEBUG', 'info': 'LOG', 'warning': 'WARNING', 'error': 'ERROR'}
+
+# ID обрабатываемого обновления и накопленные длительности его этапов (для записей журнала)
+_log_request_id = contextvars.ContextVar('log_request_id', default=None)
+_log_stages = contextvars.ContextVar('log_stages', default=None)
+
+class _RequestScope:
+    """Область обработки одного обновления: ID в записях журнала и итоговая запись с этапами"""
+    
+    def __init__(self, logger, request_id, fields):
+        self.logger = logger
+        self.request_id = request_id
+        self.fields = fields
+    
+    def __enter__(self):
+        self.started = time.perf_counter()
+        self._tokens = (_log_request_id.set(self.request_id), _log_stages.set({}))
+        return self
+    
+    def __exit__(self, exc_type, exc, traceback):
+        stages = _log_stages.get()
+        _log_request_id.reset(self._tokens[0])
+        _log_stages.reset(self._tokens[1])
+        if exc_type is not None:
+            self.fields['error'] = exc_type.__name__
+        self.logger.event('request', request_id=self.request_id,
+                          seconds=round(time.perf_counter() - self.started, 4),
+                          stages={stage: round(seconds, 4) for stage, seconds in stages.items()}, **self.fields)
+        return False
+
+class LogPipeline:
+    """
+    Неблокирующий журнал: записи кладутся в ограниченную очередь, а фоновый
+    поток пачками пишет их в файл (JSON lines, UTF-8, ротация по размеру и
+    времени) и в консоль. При переполнении очереди отладочные записи
+    прореживаются, а остальные отбрасываются со счетчиком - обработчик
+    никогда не ждет диска.
+    """
+    
+    def __init__(self, path=LOG_PATH, level=LOG_LEVEL, console_level=LOG_CONSOLE_LEVEL,
+                 max_bytes=LOG_MAX_MB * 1024 * 1024, rotate_seconds=LOG_ROTATE_HOURS * 3600,
+                 backups=LOG_BACKUPS, queue_size=LOG_QUEUE_SIZE, debug_sample=LOG_DEBUG_SAMPLE,
+                 flush_interval=LOG_FLUSH_INTERVAL):
+        self.path = path
+        self.level = _LOG_LEVELS[level]
+        self.console_level = _LOG_LEVELS[console_level]
+        self.max_bytes = max_bytes
+        self.rotate_seconds = rotate_seconds
+        self.backups = backups
+        self.debug_sample = debug_sample
+        self.flush_interval = flush_interval
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._lock = threading.Lock()
+        self._file = None
+        self._opened_at = 0.0
+        self.dropped = {}
+        self._reported_dropped = 0
+        self.stats = {'written': 0, 'batches': 0, 'max_batch': 0, 'rotations': 0, 'write_errors': 0}
+        self._thread = None
+    
+    def start(self):
+        """Запускает поток записи; до этого записи только копятся в очереди"""
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name='log-writer', daemon=True)
+            self._thread.start()
+            atexit.register(self.close)
+        return self
+    
+    def emit(self, level, message, **fields):
+        """Ставит запись в очередь; никогда не блокирует"""
+        level_number = _LOG_LEVELS[level]
+        if level_number < self.level and level_number < self.console_level:
+            return
+        if level == 'debug' and self._queue.qsize() * 2 > self._queue.maxsize and random.random() >= self.debug_sample:
+            self._drop(level)
+            return
+        record = {'ts': time.time(), 'level': level, 'msg': message, 'thread': threading.current_thread().name}
+        request_id = _log_request_id.get()
+        if request_id is not None:
+            record['request_id'] = request_id
+        record.update(fields)
+        try:
+            self._queue.put_nowait(record)
+        except queue.Full:
+            self._drop(level)
+    
+    def debug(self, message, **fields):
+        self.emit('debug', message, **fields)
+    
+    def info(self, message, **fields):
+        self.emit('info', message, **fields)
+    
+    def warning(self, message, **fields):
+        self.emit('warning', message, **fields)
+    
+    def error(self, message, **fields):
+        self.emit('error', message, **fields)
+    
+    def event(self, name, **fields):
+        """Структурная запись только для файла (в консоль не выводится)"""
+        self.emit('info', name, event=name, **fields)
+    
+    def request(self, request_id, **fields):
+        """with logger.request(update_id): ... - ID в записях и итоговая запись с длительностями этапов"""
+        return _RequestScope(self, request_id, fields)
+    
+    def _drop(self, level):
+        with self._lock:
+            self.dropped[level] = self.dropped.get(level, 0) + 1
+    
+    def _run(self):
+        while True:
+            batch = [self._queue.get()]
+            # Записи, пришедшие за flush_interval после первой, уходят на диск одной пачкой
+            if batch[0] is not None:
+                time.sleep(self.flush_interval)
+            while True:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            stop = None in batch
+            self._write([record for record in batch if record is not None])
+            for _ in batch:
+                self._queue.task_done()
+            if stop:
+                return
+    
+    def _write(self, batch):
+        with self._lock:
+            dropped_total = sum(self.dropped.values())
+            dropped = dict(self.dropped)
+        if dropped_total > self._reported_dropped:
+            self._reported_dropped = dropped_total
+            batch.append({'ts': time.time(), 'level': 'warning', 'thread': 'log-writer', 'dropped': dropped,
+                          'msg': f"Журнал не успевал за потоком записей, пропущено: {dropped}"})
+        
+        console_lines = []
+        file_lines = []
+        for record in batch:
+            level_number = _LOG_LEVELS[record['level']]
+            if level_number >= self.console_level and 'event' not in record:
+                tag = record.get('category', _CONSOLE_TAGS[record['level']]).upper()
+                console_lines.append(f"[{tag}] {record['msg']}\n")
+            if level_number >= self.level and self.path:
+                file_lines.append(json.dumps(record, ensure_ascii=False, default=str) + '\n')
+        
+        if console_lines:
+            try:
+                sys.stdout.write(''.join(console_lines))
+                sys.stdout.flush()
+            except (OSError, ValueError):
+                pass
+        if file_lines:
+            data = ''.join(file_lines)
+            try:
+                self._write_file(data)
+            except OSError as e:
+                self.stats['write_errors'] += 1
+                sys.stderr.write(f"[ERROR] Не удалось записать журнал {self.path}: {e}\n")
+                self._file = None
+        self.stats['written'] += len(batch)
+        self.stats['batches'] += 1
+        self.stats['max_batch'] = max(self.stats['max_batch'], len(batch))
+    
+    def _write_file(self, data):
+        if self._file is not None:
+            size = self._file.tell()
+            if size and (size + len(data) > self.max_bytes or time.time() - self._opened_at >= self.rotate_seconds):
+                self._rotate()
+        if self._file is None:
+            self._file = open(self.path, 'a', encoding='utf-8')
+            self._opened_at = time.time()
+        self._file.write(data)
+        self._file.flush()
+    
+    def _rotate(self):
+        """Переименовывает текущий файл в path.ГГГГММДД-ЧЧММСС и удаляет лишние старые"""
+        self._file.close()
+        self._file = None
+        rotated = f"{self.path}.{time.strftime('%Y%m%d-%H%M%S')}"
+        suffix = 1
+        while os.path.exists(rotated):
+            rotated = f"{self.path}.{time.strftime('%Y%m%d-%H%M%S')}.{suffix}"
+            suffix += 1
+        os.replace(self.path, rotated)
+        self.stats['rotations'] += 1
+        for old in sorted(glob.glob(glob.escape(self.path) + '.*'), key=os.path.getmtime)[:-self.backups or None]:
+            try:
+                os.remove(old)
+            except OSError:
+                pass
+    
+    def flush(self, timeout=5.0):
+        """Ждет, пока очередь будет записана (для завершения и тестов)"""
+        deadline = time.time() + timeout
+        while self._thread is not None and self._queue.unfinished_tasks and time.time() < deadline:
+            time.sleep(0.01)
+    
+    def close(self, timeout=5.0):
+        if self._thread is None or not self._thread.is_alive():
+            return
+        try:
+            self._queue.put(None, timeout=timeout)
+        except queue.Full:
+            return
+        self._thread.join(timeout)
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+    
+    def get_stats(self):
+        with self._lock:
+            dropped = dict(self.dropped)
+        stats = dict(self.stats)
+        stats['queued'] = self._queue.qsize()
+        stats['dropped'] = sum(dropped.values())
+        return stats
+
+logger = LogPipeline()
+
+# Настройки метрик (METRICS_PORT=0 отключает HTTP-экспорт)
+METRICS_HOST = os.getenv('METRICS_HOST', '127.0.0.1')
+METRICS_PORT = int(os.getenv('METRICS_PORT', '9108'))
+if WORKER_INDEX is not None and METRICS_PORT:
+    # Обработчики отдают метрики на следующих портах после приемщика
+    METRICS_PORT += WORKER_INDEX + 1
+
+class _StageTimer:
+    """Замеряет длительность этапа; исключение учитывается в счетчике ошибок по типу"""
+    __slots__ = ('metrics', 'stage', 'started')
+    
+    def __init__(self, metrics, stage):
+        self.metrics = metrics
+        self.stage = stage
+    
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+    
+    def __exit__(self, exc_type, exc, traceback):
+        self.metrics.observe(self.stage, time.perf_counter() - self.started)
+        if exc_type is not None and issubclass(exc_type, Exception):
+            self.metrics.inc('errors_total', stage=self.stage, type=exc_type.__name__)
+        return False
+
+class Metrics:
+    """
+    Реестр метрик: гистограммы длительности этапов обработки и счетчики
+    с метками. Отдается в текстовом формате Prometheus и кратко в /status.
+    """
+    
+    BUCKETS = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+               1.0, 2.5, 5.0, 10.0, 20.0, 40.0, 80.0)
+    
+    def __init__(self, prefix='pushkin_bot', buckets=BUCKETS):
+        self.prefix = prefix
+        self.buckets = buckets
+        self._lock = threading.Lock()
+        # Этап -> [счетчики по корзинам (последняя - +Inf), сумма, количество]
+        self._stages = {}
+        # (имя, метки) -> значение
+        self._counters = {}
+    
+    def observe(self, stage, seconds):
+        # Длительность этапа попадает и в итоговую запись журнала о текущем обновлении
+        stages = _log_stages.get()
+        if stages is not None:
+            stages[stage] = stages.get(stage, 0.0) + seconds
+        index = bisect.bisect_left(self.buckets, seconds)
+        with self._lock:
+            histogram = self._stages.get(stage)
+            if histogram is None:
+                histogram = self._stages[stage] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            histogram[0][index] += 1
+            histogram[1] += seconds
+            histogram[2] += 1
+    
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+    
+    def time(self, stage):
+        """Контекстный менеджер: with metrics.time('llm'): ..."""
+        return _StageTimer(self, stage)
+    
+    def timed(self, stage):
+        """Декоратор, замеряющий каждый вызов функции (обычной или async) как этап"""
+        def decorator(function):
+            if asyncio.iscoroutinefunction(function):
+                @functools.wraps(function)
+                async def async_wrapper(*args, **kwargs):
+                    with _StageTimer(self, stage):
+                        return await function(*args, **kwargs)
+                return async_wrapper
+            
+            @functools.wraps(function)
+            def wrapper(*args, **kwargs):
+                with _StageTimer(self, stage):
+                    return function(*args, **kwargs)
+            return wrapper
+        return decorator
+    
+    def _quantile(self, counts, total, fraction):
+        """Оценка квантиля по корзинам гистограммы с линейной интерполяцией"""
+        rank = fraction * total
+        cumulative = 0
+        for index, count in enumerate(counts):
+            if count and cumulative + count >= rank:
+                if index == len(self.buckets):
+                    return self.buckets[-1]
+                lower = self.buckets[index - 1] if index else 0.0
+                return lower + (self.buckets[index] - lower) * (rank - cumulative) / count
+            cumulative += count
+        return 0.0
+    
+    def summary(self):
+        """Возвращает {этап: count, avg, p50, p95, p99} и копию счетчиков"""
+        with self._lock:
+            stages = {stage: (list(counts), total, count) for stage, (counts, total, count) in self._stages.items()}
+            counters = dict(self._counters)
+        result = {}
+        for stage, (counts, total, count) in stages.items():
+            result[stage] = {
+                'count': count,
+                'avg': total / count if count else 0.0,
+                'p50': self._quantile(counts, count, 0.5),
+                'p95': self._quantile(counts, count, 0.95),
+                'p99': self._quantile(counts, count, 0.99),
+            }
+        return result, counters
+    
+    @staticmethod
+    def _labels(labels):
+        if not labels:
+            return ''
+        parts = []
+        for name, value in labels:
+            value = str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+            parts.append(f'{name}="{value}"')
+        return '{' + ','.join(parts) + '}'
+    
+    def render(self):
+        """Текстовый формат экспорта Prometheus"""
+        with self._lock:
+            stages = {stage: (list(counts), total, count) for stage, (counts, total, count) in self._stages.items()}
+            counters = dict(self._counters)
+        
+        name = f'{self.prefix}_stage_seconds'
+        lines = [f'# HELP {name} Длительность этапов обработки', f'# TYPE {name} histogram']
+        for stage in sorted(stages):
+            counts, total, count = stages[stage]
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += bucket_count
+                le = '+Inf' if bound == float('inf') else repr(bound)
+                lines.append(f'{name}_bucket{{stage="{stage}",le="{le}"}} {cumulative}')
+            lines.append(f'{name}_sum{{stage="{stage}"}} {total}')
+            lines.append(f'{name}_count{{stage="{stage}"}} {count}')
+        
+        declared = set()
+        for counter_name, labels in sorted(counters):
+            full_name = f'{self.prefix}_{counter_name}'
+            if full_name not in declared:
+                declared.add(full_name)
+                lines.append(f'# TYPE {full_name} counter')
+            lines.append(f'{full_name}{self._labels(labels)} {counters[(counter_name, labels)]}')
+        return '\n'.join(lines) + '\n'
+
+metrics = Metrics()
+
+class MetricsRequestHandler(BaseHTTPRequestHandler):
+    """Отдает метрики по GET /metrics"""
+    
+    def do_GET(self):
+        if self.path.split('?', 1)[0] != '/metrics':
+            self.send_error(404)
+            return
+        body = metrics.render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+    
+    def log_message(self, format, *args):
+        pass
+
+def start_metrics_server(host=METRICS_HOST, port=METRICS_PORT):
+    """Запускает HTTP-экспорт метрик в фоновом потоке; возвращает сервер или None"""
+    if not port:
+        return None
+    try:
+        server = ThreadingHTTPServer((host, port), MetricsRequestHandler)
+    except OSError as e:
+        logger.warning(f"Не удалось запустить экспорт метрик на {host}:{port}: {e}")
+        return None
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name='metrics-server', daemon=True).start()
+    logger.info(f"Метрики Prometheus: http://{host}:{server.server_address[1]}/metrics")
+    return server
+
+# Настройки обработки обновлений
+# Потоков больше, чем мест у модели и в очереди к ней (ADMISSION_*): лишние запросы быстро получают отказ
+DISPATCHER_WORKERS = int(os.getenv('DISPATCHER_WORKERS', '40'))
+DISPATCHER_FAST_WORKERS = int(os.getenv('DISPATCHER_FAST_WORKERS', '2'))
+
+# Дешевые команды обрабатываются отдельным пулом и не ждут вызовов модели
+FAST_COMMANDS = frozenset({'start', 'help', 'about', 'status', 'admin', 'image', 'cache', 'reset'})
+
+def _update_chat_id(update):
+    """Возвращает ID чата, к которому относится обновление"""
+    message = update.message or update.edited_message
+    if message is not None:
+        return message.chat.id
+    if update.callback_query is not None and update.callback_query.message is not None:
+        return update.callback_query.message.chat.id
+    return None
+
+def _update_command(update):
+    """Возвращает имя команды из текста сообщения (без / и @имени_бота) или None"""
+    message = update.message
+    text = message.text if message is not None else None
+    if not text or not text.startswith('/'):
+        return None
+    return text.split(maxsplit=1)[0][1:].split('@')[0].lower()
+
+def parse_update(data):
+    """Update из разобранного JSON; исходный словарь сохраняется в update.raw (его приемщик передает обработчикам)"""
+    update = telebot.types.Update.de_json(data)
+    update.raw = data
+    return update
+
+class UpdateDispatcher:
+    """
+    Выполняет обработчики в ограниченном пуле потоков.
+    Обновления одного чата обрабатываются строго по порядку, разные чаты - параллельно,
+    дешевые команды идут через отдельную быструю очередь.
+    """
+    
+    def __init__(self, handler, workers=8, fast_workers=2):
+        self.handler = handler
+        self._pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='update-worker')
+        self._fast_pool = ThreadPoolExecutor(max_workers=fast_workers, thread_name_prefix='fast-worker')
+        self._lock = threading.Lock()
+        self._chats = {}
+        self._pending = 0
+        # Принятые, но еще не обработанные до конца обновления (для остановки с дообработкой)
+        self._unfinished = 0
+        self._idle = threading.Condition(self._lock)
+        self.stats = {'processed': 0, 'fast': 0, 'errors': 0, 'max_queue_depth': 0,
+                      'wait_total': 0.0, 'wait_max': 0.0}
+    
+    def submit(self, update):
+        """Ставит обновление в очередь своего чата или в быструю очередь"""
+        enqueued_at = time.time()
+        with self._lock:
+            self._pending += 1
+            self._unfinished += 1
+            self.stats['max_queue_depth'] = max(self.stats['max_queue_depth'], self._pending)
+        
+        if _update_command(update) in FAST_COMMANDS:
+            self._fast_pool.submit(self._run, update, enqueued_at, True)
+            return
+        
+        chat_id = _update_chat_id(update)
+        with self._lock:
+            queue = self._chats.get(chat_id)
+            if queue is not None:
+                # Чат уже обрабатывается - обновление будет взято после предыдущих
+                queue.append((update, enqueued_at))
+                return
+            self._chats[chat_id] = deque([(update, enqueued_at)])
+        self._pool.submit(self._drain, chat_id)
+    
+    def _drain(self, chat_id):
+        """Обрабатывает одно обновление чата и перепланирует чат, если в нем есть еще"""
+        with self._lock:
+            update, enqueued_at = self._chats[chat_id][0]
+        
+        self._run(update, enqueued_at, False)
+        
+        with self._lock:
+            queue = self._chats[chat_id]
+            queue.popleft()
+            if not queue:
+                del self._chats[chat_id]
+                return
+        self._pool.submit(self._drain, chat_id)
+    
+    def _run(self, update, enqueued_at, fast):
+        wait_time = time.time() - enqueued_at
+        with self._lock:
+            self._pending -= 1
+            self.stats['processed'] += 1
+            self.stats['fast'] += int(fast)
+            self.stats['wait_total'] += wait_time
+            self.stats['wait_max'] = max(self.stats['wait_max'], wait_time)
+        
+        try:
+            self.handler(update)
+        except Exception as e:
+            with self._lock:
+                self.stats['errors'] += 1
+            logger.error(f"Необработанная ошибка при обработке обновления {update.update_id}: {type(e).__name__}: {e}")
+        finally:
+            with self._lock:
+                self._unfinished -= 1
+                if not self._unfinished:
+                    self._idle.notify_all()
+    
+    def wait_idle(self, timeout=None):
+        """Ждет, пока будут обработаны все принятые обновления; False, если не дождались"""
+        with self._lock:
+            return self._idle.wait_for(lambda: not self._unfinished, timeout)
+    
+    def get_stats(self):
+        """Возвращает метрики очереди: глубину, число активных чатов и время ожидания"""
+        with self._lock:
+            stats = dict(self.stats)
+            stats['queue_depth'] = self._pending
+            stats['active_chats'] = len(self._chats)
+            stats['unfinished'] = self._unfinished
+        stats['wait_avg'] = stats['wait_total'] / stats['processed'] if stats['processed'] else 0.0
+        return stats
+
+class DispatchingTeleBot(telebot.TeleBot):
+    """TeleBot, передающий полученные обновления в UpdateDispatcher"""
+    
+    def __init__(self, token, workers=8, fast_workers=2, **kwargs):
+        self._update_id_lock = threading.Lock()
+        self._last_update_id = 0
+        super().__init__(token, threaded=False, **kwargs)
+        self.dispatcher = UpdateDispatcher(self._process_update, workers, fast_workers) if workers > 0 else None
+        # UpdateRouter в процессе-приемщике режима нескольких процессов
+        self.router = None
+    
+    @property
+    def last_update_id(self):
+        return self._last_update_id
+    
+    @last_update_id.setter
+    def last_update_id(self, value):
+        # Обработчики из разных потоков не должны откатывать смещение getUpdates назад
+        with self._update_id_lock:
+            self._last_update_id = max(self._last_update_id, value)
+    
+    def get_updates(self, offset=None, limit=None, timeout=20, allowed_updates=None, long_polling_timeout=20):
+        json_updates = telebot.apihelper.get_updates(
+            self.token, offset=offset, limit=limit, timeout=timeout, allowed_updates=allowed_updates,
+            long_polling_timeout=long_polling_timeout)
+        return [parse_update(data) for data in json_updates]
+    
+    def _process_update(self, update):
+        with logger.request(update.update_id, chat_id=_update_chat_id(update), command=_update_command(update)):
+            super().process_new_updates([update])
+    
+    def process_new_updates(self, updates):
+        if self.router is not None:
+            # Процесс-приемщик только раздает обновления процессам-обработчикам
+            for update in updates:
+                self.last_update_id = update.update_id
+                self.router.route(update)
+            return
+        
+        if self.dispatcher is None:
+            for update in updates:
+                self._process_update(update)
+            return
+        
+        for update in updates:
+            self.last_update_id = update.update_id
+            self.dispatcher.submit(update)
+
+# Ограничения Telegram на исходящие вызовы
+TELEGRAM_RATE_LIMIT = os.getenv('TELEGRAM_RATE_LIMIT', '1') == '1'
+# Общий лимит бота; в режиме нескольких процессов делится между обработчиками (лимиты чата - нет: чат всегда в одном процессе)
+TELEGRAM_GLOBAL_RATE = worker_share(float(os.getenv('TELEGRAM_GLOBAL_RATE', '30')))
+TELEGRAM_CHAT_RATE = float(os.getenv('TELEGRAM_CHAT_RATE', '1'))
+TELEGRAM_CHAT_BURST = float(os.getenv('TELEGRAM_CHAT_BURST', '3'))
+TELEGRAM_GROUP_RATE = float(os.getenv('TELEGRAM_GROUP_RATE', str(20 / 60)))
+TELEGRAM_MAX_RETRIES = int(os.getenv('TELEGRAM_MAX_RETRIES', '3'))
+TELEGRAM_MAX_RETRY_AFTER = float(os.getenv('TELEGRAM_MAX_RETRY_AFTER', '30'))
+
+# Индикаторы действия пропускают ответы вперед и не расходуют лимит сообщений чата
+TELEGRAM_LOW_PRIORITY_METHODS = frozenset({'sendChatAction'})
+
+class _TokenBucket:
+    """Корзина токенов с возможной блокировкой до момента, указанного в retry_after"""
+    __slots__ = ('rate', 'capacity', 'tokens', 'updated', 'blocked_until')
+    
+    def __init__(self, rate, capacity, now):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = now
+        self.blocked_until = 0.0
+    
+    def refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+    
+    def ready_at(self, now):
+        """Момент, когда в корзине появится целый токен"""
+        ready = now if self.tokens >= 1 else now + (1 - self.tokens) / self.rate
+        return max(ready, self.blocked_until)
+
+class TelegramRateLimiter:
+    """
+    Ограничивает исходящие вызовы Bot API корзинами токенов: общей и отдельной для каждого чата.
+    Ожидающие вызовы получают токены в порядке приоритета, ответ 429 блокирует
+    чат на retry_after секунд, после чего вызов повторяется.
+    """
+    
+    def __init__(self, global_rate=TELEGRAM_GLOBAL_RATE, chat_rate=TELEGRAM_CHAT_RATE, chat_burst=TELEGRAM_CHAT_BURST,
+                 group_rate=TELEGRAM_GROUP_RATE, max_retries=TELEGRAM_MAX_RETRIES, max_retry_after=TELEGRAM_MAX_RETRY_AFTER):
+        now = time.monotonic()
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.group_rate = group_rate
+        self.max_retries = max_retries
+        self.max_retry_after = max_retry_after
+        self._condition = threading.Condition()
+        self._global = _TokenBucket(global_rate, max(1.0, global_rate), now)
+        self._chats = {}
+        # Ожидающие вызовы: [приоритет, порядковый номер, ID чата, расходует ли лимит чата, выдан ли токен]
+        self._waiting = []
+        self._sequence = itertools.count()
+        self._sessions = threading.local()
+        self.stats = {'calls': 0, 'throttled': 0, 'retry_after': 0, 'max_queue': 0, 'wait_total': 0.0, 'wait_max': 0.0}
+    
+    def _chat_bucket(self, chat_id, now):
+        bucket = self._chats.get(chat_id)
+        if bucket is None:
+            # Группы и каналы (отрицательный ID или @username) ограничены сильнее личных чатов
+            if isinstance(chat_id, str) or chat_id < 0:
+                bucket = _TokenBucket(self.group_rate, 1.0, now)
+            else:
+                bucket = _TokenBucket(self.chat_rate, max(1.0, self.chat_burst), now)
+            self._chats[chat_id] = bucket
+        bucket.refill(now)
+        return bucket
+    
+    def _prune(self, now):
+        """Убирает корзины простаивающих чатов, чтобы словарь не рос бесконечно"""
+        waiting = {entry[2] for entry in self._waiting}
+        for chat_id, bucket in list(self._chats.items()):
+            if chat_id not in waiting and bucket.blocked_until <= now:
+                bucket.refill(now)
+                if bucket.tokens >= bucket.capacity:
+                    del self._chats[chat_id]
+    
+    def _grant(self, now):
+        """Выдает токены ожидающим вызовам по приоритету; возвращает время следующей проверки"""
+        self._global.refill(now)
+        next_check = None
+        remaining = []
+        granted = False
+        for entry in sorted(self._waiting):
+            ready = self._global.ready_at(now)
+            bucket = self._chat_bucket(entry[2], now) if entry[3] else None
+            if bucket is not None:
+                ready = max(ready, bucket.ready_at(now))
+            if ready <= now:
+                self._global.tokens -= 1
+                if bucket is not None:
+                    bucket.tokens -= 1
+                entry[4] = granted = True
+            else:
+                remaining.append(entry)
+                next_check = ready if next_check is None else min(next_check, ready)
+        self._waiting = remaining
+        if granted:
+            self._condition.notify_all()
+        if len(self._chats) > 10000:
+            self._prune(now)
+        return next_check
+    
+    def _enqueue(self, chat_id, method_name):
+        low = method_name in TELEGRAM_LOW_PRIORITY_METHODS
+        entry = [1 if low else 0, next(self._sequence), chat_id, not low, False]
+        self._waiting.append(entry)
+        self.stats['calls'] += 1
+        self.stats['max_queue'] = max(self.stats['max_queue'], len(self._waiting))
+        return entry
+    
+    def _record_wait(self, started, throttled):
+        waited = time.monotonic() - started
+        self.stats['throttled'] += throttled
+        self.stats['wait_total'] += waited
+        self.stats['wait_max'] = max(self.stats['wait_max'], waited)
+    
+    def acquire(self, chat_id, method_name):
+        """Блокирует поток, пока вызов не уложится в лимиты"""
+        started = time.monotonic()
+        throttled = False
+        with self._condition:
+            entry = self._enqueue(chat_id, method_name)
+            while True:
+                now = time.monotonic()
+                next_check = self._grant(now)
+                if entry[4]:
+                    break
+                throttled = True
+                self._condition.wait(max(0.001, next_check - now) if next_check else None)
+            self._record_wait(started, throttled)
+    
+    async def acquire_async(self, chat_id, method_name):
+        """Асинхронный acquire: ожидание не блокирует событийный цикл"""
+        started = time.monotonic()
+        throttled = False
+        with self._condition:
+            entry = self._enqueue(chat_id, method_name)
+        try:
+            while True:
+                with self._condition:
+                    now = time.monotonic()
+                    next_check = self._grant(now)
+                    if entry[4]:
+                        self._record_wait(started, throttled)
+                        return
+                throttled = True
+                await asyncio.sleep(max(0.001, next_check - now) if next_check else 0.05)
+        finally:
+            if not entry[4]:
+                with self._condition:
+                    if entry in self._waiting:
+                        self._waiting.remove(entry)
+    
+    def penalize(self, chat_id, retry_after):
+        """Запрещает вызовы в чат (или все вызовы, если чат неизвестен) на retry_after секунд"""
+        with self._condition:
+            now = time.monotonic()
+            bucket = self._chat_bucket(chat_id, now) if chat_id is not None else self._global
+            bucket.blocked_until = max(bucket.blocked_until, now + retry_after)
+            self.stats['retry_after'] += 1
+            self._condition.notify_all()
+    
+    def _retry_after(self, retry_after, attempt):
+        """Возвращает паузу перед повтором или None, если повторять не нужно"""
+        if retry_after is None or attempt >= self.max_retries or retry_after > self.max_retry_after:
+            return None
+        return retry_after
+    
+    @staticmethod
+    def _chat_id(params):
+        chat_id = (params or {}).get('chat_id')
+        if isinstance(chat_id, str) and chat_id.lstrip('-').isdigit():
+            return int(chat_id)
+        return chat_id
+    
+    def send(self, method, url, **kwargs):
+        """Отправитель запросов для telebot.apihelper.CUSTOM_REQUEST_SENDER"""
+        method_name = url.rsplit('/', 1)[-1]
+        chat_id = self._chat_id(kwargs.get('params'))
+        session = getattr(self._sessions, 'session', None)
+        if session is None:
+            session = self._sessions.session = requests.Session()
+        
+        attempt = 0
+        while True:
+            if chat_id is not None:
+                self.acquire(chat_id, method_name)
+            response = session.request(method, url, **kwargs)
+            retry_after = None
+            if response.status_code == 429:
+                try:
+                    retry_after = float(response.json()['parameters']['retry_after'])
+                except Exception:
+                    retry_after = 1.0
+            retry_after = self._retry_after(retry_after, attempt)
+            if retry_after is None:
+                return response
+            
+            logger.warning(f"Telegram ограничил {method_name} для чата {chat_id}, повтор через {retry_after:.0f} с")
+            self.penalize(chat_id, retry_after)
+            # Загружаемые файлы уже прочитаны - перематываем их перед повтором
+            for value in (kwargs.get('files') or {}).values():
+                stream = value[1] if isinstance(value, tuple) else value
+                if hasattr(stream, 'seek'):
+                    stream.seek(0)
+            attempt += 1
+    
+    def wrap_async(self, process_request):
+        """Оборачивает telebot.asyncio_helper._process_request ограничителем"""
+        async def limited_request(token, url, method='get', params=None, files=None, **kwargs):
+            chat_id = self._chat_id(params)
+            attempt = 0
+            while True:
+                if chat_id is not None:
+                    await self.acquire_async(chat_id, url)
+                try:
+                    return await process_request(token, url, method=method, params=params, files=files, **kwargs)
+                except telebot.asyncio_helper.ApiTelegramException as e:
+                    retry_after = (e.result_json.get('parameters') or {}).get('retry_after') if e.error_code == 429 else None
+                    retry_after = self._retry_after(retry_after, attempt)
+                    if retry_after is None:
+                        raise
+                    logger.warning(f"Telegram ограничил {url} для чата {chat_id}, повтор через {retry_after:.0f} с")
+                    self.penalize(chat_id, retry_after)
+                    attempt += 1
+        
+        limited_request.rate_limited = True
+        return limited_request
+    
+    def get_stats(self):
+        with self._condition:
+            stats = dict(self.stats)
+            stats['queue_length'] = len(self._waiting)
+            stats['wait_avg'] = stats['wait_total'] / stats['calls'] if stats['calls'] else 0.0
+        return stats
+
+telegram_limiter = TelegramRateLimiter()
+
+# Адрес Bot API - шаблон "http://host:port/bot{0}/{1}" (например, свой telegram-bot-api);
+# задается окружением, чтобы его получили и процессы-обработчики
+TELEGRAM_API_URL = os.getenv('TELEGRAM_API_URL', '')
+
 # Инициализируем бота
-bot = telebot.TeleBot(TELEGRAM_TOKEN, threaded=False)
+bot = DispatchingTeleBot(TELEGRAM_TOKEN, workers=DISPATCHER_WORKERS, fast_workers=DISPATCHER_FAST_WORKERS)
 
 def is_admin(user_id):
     """Проверяет, является ли пользователь администратором"""
     return str(user_id) == ADMIN_ID
 
+# Словари для форматирования ответа (компилируются один раз при загрузке модуля)
+CHARACTER_NAMES = ('Онегин', 'Татьяна', 'Раскольников', 'Соня', 'Мастер',
+                   'Маргарита', 'Пьер', 'Наташа', 'Андрей')
+
+LITERARY_TERMS = ('композиция', 'сюжет', 'фабула', 'конфликт', 'образ', 'персонаж',
+                  'характер', 'пейзаж', 'интерьер', 'диалог', 'монолог', 'символ',
+                  'метафора', 'эпитет', 'гипербола', 'аллегория', 'антитеза',
+                  'гротеск', 'ирония', 'сатира', 'лирика', 'эпос', 'драма')
+
+_CHARACTER_NAMES_LOWER = frozenset(name.lower() for name in CHARACTER_NAMES)
+_LITERARY_TERMS_LOWER = frozenset(term.lower() for term in LITERARY_TERMS)
+
+_BLANK_LINES_RE = re.compile(r'\n\s*\n\s*\n')
+_HEADER_RE = re.compile(r'^(#+)\s*(.+)$', re.MULTILINE)
+_SUBHEADER_RE = re.compile(r'^(\d+\.\s+[^:\n]+:|[А-Я][^:\n]+:)\s*$', re.MULTILINE)
+
+# Разбор строки: маркированный список, нумерованный список, "термин - определение"
+_LINE_RE = re.compile(
+    r'\s*[-•*]\s+(?P<item>.+)'
+    r'|\s*\d+\.\s+(?P<number>.+)'
+    r'|(?P<term>[^-\n]+)\s+-\s+(?P<definition>.+)$'
+)
+_LINE_QUOTE_RES = (re.compile(r'«[^»]+»'), re.compile(r'"[^"]+"'), re.compile(r"'[^']+'"))
+
+# Все inline-правила объединены в один шаблон и применяются за один проход по тексту
+_INLINE_RE = re.compile(
+    r'(?P<run>\b[А-ЯЁA-Z][а-яёa-z]+(?:\s+[А-ЯЁA-Z][а-яёa-z]+)*\b)'
+    r'|(?P<word>\b(?i:' + '|'.join(CHARACTER_NAMES + LITERARY_TERMS) + r')\b)'
+    r'|(?P<year>\b(?P<digits>\d{4})(?:\s*года?)?\b)'
+    r'|(?P<quote>[«»"])'
+)
+_WHITESPACE_SPLIT_RE = re.compile(r'(\s+)')
+
+# Максимальное число слов в ключевом термине
+KEY_TERM_MAX_WORDS = 3
+
+def _format_word(word):
+    """Выделяет имя персонажа курсивом, а литературный термин - жирным"""
+    lowered = word.lower()
+    if lowered in _CHARACTER_NAMES_LOWER:
+        return f"<i>{word}</i>"
+    if lowered in _LITERARY_TERMS_LOWER:
+        return f"<b>{word}</b>"
+    return word
+
+def _format_key_terms(words, separators, key_terms, limit):
+    """
+    Выделяет ключевые термины внутри последовательности слов с заглавной буквы.
+    Сначала выбирается самый длинный термин, затем более короткие внутри него.
+    """
+    pieces = []
+    i = 0
+    while i < len(words):
+        for size in range(min(limit, len(words) - i), 0, -1):
+            candidate = words[i]
+            for j in range(i + 1, i + size):
+                candidate += separators[j - 1] + words[j]
+            if candidate in key_terms:
+                inner = _format_key_terms(words[i:i + size], separators[i:i + size - 1], key_terms, size - 1)
+                pieces.append(f"<b>{inner}</b>")
+                break
+        else:
+            size = 1
+            pieces.append(_format_word(words[i]))
+        i += size
+        if i < len(words):
+            pieces.append(separators[i - 1])
+    return ''.join(pieces)
+
+def _format_lines(text):
+    """Форматирует списки, определения и цитаты построчно"""
+    formatted_lines = []
+    
+    for line in text.split('\n'):
+        if not line.strip():
+            formatted_lines.append('')
+            continue
+        
+        line_match = _LINE_RE.match(line)
+        if line_match:
+            if line_match.group('item') is not None:
+                formatted_lines.append(f"• {line_match.group('item')}")
+            elif line_match.group('number') is not None:
+                formatted_lines.append(line_match.group('number'))
+            else:
+                formatted_lines.append(f"<b>{line_match.group('term').strip()}</b> - {line_match.group('definition')}")
+            continue
+        
+        if '«' in line or '"' in line or "'" in line:
+            for quote_re in _LINE_QUOTE_RES:
+                line = quote_re.sub(r'<i>\g<0></i>', line)
+        formatted_lines.append(line)
+    
+    return '\n'.join(formatted_lines)
+
+def _format_inline(text):
+    """
+    Выделяет ключевые термины, имена персонажей, литературные термины,
+    годы и названия произведений за один проход по тексту
+    """
+    pieces = []
+    runs = []
+    position = 0
+    guillemet_close = -1
+    quote_close = -1
+    
+    for match in _INLINE_RE.finditer(text):
+        start = match.start()
+        pieces.append(text[position:start])
+        position = match.end()
+        kind = match.lastgroup
+        
+        if kind == 'run':
+            # Ключевые термины известны только после полного прохода
+            runs.append((len(pieces), match.group()))
+            pieces.append('')
+        elif kind == 'word':
+            pieces.append(_format_word(match.group()))
+        elif kind == 'year':
+            pieces.append(f"<code>{match.group('digits')}</code>")
+        else:
+            char = match.group()
+            if char == '«' and guillemet_close < start:
+                close = text.find('»', start + 1)
+                if close > start + 1:
+                    guillemet_close = close
+                    char = '<i>«'
+            elif char == '»' and start == guillemet_close:
+                char = '»</i>'
+            elif char == '"':
+                if start == quote_close:
+                    char = '"</i>'
+                elif quote_close < start:
+                    close = text.find('"', start + 1)
+                    if close > start + 1:
+                        quote_close = close
+                        char = '<i>"'
+            pieces.append(char)
+    
+    pieces.append(text[position:])
+    
+    key_terms = {run for _, run in runs if len(run.split()) <= KEY_TERM_MAX_WORDS}
+    for index, run in runs:
+        parts = _WHITESPACE_SPLIT_RE.split(run)
+        pieces[index] = _format_key_terms(parts[::2], parts[1::2], key_terms, KEY_TERM_MAX_WORDS)
+    
+    return ''.join(pieces)
+
+@metrics.timed('format')
 def format_ai_response(text):
     """
     Форматирует текст от нейросети, добавляя HTML-разметку
@@ -32,94 +1064,130 @@ def format_ai_response(text):
     """
     try:
         # Убираем лишние пробелы и переносы
-        text = re.sub(r'\n\s*\n\s*\n', '\n\n', text)
+        text = _BLANK_LINES_RE.sub('\n\n', text)
         
         # Форматируем заголовки
-        text = re.sub(r'^(#+)\s*(.+)$', lambda m: f"<b>{m.group(2)}</b>\n", text, flags=re.MULTILINE)
+        text = _HEADER_RE.sub(lambda m: f"<b>{m.group(2)}</b>\n", text)
         
         # Форматируем подзаголовки
-        text = re.sub(r'^(\d+\.\s+[^:\n]+:|[А-Я][^:\n]+:)\s*$', lambda m: f"<b>{m.group(1)}</b>", text, flags=re.MULTILINE)
+        text = _SUBHEADER_RE.sub(lambda m: f"<b>{m.group(1)}</b>", text)
         
         # Форматируем списки
-        lines = text.split('\n')
-        formatted_lines = []
-        
-        for i, line in enumerate(lines):
-            if not line.strip():
-                formatted_lines.append('')
-                continue
-            
-            list_match = re.match(r'^(\s*[-•*]\s+)(.+)', line)
-            if list_match:
-                prefix, content = list_match.groups()
-                formatted_lines.append(f"• {content}")
-                continue
-            
-            num_match = re.match(r'^(\s*\d+\.\s+)(.+)', line)
-            if num_match:
-                prefix, content = num_match.groups()
-                formatted_lines.append(f"{content}")
-                continue
-            
-            term_match = re.match(r'^([^-\n]+)\s+-\s+(.+)$', line)
-            if term_match:
-                term, definition = term_match.groups()
-                formatted_lines.append(f"<b>{term.strip()}</b> - {definition}")
-                continue
-            
-            if '«' in line or '"' in line or "'" in line:
-                def format_quote(match):
-                    return f"<i>{match.group(0)}</i>"
-                
-                line = re.sub(r'«[^»]+»', format_quote, line)
-                line = re.sub(r'"[^"]+"', format_quote, line)
-                line = re.sub(r"'[^']+'", format_quote, line)
-                formatted_lines.append(line)
-                continue
-            
-            if len(line) > 100 and not any(tag in line for tag in ['<b>', '<i>', '<code>']):
-                formatted_lines.append(line)
-            else:
-                formatted_lines.append(line)
-        
-        text = '\n'.join(formatted_lines)
-        
-        # Добавляем форматирование для ключевых терминов
-        key_terms = re.findall(r'\b([А-ЯЁA-Z][а-яёa-z]+(?:\s+[А-ЯЁA-Z][а-яёa-z]+)*)\b', text)
-        for term in set(key_terms):
-            if len(term.split()) <= 3:
-                text = re.sub(rf'\b{re.escape(term)}\b', f"<b>{term}</b>", text)
-        
-        # Форматируем имена персонажей
-        text = re.sub(r'\b(Онегин|Татьяна|Раскольников|Соня|Мастер|Маргарита|Пьер|Наташа|Андрей)\b', 
-                     lambda m: f"<i>{m.group(1)}</i>", text, flags=re.IGNORECASE)
-        
-        # Добавляем форматирование для литературных терминов
-        literary_terms = ['композиция', 'сюжет', 'фабула', 'конфликт', 'образ', 'персонаж', 
-                         'характер', 'пейзаж', 'интерьер', 'диалог', 'монолог', 'символ', 
-                         'метафора', 'эпитет', 'гипербола', 'аллегория', 'антитеза', 
-                         'гротеск', 'ирония', 'сатира', 'лирика', 'эпос', 'драма']
-        
-        for term in literary_terms:
-            text = re.sub(rf'\b({term})\b', rf"<b>\1</b>", text, flags=re.IGNORECASE)
-        
-        # Форматируем годы
-        text = re.sub(r'\b(\d{4})(?:\s*года?)?\b', r'<code>\1</code>', text)
-        
-        # Форматируем названия произведений
-        text = re.sub(r'«([^»]+)»', r'<i>«\1»</i>', text)
-        text = re.sub(r'"([^"]+)"', r'<i>"\1"</i>', text)
+        text = _format_lines(text)
         
-        return text
+        # Ключевые термины, имена, литературные термины, годы и названия
+        return _format_inline(text)
         
     except Exception as e:
-        print(f"[ERROR] Ошибка при форматировании текста: {e}")
+        logger.error(f"Ошибка при форматировании текста: {e}")
         return text
 
-def send_welcome_with_image(chat_id, max_retries=3):
-    """Отправляет приветственное сообщение с изображением с повторными попытками"""
+# Кэш file_id загруженных в Telegram изображений (ключ - SHA-256 содержимого файла)
+MEDIA_CACHE_PATH = "media_cache.json"
+
+_media_cache = None
+_media_hashes = {}
+_media_cache_lock = threading.Lock()
+
+def _load_media_cache():
+    """Загружает кэш file_id с диска (один раз за время работы процесса)"""
+    global _media_cache
+    if _media_cache is None:
+        try:
+            with open(MEDIA_CACHE_PATH, 'r', encoding='utf-8') as cache_file:
+                _media_cache = json.load(cache_file)
+        except (OSError, ValueError):
+            _media_cache = {}
+    return _media_cache
+
+def _save_media_cache():
+    """Атомарно сохраняет кэш file_id на диск"""
+    # Временный файл свой у каждого процесса: в режиме нескольких процессов кэш пишут обработчики
+    temp_path = f"{MEDIA_CACHE_PATH}.{os.getpid()}.tmp"
+    with open(temp_path, 'w', encoding='utf-8') as cache_file:
+        json.dump(_media_cache, cache_file, ensure_ascii=False, indent=2)
+    os.replace(temp_path, MEDIA_CACHE_PATH)
+
+def _file_digest(path):
+    """Возвращает SHA-256 файла; пересчитывает только при изменении размера или времени изменения"""
+    stat = os.stat(path)
+    signature = (stat.st_size, stat.st_mtime_ns)
+    cached = _media_hashes.get(path)
+    if cached and cached[0] == signature:
+        return cached[1]
+    
+    sha256 = hashlib.sha256()
+    with open(path, 'rb') as media_file:
+        for chunk in iter(lambda: media_file.read(65536), b''):
+            sha256.update(chunk)
+    digest = sha256.hexdigest()
+    _media_hashes[path] = (signature, digest)
+    return digest
+
+def _cached_file_id(image_path):
+    """Возвращает (хэш файла, сохраненный file_id или None)"""
+    with _media_cache_lock:
+        digest = _file_digest(image_path)
+        return digest, _load_media_cache().get(digest)
+
+def _file_id_rejected(error):
+    """
+    True, если Telegram отклонил сам file_id (400 "wrong file identifier" и т.п.);
+    остальные ошибки (403, 429, сбои сети) к file_id не относятся
+    """
+    description = str(getattr(error, 'description', '')).lower()
+    return error.error_code == 400 and ('file identifier' in description or 'file_id' in description)
+
+def _photo_retry_delay(error, attempt):
+    """Пауза перед повторной отправкой изображения; None - повторять бесполезно (бот заблокирован)"""
+    error_code = getattr(error, 'error_code', None)
+    if error_code == 403:
+        return None
+    delay = 2 * (attempt + 1)
+    if error_code == 429:
+        retry_after = (error.result_json.get('parameters') or {}).get('retry_after')
+        delay = max(delay, retry_after or 0)
+    return delay
+
+def _forget_file_id(image_path, digest, file_id, error):
+    """Удаляет file_id, который Telegram отказался принять"""
+    logger.warning(f"Telegram отклонил сохраненный file_id для {image_path}: {error}")
+    with _media_cache_lock:
+        if _media_cache.get(digest) == file_id:
+            del _media_cache[digest]
+            _save_media_cache()
+
+def _remember_file_id(image_path, digest, sent_msg):
+    """Сохраняет file_id загруженного изображения"""
+    if sent_msg.photo:
+        with _media_cache_lock:
+            _media_cache[digest] = sent_msg.photo[-1].file_id
+            _save_media_cache()
+        logger.debug(f"file_id для {image_path} сохранен в кэш")
+
+@metrics.timed('send_photo')
+def send_cached_photo(chat_id, image_path, timeout=30):
+    """
+    Отправляет изображение по сохраненному file_id, а если его нет
+    (или Telegram отклонил именно его) - загружает файл и запоминает новый file_id
+    """
+    digest, file_id = _cached_file_id(image_path)
+    
+    if file_id:
+        try:
+            return bot.send_photo(chat_id, file_id, timeout=timeout)
+        except telebot.apihelper.ApiTelegramException as e:
+            if not _file_id_rejected(e):
+                raise
+            _forget_file_id(image_path, digest, file_id, e)
     
-    start_text = """<b>Привет, я Pushkin AI!</b>
+    with open(image_path, 'rb') as photo:
+        sent_msg = bot.send_photo(chat_id, photo, timeout=timeout)
+    _remember_file_id(image_path, digest, sent_msg)
+    return sent_msg
+
+# Приветствие для /start и /help
+WELCOME_TEXT = """<b>Привет, я Pushkin AI!</b>
 
 Я специализируюсь на анализе литературных произведений.
 
@@ -133,125 +1201,138 @@ def send_welcome_with_image(chat_id, max_retries=3):
 • "Мастер и Маргарита, Михаил Булгаков"
 
 <code>Важно:</code> Я занимаюсь только разбором литературных произведений"""
+
+WELCOME_IMAGE_PATH = "main.png"
+
+@metrics.timed('welcome')
+def send_welcome_with_image(chat_id, max_retries=3):
+    """Отправляет приветственное сообщение с изображением с повторными попытками"""
     
     # Сначала отправляем текстовое сообщение
     try:
-        bot.send_message(chat_id, start_text, parse_mode='HTML')
-        print(f"[LOG] Текстовое приветствие отправлено в чат {chat_id}")
+        bot.send_message(chat_id, WELCOME_TEXT, parse_mode='HTML')
+        logger.info(f"Текстовое приветствие отправлено в чат {chat_id}")
     except Exception as e:
-        print(f"[ERROR] Ошибка при отправке текста: {e}")
+        logger.error(f"Ошибка при отправке текста: {e}")
     
     # Затем пытаемся отправить изображение с повторными попытками
-    image_path = "main.png"
+    image_path = WELCOME_IMAGE_PATH
     
     if not os.path.exists(image_path):
-        print(f"[WARNING] Файл {image_path} не найден.")
+        logger.warning(f"Файл {image_path} не найден.")
         return
     
     for attempt in range(max_retries):
         try:
-            print(f"[LOG] Попытка {attempt + 1} отправки изображения...")
+            logger.debug(f"Попытка {attempt + 1} отправки изображения...")
             
-            with open(image_path, 'rb') as photo:
-                bot.send_photo(chat_id, photo, timeout=30)
-                print(f"[LOG] Изображение успешно отправлено в чат {chat_id}")
-                break
+            send_cached_photo(chat_id, image_path, timeout=30)
+            logger.info(f"Изображение успешно отправлено в чат {chat_id}")
+            break
                 
         except Exception as e:
-            print(f"[ERROR] Ошибка при отправке изображения (попытка {attempt + 1}): {type(e).__name__}: {e}")
+            logger.error(f"Ошибка при отправке изображения (попытка {attempt + 1}): {type(e).__name__}: {e}")
+            wait_time = _photo_retry_delay(e, attempt)
+            if wait_time is None:
+                break
             if attempt < max_retries - 1:
-                wait_time = 2 * (attempt + 1)
-                print(f"[LOG] Ожидание {wait_time} секунд перед повторной попыткой...")
+                logger.info(f"Ожидание {wait_time} секунд перед повторной попыткой...")
                 time.sleep(wait_time)
             else:
-                print(f"[ERROR] Не удалось отправить изображение после {max_retries} попыток")
+                logger.error(f"Не удалось отправить изображение после {max_retries} попыток")
                 break
 
 @bot.message_handler(commands=["start", "help"])
 def start_handler(message):
     """Обработчик команд /start и /help"""
-    print(f"[LOG] Получена команда /start от пользователя {message.from_user.id}")
+    logger.info(f"Получена команда /start от пользователя {message.from_user.id}")
     send_welcome_with_image(message.chat.id)
 
 @bot.message_handler(commands=["reset"])
 def reset_handler(message):
-    """Команда для сброса и перезапуска бота (только для администратора)"""
+    """
+    Перезапуск бота без простоя (только для администратора):
+    /reset - новый процесс с текущим кодом принимает обновления вместо этого,
+    /reset config - перечитать настройки из .env без перезапуска.
+    В режиме нескольких процессов /reset перезапускает обработчики по одному,
+    /reset worker N - только N-й, /reset config - перечитывают настройки все
+    """
     user_id = message.from_user.id
     
     if not is_admin(user_id):
-        print(f"[SECURITY] Неавторизованная попытка сброса от пользователя {user_id}")
+        logger.warning(f"Неавторизованная попытка сброса от пользователя {user_id}", category='security')
         bot.send_message(message.chat.id, "⛔ У вас нет прав для выполнения этой команды.")
         return
     
-    print(f"[ADMIN] Запрошен сброс системы пользователем {user_id}")
+    mode = _command_argument(message).lower()
+    logger.info(f"Запрошен сброс системы пользователем {user_id}", category='admin')
     
     # Отправляем подтверждение
     confirm_msg = bot.send_message(
         message.chat.id,
         "<b>🔄 Запущен процесс сброса системы...</b>\n\n"
-        "<i>Статус:</i> Очистка кэша и перезапуск...",
+        "<i>Статус:</i> Очистка временных файлов...",
         parse_mode='HTML'
     )
     
     try:
         # Шаг 1: Логируем событие
-        log_message = f"""
-        ⚠️ АДМИНИСТРАТИВНОЕ ДЕЙСТВИЕ ⚠️
-        
-        Инициатор: {message.from_user.id} ({message.from_user.username})
-        Время: {time.strftime('%Y-%m-%d %H:%M:%S')}
-        Действие: СБРОС И ПЕРЕЗАПУСК СИСТЕМЫ
-        """
-        print(log_message)
+        action = 'ПЕРЕЧИТЫВАНИЕ НАСТРОЕК' if mode == 'config' else 'ПЕРЕЗАПУСК СИСТЕМЫ'
+        logger.warning(f"⚠️ АДМИНИСТРАТИВНОЕ ДЕЙСТВИЕ: {action}, инициатор {user_id} ({message.from_user.username})",
+                       category='admin', action=mode or 'reload', user_id=user_id)
         
-        # Шаг 2: Обновляем статус
-        bot.edit_message_text(
-            "<b>🔄 Запущен процесс сброса системы...</b>\n\n"
-            "<i>Статус:</i> Останавливаю бота...",
-            message.chat.id,
-            confirm_msg.message_id,
-            parse_mode='HTML'
-        )
-        
-        # Шаг 3: Останавливаем polling (это остановит текущий процесс)
-        bot.stop_polling()
-        time.sleep(2)
-        
-        # Шаг 4: Обновляем статус
-        bot.edit_message_text(
-            "<b>🔄 Запущен процесс сброса системы...</b>\n\n"
-            "<i>Статус:</i> Бот остановлен. Перезапускаюсь...",
-            message.chat.id,
-            confirm_msg.message_id,
-            parse_mode='HTML'
-        )
-        
-        # Шаг 5: Очищаем любые временные файлы или кэш
+        # Шаг 2: Очищаем любые временные файлы или кэш
         temp_files = ['temp_optimized.png', 'temp_response.txt']
         for temp_file in temp_files:
             if os.path.exists(temp_file):
                 try:
                     os.remove(temp_file)
-                    print(f"[ADMIN] Удален временный файл: {temp_file}")
+                    logger.info(f"Удален временный файл: {temp_file}", category='admin')
                 except:
                     pass
         
-        # Шаг 6: Записываем логи о перезапуске
-        with open('restart.log', 'a') as log_file:
-            log_file.write(f"[{time.strftime('%Y-%m-%d %H:%M:%S')}] Перезапуск инициирован пользователем {user_id}\n")
+        # Шаг 3: Записываем логи о перезапуске (явно в UTF-8: кодировка системы по умолчанию бывает cp1251)
+        with open('restart.log', 'a', encoding='utf-8') as log_file:
+            log_file.write(f"[{time.strftime('%Y-%m-%d %H:%M:%S')}] Перезапуск инициирован пользователем {user_id}"
+                           f"{' (настройки)' if mode == 'config' else ''}\n")
         
-        # Шаг 7: Отправляем финальное сообщение
-        final_message = f"""
-<b>✅ Сброс системы выполнен успешно!</b>
+        # Шаг 4: Перечитываем настройки в этом процессе или передаем работу новому
+        from bot_supervisor import supervisor
+        from bot_workers import ingester_request
+        if WORKER_INDEX is not None:
+            worker = mode.split()[1] if mode.startswith('worker') and len(mode.split()) > 1 else None
+            if mode == 'config':
+                reply = ingester_request('reload_config')
+            else:
+                reply = ingester_request('restart', worker=int(worker) - 1 if worker and worker.isdigit() else None)
+            target = f"обработчик {worker}" if worker else f"обработчики (их {WORKER_COUNT}) по одному"
+            final_message = f"""
+<b>{'✅ Настройки перечитываются' if mode == 'config' else '🔄 Перезапускаю ' + target}</b>
 
-<i>Выполненные действия:</i>
-• Бот остановлен
-• Временные файлы очищены
-• Система перезапускается
+<i>Статус:</i> {('Приемщик передал команду всем обработчикам' if mode == 'config' else 'Новый процесс сразу принимает обновления, прежний дорабатывает начатое') if reply.get('started') else 'Не начато: ' + html.escape(str(reply.get('error', 'перезапуск уже выполняется')))}
+<i>Время выполнения:</i> {time.strftime('%H:%M:%S')}
+            """
+        elif mode == 'config':
+            changed = reload_settings()
+            final_message = f"""
+<b>✅ Настройки перечитаны</b>
 
+<i>Изменены:</i> {', '.join(changed) if changed else 'нет'}
 <i>Время выполнения:</i> {time.strftime('%H:%M:%S')}
-<i>Статус:</i> Переход в режим ожидания...
-        """
+<i>Статус:</i> Бот работает без перерыва
+            """
+        elif supervisor.reload_code(notify=(message.chat.id, confirm_msg.message_id)):
+            final_message = """
+<b>🔄 Запущен процесс сброса системы...</b>
+
+<i>Статус:</i> Запускаю новый процесс. Этот продолжает отвечать, пока новый не будет готов...
+            """
+        else:
+            final_message = """
+<b>⚠️ Перезапуск не начат</b>
+
+<i>Причина:</i> перезапуск уже выполняется или прием обновлений еще не запущен.
+            """
         
         bot.edit_message_text(
             final_message,
@@ -260,26 +1341,11 @@ def reset_handler(message):
             parse_mode='HTML'
         )
         
-        print("[ADMIN] Сброс завершен. Перезапускаю бота через 3 секунды...")
-        
-        # Шаг 8: Перезапускаем бота
-        time.sleep(3)
-        
-        # Способ 1: Перезапуск через subprocess (рекомендуется)
-        python_executable = sys.executable
-        script_path = os.path.abspath(__file__)
-        
-        # Запускаем новый процесс
-        subprocess.Popen([python_executable, script_path])
-        
-        # Шаг 9: Завершаем текущий процесс
-        sys.exit(0)
-        
     except Exception as e:
         error_message = f"""
 <b>❌ Ошибка при сбросе системы!</b>
 
-<i>Ошибка:</i> <code>{str(e)}</code>
+<i>Ошибка:</i> <code>{html.escape(str(e))}</code>
 
 Пожалуйста, перезапустите бота вручную.
         """
@@ -294,30 +1360,27 @@ def reset_handler(message):
         except:
             bot.send_message(message.chat.id, error_message, parse_mode='HTML')
         
-        print(f"[ERROR] Ошибка при выполнении сброса: {e}")
+        logger.error(f"Ошибка при выполнении сброса: {e}")
 
 @bot.message_handler(commands=["image"])
 def image_handler(message):
     """Отправляет только изображение по команде /image"""
     try:
-        image_path = "main.png"
+        image_path = WELCOME_IMAGE_PATH
         if os.path.exists(image_path):
-            print(f"[LOG] Отправка изображения по команде /image в чат {message.chat.id}")
+            logger.info(f"Отправка изображения по команде /image в чат {message.chat.id}")
             
-            with open(image_path, 'rb') as photo:
-                bot.send_photo(message.chat.id, photo, timeout=30)
-            print(f"[LOG] Изображение отправлено по команде /image")
+            send_cached_photo(message.chat.id, image_path, timeout=30)
+            logger.info("Изображение отправлено по команде /image")
                 
         else:
             bot.send_message(message.chat.id, "Изображение не найдено на сервере.")
     except Exception as e:
-        print(f"[ERROR] Ошибка при отправке изображения: {e}")
+        logger.error(f"Ошибка при отправке изображения: {e}")
         bot.send_message(message.chat.id, "Ошибка при отправке изображения.")
 
-@bot.message_handler(commands=["about"])
-def about_handler(message):
-    """Обработчик команды /about"""
-    about_text = """<b>Pushkin AI</b>
+# Информация о боте для /about
+ABOUT_TEXT = """<b>Pushkin AI</b>
     
 <i>Версия:</i> 1.0
 <i>Назначение:</i> Анализ литературных произведений
@@ -325,12 +1388,15 @@ def about_handler(message):
 <i>Разработчик:</i> [Ваше имя/организация]
     
 <code>По вопросам сотрудничества:</code> ваш_email@example.com"""
-    
-    bot.send_message(message.chat.id, about_text, parse_mode='HTML')
 
-@bot.message_handler(commands=["admin"])
-def admin_handler(message):
-    """Показывает информацию об административных командах"""
+@bot.message_handler(commands=["about"])
+def about_handler(message):
+    """Обработчик команды /about"""
+    bot.send_message(message.chat.id, ABOUT_TEXT, parse_mode='HTML')
+
+@bot.message_handler(commands=["admin"])
+def admin_handler(message):
+    """Показывает информацию об административных командах"""
     user_id = message.from_user.id
     
     if not is_admin(user_id):
@@ -343,9 +1409,14 @@ def admin_handler(message):
 <i>Время сервера:</i> {time.strftime('%Y-%m-%d %H:%M:%S')}
 
 <b>Доступные команды:</b>
-• /reset - Сбросить и перезапустить бота
+• /reset - Перезапустить бота без простоя (новый процесс)
+• /reset config - Перечитать настройки из .env
 • /status - Показать статус системы
 • /logs - Показать последние логи
+• /cache - Статистика и последние записи кэша анализов
+• /cache_show &lt;запрос&gt; - Показать запись кэша
+• /cache_purge &lt;запрос|all&gt; - Удалить запись или весь кэш
+• /cache_seed &lt;запрос&gt; - Сгенерировать и сохранить анализ заранее
 
 <b>Информация о системе:</b>
 • Python: {sys.version.split()[0]}
@@ -354,6 +1425,29 @@ def admin_handler(message):
     
     bot.send_message(message.chat.id, admin_text, parse_mode='HTML')
 
+# Этапы обработки, которые показываются в /status (полный набор - в экспорте Prometheus)
+STATUS_STAGES = ('request', 'classify', 'resolve', 'cache', 'admission_wait', 'llm_first_token', 'llm', 'format',
+                 'split', 'send_message', 'edit_message', 'welcome', 'send_photo')
+
+def format_resource_line(summary, label, unit):
+    """Строка /status: текущее значение, средние по окнам, максимум за самое длинное окно и спарклайн"""
+    windows = summary['windows']
+    averages = ' / '.join(f"{windows[window][0]:.0f}" if window in windows else '-' for window in ResourceSampler.WINDOWS)
+    longest = windows[max(windows)][1] if windows else summary['current']
+    return (f"• {label}: <b>{summary['current']:.0f}{unit}</b> · {averages} · макс. {longest:.0f} "
+            f"<code>{summary['sparkline']}</code>")
+
+def format_backend_line(stats):
+    """Строка /status об одной модели пула: исправность, победы, ошибки и задержка первого токена"""
+    def seconds(value):
+        return f"{value:.1f} с" if value is not None else '-'
+    
+    state = '✅' if stats['healthy'] else '⏸ пропускается после ошибок'
+    return (f"• {html.escape(stats['name'])} ({html.escape(stats['model'])}): {state}, ответил первым {stats['wins']} "
+            f"из {stats['attempts'] + stats['hedges']} (дублей {stats['hedges']}, отменено {stats['cancelled']}), "
+            f"ошибок {stats['failures']} (доля {stats['error_rate'] * 100:.0f}%), первый токен "
+            f"{seconds(stats['ewma']['first_token'])} / p95 {seconds(stats['p95']['first_token'])}")
+
 @bot.message_handler(commands=["status"])
 def status_handler(message):
     """Показывает статус системы"""
@@ -363,43 +1457,132 @@ def status_handler(message):
         bot.send_message(message.chat.id, "⛔ У вас нет прав для просмотра статуса.")
         return
     
-    # Собираем информацию о системе
-    import psutil
-    
+    # Показатели ресурсов и доступность API собираются в фоне: здесь только чтение готовых значений
     try:
-        # Использование памяти
-        memory = psutil.virtual_memory()
-        disk = psutil.disk_usage('/')
+        from bot_async import async_answer_flights, async_llm_pool
+        from bot_supervisor import supervisor
+        from bot_webhook import webhook_server
+        resources = resource_sampler.summary()
+        sampler_stats = resource_sampler.get_stats()
+        llm_stats = (async_llm_pool or llm_pool).get_stats()
+        cache_stats = analysis_cache.get_stats()
+        flight_stats = (async_answer_flights if BOT_RUNTIME == 'async' else answer_flights).get_stats()
+        dispatcher_stats = bot.dispatcher.get_stats() if bot.dispatcher else None
+        typing_stats = chat_actions.get_stats()
+        webhook_stats = webhook_server.get_stats() if webhook_server else None
+        limiter_stats = telegram_limiter.get_stats()
+        log_stats = logger.get_stats()
+        admission_stats = admission.get_stats()
+        stage_stats, counters = metrics.summary()
+        supervisor_stats = supervisor.get_stats()
+        classifier_stats = literature_classifier.get_stats()
+        resolver_stats = work_resolver.get_stats()
+        handoff_gap = supervisor_stats['handoff_gap']
+        backend_text = '\n'.join(format_backend_line(backend) for backend in llm_stats['backends'])
+        resource_text = '\n'.join(format_resource_line(resources[name], label, unit)
+                                  for name, label, unit, _ in ResourceSampler.SERIES if name in resources)
+        resource_text = resource_text or '• нет данных (сбор показателей не запущен)'
+        resource_text += (f"\n• Замер каждые {sampler_stats['interval']:g} с ({sampler_stats['source']}), "
+                          f"стоимость {sampler_stats['sample_time_avg'] * 1000:.2f} мс")
+        handoff_text = f", пауза при запуске этого процесса: {handoff_gap * 1000:.0f} мс" if handoff_gap is not None else ''
         
         status_text = f"""<b>📊 Статус системы</b>
 
 <i>Время сервера:</i> {time.strftime('%Y-%m-%d %H:%M:%S')}
 
-<b>Использование ресурсов:</b>
-• CPU: {psutil.cpu_percent()}%
-• RAM: {memory.percent}% ({memory.used / 1024 / 1024:.1f} MB / {memory.total / 1024 / 1024:.1f} MB)
-• Disk: {disk.percent}% ({disk.used / 1024 / 1024 / 1024:.1f} GB / {disk.total / 1024 / 1024 / 1024:.1f} GB)
+<b>Использование ресурсов</b> (сейчас, среднее за 1 / 5 / 15 мин, максимум за 15 мин):
+{resource_text}
 
 <b>Файлы системы:</b>
 • main.png: {'✅ найден' if os.path.exists('main.png') else '❌ не найден'}
 • .env: {'✅ найден' if os.path.exists('.env') else '❌ не найден'}
 
 <b>Процессы:</b>
-• Бот: ✅ запущен
-• Подключение к API: ✅ активно
+• Бот: ✅ запущен (PID {os.getpid()}, работает {supervisor_stats['uptime'] / 3600:.1f} ч)
+• Подключение к API: {llm_probes_text()}
+• Падений приема обновлений: {supervisor_stats['crashes']} (последняя задержка перезапуска {supervisor_stats['last_backoff']:.0f} с)
+• Перезапусков без простоя: {supervisor_stats['handoffs']}, отменено: {supervisor_stats['failed_handoffs']}{handoff_text}
+
+<b>Модель:</b>
+• Запросов: {llm_stats['requests']}, повторов: {llm_stats['retries']}, ошибок: {llm_stats['errors']}
+• Соединения: переиспользовано {llm_stats['connection_hits']}, новых {llm_stats['connection_misses']}
+• Дублировано медленных запросов: {llm_stats['hedged']} (дубль ответил первым: {llm_stats['hedge_wins']}, не отправлено - потоки заняты: {llm_stats['hedge_busy']}), передано другой модели после ошибки: {llm_stats['failovers']} (из них временно отключенной: {llm_stats['last_resort']})
+{backend_text}
+• Генераций: {admission_stats['active']} из {admission.max_active}, в очереди: {admission_stats['queue_length']} из {admission.queue_size} (пользователей: {admission_stats['waiting_users']})
+• Ожидание места: среднее {admission_stats['wait_avg']:.2f} с, максимум {admission_stats['wait_max']:.2f} с
+• Отклонено: частые запросы {admission_stats['rejected_rate']}, лимит пользователя {admission_stats['rejected_user']}, очередь полна {admission_stats['rejected_queue']}
+
+<b>Исходящие вызовы Telegram:</b>
+• В очереди: {limiter_stats['queue_length']} (максимум {limiter_stats['max_queue']}), всего вызовов: {limiter_stats['calls']}
+• Задержано ограничителем: {limiter_stats['throttled']}, ожидание: среднее {limiter_stats['wait_avg']:.2f} с, максимум {limiter_stats['wait_max']:.2f} с
+• Ответов 429 (retry_after): {limiter_stats['retry_after']}
+
+<b>Журнал:</b> {html.escape(logger.path) if logger.path else 'только консоль'}
+• Записано: {log_stats['written']} ({log_stats['batches']} пачек, наибольшая {log_stats['max_batch']}), в очереди: {log_stats['queued']}
+• Пропущено при перегрузке: {log_stats['dropped']}, ротаций: {log_stats['rotations']}, ошибок записи: {log_stats['write_errors']}
+
+<b>Кэш анализов:</b>
+• Записей: {cache_stats['entries']}, объем: {cache_stats['bytes'] / 1024 / 1024:.2f} MB
+• Попаданий: {cache_stats['hits']} из {cache_stats['hits'] + cache_stats['misses']} ({cache_stats['hit_ratio'] * 100:.1f}%)
+• Объединено одинаковых запросов: {flight_stats['coalesced']} (генераций сейчас: {flight_stats['in_flight']})
+• Распознано произведений: {resolver_stats['resolved']}, не найдено: {resolver_stats['unresolved']}, неоднозначно: {resolver_stats['ambiguous']} (в каталоге {resolver_stats['works']})
+• Ошибок общих генераций: {flight_stats['failed_calls']}, затронуто ожидавших: {flight_stats['failed_followers']}
+
+<b>Предварительная проверка запросов:</b> {'включена' if LITERATURE_FILTER else 'выключена'}
+• Проверено: {classifier_stats['checked']}, отказано без модели: {classifier_stats['rejected']}
+• Пропущено к модели: по каталогу {classifier_stats['catalog']}, по словам-признакам {classifier_stats['cue']}, по форме запроса {classifier_stats['form']}
 """
+        stage_lines = [
+            f"• {stage}: {stage_stats[stage]['p50'] * 1000:.1f} / {stage_stats[stage]['p95'] * 1000:.1f} / {stage_stats[stage]['p99'] * 1000:.1f} ({stage_stats[stage]['count']})"
+            for stage in STATUS_STAGES if stage in stage_stats
+        ]
+        if stage_lines:
+            status_text += "\n<b>Задержки, мс (p50 / p95 / p99, число):</b>\n" + '\n'.join(stage_lines) + '\n'
+        errors = sorted(
+            ((value, dict(labels)) for (name, labels), value in counters.items() if name == 'errors_total'),
+            key=lambda item: item[0], reverse=True
+        )
+        status_text += (f"\n<b>Токены:</b> запрос {llm_stats['prompt_tokens']}, ответ {llm_stats['completion_tokens']}\n"
+                        f"<b>Ошибки по типам:</b> " +
+                        (', '.join(f"{labels['stage']}/{labels['type']}: {value}" for value, labels in errors[:5]) or 'нет') + '\n')
         
-        bot.send_message(message.chat.id, status_text, parse_mode='HTML')
+        if dispatcher_stats:
+            status_text += f"""
+<b>Очередь обновлений:</b>
+• В очереди: {dispatcher_stats['queue_depth']} (максимум {dispatcher_stats['max_queue_depth']}), активных чатов: {dispatcher_stats['active_chats']}
+• Обработано: {dispatcher_stats['processed']} (быстрых: {dispatcher_stats['fast']}), ошибок: {dispatcher_stats['errors']}
+• Ожидание: среднее {dispatcher_stats['wait_avg']:.2f} с, максимум {dispatcher_stats['wait_max']:.2f} с
+• Индикаторы печати: активных чатов {typing_stats['active_chats']}, отправлено {typing_stats['sent']}, ошибок {typing_stats['failed']}
+"""
+        
+        if WORKER_INDEX is not None:
+            try:
+                router_stats = ingester_request('stats')
+                worker_lines = '\n'.join(
+                    f"• {number}: PID {worker['pid']} {'✅' if worker['alive'] else '❌'}, передано {worker['forwarded']}, "
+                    f"в очереди {worker['queue_depth']}, в обработке {worker['unfinished']}, падений {worker['crashes']} "
+                    f"(передано заново {worker['redelivered']}, потеряно начатых {worker['lost']}), перезапусков {worker['restarts']}"
+                    f"{' (этот)' if number == WORKER_INDEX + 1 else ''}"
+                    for number, worker in enumerate(router_stats['workers'], 1))
+                status_text += f"""
+<b>Обработчики</b> (чаты распределены по ID между {WORKER_COUNT} процессами, лимиты выше - доля этого процесса):
+• Передано обновлений: {router_stats['routed']}, перезапусков всех по очереди: {router_stats['rolling_restarts']}
+{worker_lines}
+"""
+            except (OSError, ValueError) as e:
+                status_text += f"\n<b>Обработчики:</b> приемщик недоступен ({html.escape(str(e))})\n"
+        
+        if webhook_stats:
+            status_text += f"""
+<b>Webhook:</b>
+• Принято: {webhook_stats['received']}, в очереди: {webhook_stats['queue_depth']}
+• Отклонено (неверный секрет): {webhook_stats['rejected']}, сброшено (очередь полна): {webhook_stats['dropped']}, некорректных: {webhook_stats['invalid']}, слишком больших: {webhook_stats['too_large']}
+"""
+        
+        # С несколькими обработчиками, webhook и спарклайнами статус не помещается в одно сообщение
+        for part in split_html_message(status_text):
+            bot.send_message(message.chat.id, part, parse_mode='HTML')
         
-    except ImportError:
-        bot.send_message(
-            message.chat.id,
-            "<b>📊 Статус системы</b>\n\n"
-            "<i>Время сервера:</i> {time.strftime('%Y-%m-%d %H:%M:%S')}\n\n"
-            "<code>Информация:</code> Установите библиотеку psutil для подробной статистики\n"
-            "<code>Команда:</code> pip install psutil",
-            parse_mode='HTML'
-        )
     except Exception as e:
         bot.send_message(
             message.chat.id,
@@ -407,7 +1590,1085 @@ def status_handler(message):
             parse_mode='HTML'
         )
 
+# Настройки потоковой выдачи ответа
+STREAM_RESPONSES = os.getenv('STREAM_RESPONSES', '1') == '1'
+STREAM_EDIT_INTERVAL = float(os.getenv('STREAM_EDIT_INTERVAL', '1.5'))
+# Лимит Telegram на текст сообщения - 4096 единиц UTF-16 после разбора HTML-разметки
+MESSAGE_LIMIT = 4096
+# Запас под заголовок "Часть N" во втором и последующих сообщениях
+PART_HEADER_RESERVE = 16
+
+# Тег, HTML-сущность или текст между ними
+_HTML_TOKEN_RE = re.compile(r'<(?P<closing>/?)(?P<tag>[a-zA-Z][a-zA-Z0-9-]*)[^<>]*>|(?P<entity>&#?\w+;)|[^<&]+|[<&]')
+_HTML_TAG_RE = re.compile(r'(<(/?)([a-zA-Z][a-zA-Z0-9-]*)[^<>]*>)')
+
+def _utf16_len(text):
+    """Длина текста в единицах UTF-16, как ее считает Telegram"""
+    if text.isascii():
+        return len(text)
+    return len(text.encode('utf-16-le')) // 2
+
+def _utf16_prefix(text, room):
+    """Самое длинное начало текста, которое помещается в room единиц UTF-16"""
+    prefix = text[:room]
+    width = _utf16_len(prefix)
+    while width > room:
+        width -= 2 if ord(prefix[-1]) > 0xFFFF else 1
+        prefix = prefix[:-1]
+    return prefix
+
+def html_visible_len(text):
+    """Длина HTML-текста без тегов (сущности считаются по одному символу) в единицах UTF-16"""
+    if '<' in text:
+        text = _HTML_TAG_RE.sub('', text)
+    if '&' in text:
+        text = html.unescape(text)
+    return _utf16_len(text)
+
+class _HtmlChunker:
+    """Накапливает куски HTML в сообщения с учетом лимита и стека открытых тегов"""
+    
+    def __init__(self, limit):
+        self.limit = limit
+        self.chunks = []
+        self.pieces = []
+        self.width = 0
+        # Открытые теги: (имя, исходный открывающий тег)
+        self.open_tags = []
+    
+    def add_tag(self, match):
+        self.pieces.append(match.group())
+        self._track_tags([(match.group(), match.group('closing'), match.group('tag'))])
+    
+    def _track_tags(self, tags):
+        """Обновляет стек открытых тегов по списку (тег, '/' или '', имя)"""
+        open_tags = self.open_tags
+        for raw, closing, name in tags:
+            if not closing:
+                open_tags.append((name, raw))
+            elif open_tags and open_tags[-1][0] == name:
+                open_tags.pop()
+            else:
+                for i in range(len(open_tags) - 1, -1, -1):
+                    if open_tags[i][0] == name:
+                        del open_tags[i]
+                        break
+    
+    def add_text(self, raw, width):
+        self.pieces.append(raw)
+        self.width += width
+    
+    def add_markup(self, text, width):
+        """Добавляет фрагмент, заведомо помещающийся в текущее сообщение"""
+        self.pieces.append(text)
+        self.width += width
+        if '<' in text:
+            self._track_tags(_HTML_TAG_RE.findall(text))
+    
+    def add_oversized(self, text):
+        """Добавляет фрагмент по токенам, разрезая текст на границах строк и слов"""
+        for match in _HTML_TOKEN_RE.finditer(text):
+            if match.group('tag'):
+                self.add_tag(match)
+                continue
+            raw = match.group()
+            entity = match.group('entity')
+            width = _utf16_len(html.unescape(entity) if entity else raw)
+            while self.width + width > self.limit:
+                if entity or self.width >= self.limit:
+                    self.flush()
+                    if entity:
+                        break
+                    continue
+                head = _utf16_prefix(raw, self.limit - self.width)
+                cut = max(head.rfind('\n'), head.rfind(' '))
+                if cut >= 0:
+                    head = head[:cut + 1]
+                elif self.width > 0:
+                    # Слово не помещается целиком - переносим его в следующее сообщение
+                    self.flush()
+                    continue
+                elif not head:
+                    head = raw[0]
+                head_width = _utf16_len(head)
+                self.add_text(head, head_width)
+                self.flush()
+                raw = raw[len(head):]
+                width -= head_width
+            self.add_text(raw, width)
+    
+    def flush(self):
+        """Закрывает открытые теги в текущем сообщении и открывает их заново в следующем"""
+        if self.width == 0:
+            return
+        closing = ''.join(f"</{name}>" for name, _ in reversed(self.open_tags))
+        self.chunks.append(''.join(self.pieces) + closing)
+        self.pieces = [tag for _, tag in self.open_tags]
+        self.width = 0
+
+@metrics.timed('split')
+def split_html_message(text, limit=MESSAGE_LIMIT):
+    """
+    Разбивает HTML-текст на сообщения не длиннее limit единиц UTF-16.
+    Абзацы укладываются жадно; слишком длинный абзац режется по строкам и словам.
+    Теги, открытые на границе сообщения, закрываются и открываются заново.
+    """
+    if html_visible_len(text) <= limit:
+        return [text]
+    
+    chunker = _HtmlChunker(limit)
+    for paragraph in text.split('\n\n'):
+        width = html_visible_len(paragraph)
+        if chunker.width and chunker.width + 2 + width > limit:
+            chunker.flush()
+        if chunker.width:
+            chunker.add_text('\n\n', 2)
+        elif not paragraph:
+            # Пустые абзацы в начале сообщения не переносим
+            continue
+        if chunker.width + width <= limit:
+            chunker.add_markup(paragraph, width)
+        else:
+            chunker.add_oversized(paragraph)
+    chunker.flush()
+    return chunker.chunks or [text]
+
+def build_reply_parts(formatted_response, limit=MESSAGE_LIMIT):
+    """Разбивает отформатированный ответ на сообщения, начиная со второй части нумерует их"""
+    if html_visible_len(formatted_response) <= limit:
+        return [formatted_response]
+    
+    parts = split_html_message(formatted_response, limit - PART_HEADER_RESERVE)
+    messages = [parts[0]]
+    for i, part in enumerate(parts[1:], 1):
+        # Добавляем номер части
+        messages.append(f"<b>Часть {i+1}</b>\n\n{part}")
+    return messages
+
+class StreamingReply:
+    """
+    Показывает ответ модели по мере генерации: редактирует сообщение не чаще
+    раза в STREAM_EDIT_INTERVAL секунд, форматирует завершенные абзацы
+    и переходит к новому сообщению на границе абзаца перед лимитом длины
+    """
+    
+    def __init__(self, chat_id, message_id, limit=MESSAGE_LIMIT, interval=STREAM_EDIT_INTERVAL):
+        self.chat_id = chat_id
+        self.limit = limit
+        self.interval = interval
+        self.started = False
+        # Для каждого сообщения ответа: абзацы, видимая длина, ID в Telegram и последний отправленный текст
+        self._messages = [[]]
+        self._widths = [0]
+        self._message_ids = [message_id]
+        self._rendered = ['']
+        self._pending = ''
+        self._last_edit = 0.0
+    
+    @property
+    def message_ids(self):
+        """ID сообщений, в которых уже показан текст ответа"""
+        return [message_id for message_id, text in zip(self._message_ids, self._rendered) if text]
+    
+    def feed(self, fragment):
+        """Принимает очередной фрагмент текста от модели"""
+        self._consume(fragment)
+        for index, text in self._due_updates():
+            self._deliver(index, text)
+    
+    def finish(self):
+        """Дописывает последний абзац и отправляет окончательный текст"""
+        self._close()
+        for index, text in self._due_updates(force=True):
+            self._deliver(index, text)
+    
+    def _consume(self, fragment):
+        self.started = True
+        self._pending += fragment
+        while '\n\n' in self._pending:
+            paragraph, self._pending = self._pending.split('\n\n', 1)
+            self._add_paragraph(paragraph)
+    
+    def _close(self):
+        if self._pending.strip():
+            self._add_paragraph(self._pending)
+        self._pending = ''
+    
+    def _add_paragraph(self, paragraph):
+        if not paragraph.strip():
+            return
+        for formatted in split_html_message(format_ai_response(paragraph), self.limit):
+            width = html_visible_len(formatted)
+            if self._messages[-1] and self._widths[-1] + width + 2 > self.limit:
+                # Текущее сообщение заполнено - следующий абзац пойдет в новое
+                self._messages.append([])
+                self._widths.append(0)
+                self._message_ids.append(None)
+                self._rendered.append('')
+            if self._messages[-1]:
+                self._widths[-1] += 2
+            self._messages[-1].append(formatted)
+            self._widths[-1] += width
+    
+    def _render(self, index):
+        text = '\n\n'.join(self._messages[index])
+        if index == len(self._messages) - 1 and self._pending.strip():
+            room = self.limit - self._widths[index] - (2 if text else 0)
+            if room > 0:
+                tail = html.escape(_utf16_prefix(self._pending, room))
+                text = f"{text}\n\n{tail}" if text else tail
+        return text
+    
+    def _due_updates(self, force=False):
+        """Возвращает (номер сообщения, текст) для сообщений, которые пора обновить"""
+        if not force and time.time() - self._last_edit < self.interval:
+            return []
+        updates = []
+        for index in range(len(self._messages)):
+            text = self._render(index)
+            if text.strip() and text != self._rendered[index]:
+                updates.append((index, text))
+        return updates
+    
+    def _delivered(self, index, message_id, text):
+        self._message_ids[index] = message_id
+        self._rendered[index] = text
+        self._last_edit = time.time()
+    
+    def _deliver(self, index, text):
+        message_id = self._message_ids[index]
+        try:
+            with metrics.time('send_message' if message_id is None else 'edit_message'):
+                if message_id is None:
+                    message_id = bot.send_message(self.chat_id, text, parse_mode='HTML').message_id
+                else:
+                    bot.edit_message_text(text, self.chat_id, message_id, parse_mode='HTML')
+        except telebot.apihelper.ApiTelegramException as e:
+            if 'message is not modified' not in str(e):
+                raise
+        self._delivered(index, message_id, text)
+
+def _command_argument(message):
+    """Возвращает текст после команды (или пустую строку)"""
+    parts = (message.text or '').split(maxsplit=1)
+    return parts[1].strip() if len(parts) > 1 else ''
+
+@bot.message_handler(commands=["cache"])
+def cache_handler(message):
+    """Показывает статистику кэша анализов и последние записи (только для администратора)"""
+    if not is_admin(message.from_user.id):
+        bot.send_message(message.chat.id, "⛔ У вас нет прав для выполнения этой команды.")
+        return
+    
+    stats = analysis_cache.get_stats()
+    lines = [
+        "<b>🗄 Кэш анализов</b>",
+        "",
+        f"<i>Записей:</i> {stats['entries'] - stats['pinned']} (лимит {analysis_cache.max_entries}), "
+        f"закреплено: {stats['pinned']} (лимит {analysis_cache.pinned_max_entries})",
+        f"<i>Объем:</i> {stats['bytes'] / 1024 / 1024:.2f} MB (лимит {analysis_cache.max_bytes / 1024 / 1024:.0f} MB)",
+        f"<i>Попаданий:</i> {stats['hits']}, промахов: {stats['misses']} ({stats['hit_ratio'] * 100:.1f}%)",
+        "",
+        "<b>Последние записи:</b>",
+    ]
+    for entry in analysis_cache.list_entries(limit=15):
+        lines.append(f"• <code>{html.escape(entry['key'])}</code> - {entry['hits']} попад., {entry['size'] / 1024:.1f} KB")
+    
+    bot.send_message(message.chat.id, '\n'.join(lines), parse_mode='HTML')
+
+@bot.message_handler(commands=["cache_show"])
+def cache_show_handler(message):
+    """Показывает запись кэша для запроса (только для администратора)"""
+    if not is_admin(message.from_user.id):
+        bot.send_message(message.chat.id, "⛔ У вас нет прав для выполнения этой команды.")
+        return
+    
+    prompt = _command_argument(message)
+    key = resolve_prompt(prompt)[0] if prompt else ''
+    entry = analysis_cache.get_entry(key) if key else None
+    if not entry:
+        bot.send_message(message.chat.id, f"Запись <code>{html.escape(key)}</code> не найдена.", parse_mode='HTML')
+        return
+    
+    info = (f"<b>🗄 Запись кэша</b>\n\n"
+            f"<i>Ключ:</i> <code>{html.escape(entry['key'])}</code>\n"
+            f"<i>Исходный запрос:</i> {html.escape(entry['prompt'])}\n"
+            f"<i>Создана:</i> {time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(entry['created_at']))}\n"
+            f"<i>Попаданий:</i> {entry['hits']}, <i>размер:</i> {entry['size'] / 1024:.1f} KB"
+            f"{', закреплена' if entry['pinned'] else ''}\n\n"
+            f"{html.escape(entry['response'][:1500])}")
+    bot.send_message(message.chat.id, info, parse_mode='HTML')
+
+@bot.message_handler(commands=["cache_purge"])
+def cache_purge_handler(message):
+    """Удаляет запись кэша или весь кэш (только для администратора)"""
+    if not is_admin(message.from_user.id):
+        bot.send_message(message.chat.id, "⛔ У вас нет прав для выполнения этой команды.")
+        return
+    
+    argument = _command_argument(message)
+    if not argument:
+        bot.send_message(message.chat.id, "Использование: /cache_purge &lt;запрос|all&gt;", parse_mode='HTML')
+        return
+    
+    if argument.lower() == 'all':
+        removed = analysis_cache.purge()
+    else:
+        removed = analysis_cache.delete(resolve_prompt(argument)[0])
+    
+    logger.info(f"Из кэша анализов удалено записей: {removed}", category='admin')
+    bot.send_message(message.chat.id, f"🗑 Удалено записей: {removed}")
+
+@bot.message_handler(commands=["cache_seed"])
+def cache_seed_handler(message):
+    """Генерирует анализ и сохраняет его в кэш заранее (только для администратора)"""
+    if not is_admin(message.from_user.id):
+        bot.send_message(message.chat.id, "⛔ У вас нет прав для выполнения этой команды.")
+        return
+    
+    prompt = _command_argument(message)
+    if len(prompt) < 5:
+        bot.send_message(message.chat.id, "Использование: /cache_seed &lt;произведение, автор&gt;", parse_mode='HTML')
+        return
+    
+    try:
+        key, content = resolve_prompt(prompt)
+        response = get_answer(content)
+        analysis_cache.put(content, response, key=key, formatted=format_ai_response(response))
+        bot.send_message(message.chat.id, f"✅ Запись <code>{html.escape(key)}</code> сохранена ({len(response)} символов).", parse_mode='HTML')
+    except Exception as e:
+        logger.error(f"Ошибка при заполнении кэша: {e}")
+        bot.send_message(message.chat.id, f"<b>❌ Ошибка:</b> <code>{html.escape(str(e)[:200])}</code>", parse_mode='HTML')
+
+# Настройки индикатора печати
+TYPING_INTERVAL = float(os.getenv('TYPING_INTERVAL', '5'))
+CHAT_ACTION_RATE = float(os.getenv('CHAT_ACTION_RATE', '20'))
+CHAT_ACTION_SENDERS = int(os.getenv('CHAT_ACTION_SENDERS', '2'))
+
+class ChatActionHandle:
+    """Подписка запроса на индикатор действия в чате"""
+    
+    def __init__(self, scheduler, chat_id):
+        self.scheduler = scheduler
+        self.chat_id = chat_id
+        self.stopped = False
+    
+    def stop(self):
+        self.scheduler.stop(self)
+
+class ChatActionScheduler:
+    """
+    Общий планировщик индикаторов «печатает…» для всех активных чатов.
+    Сроки повторов хранятся в куче, наступившие send_chat_action отправляются
+    пачкой через небольшой пул, частота исходящих вызовов ограничена
+    """
+    
+    def __init__(self, send, interval=TYPING_INTERVAL, rate=CHAT_ACTION_RATE, senders=CHAT_ACTION_SENDERS):
+        self._send = send
+        self.interval = interval
+        self.rate = rate
+        self._condition = threading.Condition()
+        # Куча (срок, порядковый номер, ID чата, состояние); устаревшие записи пропускаются при извлечении
+        self._heap = []
+        self._sequence = itertools.count()
+        self._chats = {}
+        self._tokens = max(1.0, rate)
+        self._refilled = time.monotonic()
+        self._executor = ThreadPoolExecutor(max_workers=senders, thread_name_prefix='chat-action')
+        self._thread = None
+        self.stats = {'sent': 0, 'failed': 0, 'max_lag': 0.0}
+    
+    def start(self, chat_id, action='typing'):
+        """Включает индикатор в чате; несколько запросов одного чата делят один индикатор"""
+        handle = ChatActionHandle(self, chat_id)
+        with self._condition:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='chat-action-scheduler', daemon=True)
+                self._thread.start()
+            state = self._chats.get(chat_id)
+            if state is None:
+                state = self._chats[chat_id] = {'action': action, 'handles': set(), 'sending': False}
+                self._schedule(chat_id, state, time.monotonic())
+                self._condition.notify()
+            state['handles'].add(handle)
+        return handle
+    
+    def stop(self, handle):
+        """Снимает подписку; индикатор выключается, когда в чате не осталось запросов"""
+        with self._condition:
+            if handle.stopped:
+                return
+            handle.stopped = True
+            state = self._chats.get(handle.chat_id)
+            if state is not None:
+                state['handles'].discard(handle)
+                if not state['handles']:
+                    del self._chats[handle.chat_id]
+    
+    def _schedule(self, chat_id, state, due):
+        state['due'] = due
+        heapq.heappush(self._heap, (due, next(self._sequence), chat_id, state))
+    
+    def _refill(self, now):
+        self._tokens = min(max(1.0, self.rate), self._tokens + (now - self._refilled) * self.rate)
+        self._refilled = now
+    
+    def _next_batch(self):
+        """Ждет наступивших сроков и забирает их в пределах доступной частоты отправки"""
+        with self._condition:
+            while True:
+                while self._heap and self._chats.get(self._heap[0][2]) is not self._heap[0][3]:
+                    heapq.heappop(self._heap)
+                if not self._heap:
+                    self._condition.wait()
+                    continue
+                
+                now = time.monotonic()
+                self._refill(now)
+                if self._heap[0][0] > now:
+                    self._condition.wait(self._heap[0][0] - now)
+                    continue
+                if self._tokens < 1:
+                    self._condition.wait((1 - self._tokens) / self.rate)
+                    continue
+                
+                batch = []
+                while self._heap and self._heap[0][0] <= now and self._tokens >= 1:
+                    due, _, chat_id, state = heapq.heappop(self._heap)
+                    if self._chats.get(chat_id) is not state or state['due'] != due:
+                        continue
+                    self._schedule(chat_id, state, now + self.interval)
+                    # Пока предыдущий вызов для чата не завершился, новый не отправляем
+                    if state['sending']:
+                        continue
+                    state['sending'] = True
+                    self._tokens -= 1
+                    self.stats['max_lag'] = max(self.stats['max_lag'], now - due)
+                    batch.append((chat_id, state))
+                return batch
+    
+    def _run(self):
+        while True:
+            for chat_id, state in self._next_batch():
+                try:
+                    self._executor.submit(self._deliver, chat_id, state)
+                except RuntimeError:
+                    # Процесс завершается (например, обработчик после перезапуска): индикаторы больше не нужны
+                    return
+    
+    def _deliver(self, chat_id, state):
+        try:
+            self._send(chat_id, state['action'])
+        except Exception as e:
+            logger.warning(f"Не удалось отправить индикатор печати в чат {chat_id}: {e}")
+            with self._condition:
+                self.stats['failed'] += 1
+                # Чат недоступен: больше не пытаемся, пока его не запустят заново
+                if self._chats.get(chat_id) is state:
+                    del self._chats[chat_id]
+        else:
+            with self._condition:
+                self.stats['sent'] += 1
+        finally:
+            with self._condition:
+                state['sending'] = False
+    
+    def get_stats(self):
+        with self._condition:
+            stats = dict(self.stats)
+            stats['active_chats'] = len(self._chats)
+        return stats
+
+chat_actions = ChatActionScheduler(bot.send_chat_action)
+
+# Настройки допуска запросов к модели
+# Места у модели и в очереди - на весь бот, в режиме нескольких процессов делятся между обработчиками
+ADMISSION_MAX_ACTIVE = worker_share(int(os.getenv('ADMISSION_MAX_ACTIVE', '8')))
+ADMISSION_QUEUE_SIZE = worker_share(int(os.getenv('ADMISSION_QUEUE_SIZE', '24')))
+ADMISSION_USER_CONCURRENCY = int(os.getenv('ADMISSION_USER_CONCURRENCY', '2'))
+# Запросов на анализ в минуту от одного пользователя и допустимый всплеск
+ADMISSION_USER_RATE = float(os.getenv('ADMISSION_USER_RATE', '6'))
+ADMISSION_USER_BURST = float(os.getenv('ADMISSION_USER_BURST', '3'))
+ADMISSION_POSITION_INTERVAL = float(os.getenv('ADMISSION_POSITION_INTERVAL', '3'))
+
+class AdmissionRejected(Exception):
+    """Запрос не допущен к модели; текст исключения показывается пользователю"""
+
+class AdmissionTicket:
+    """Заявка на генерацию: ждет допуска в потоке (threading.Event) или в событийном цикле (asyncio.Event)"""
+    
+    def __init__(self, user_id, loop=None):
+        self.user_id = user_id
+        self.loop = loop
+        self.event = asyncio.Event() if loop is not None else threading.Event()
+        self.granted = False
+        self.created = time.monotonic()
+
+class AdmissionSlot:
+    """Место у модели: with / async with ждет допуска и освобождает место при выходе"""
+    
+    def __init__(self, controller, user_id, on_position=None):
+        self.controller = controller
+        self.user_id = user_id
+        self.on_position = on_position
+        self.ticket = None
+    
+    def __enter__(self):
+        self.ticket = AdmissionTicket(self.user_id)
+        self.controller.acquire(self.ticket, self.on_position)
+        return self
+    
+    def __exit__(self, *exc_info):
+        self.controller.release(self.ticket)
+    
+    async def __aenter__(self):
+        self.ticket = AdmissionTicket(self.user_id, asyncio.get_running_loop())
+        await self.controller.acquire_async(self.ticket, self.on_position)
+        return self
+    
+    async def __aexit__(self, *exc_info):
+        self.controller.release(self.ticket)
+
+class AdmissionController:
+    """
+    Допуск запросов к модели: ограничение частоты и числа одновременных запросов
+    пользователя, общее число генераций и ограниченная очередь, из которой места
+    выдаются по кругу между пользователями. При полной очереди запрос сразу отклоняется.
+    """
+    
+    def __init__(self, max_active=ADMISSION_MAX_ACTIVE, queue_size=ADMISSION_QUEUE_SIZE,
+                 user_concurrency=ADMISSION_USER_CONCURRENCY, user_rate=ADMISSION_USER_RATE,
+                 user_burst=ADMISSION_USER_BURST, position_interval=ADMISSION_POSITION_INTERVAL):
+        self.max_active = max_active
+        self.queue_size = queue_size
+        self.user_concurrency = user_concurrency
+        self.user_rate = user_rate / 60
+        self.user_burst = user_burst
+        self.position_interval = position_interval
+        self._lock = threading.Lock()
+        self._active = 0
+        self._queued = 0
+        # Ожидающие заявки по пользователям и круговой порядок пользователей
+        self._waiting = {}
+        self._ring = deque()
+        self._user_load = {}
+        self._rates = {}
+        self.stats = {'admitted': 0, 'queued': 0, 'rejected_rate': 0, 'rejected_user': 0, 'rejected_queue': 0,
+                      'max_queue': 0, 'wait_total': 0.0, 'wait_max': 0.0}
+    
+    def slot(self, user_id, on_position=None):
+        return AdmissionSlot(self, user_id, on_position)
+    
+    def check(self, user_id):
+        """Учитывает запрос пользователя; слишком частые запросы отклоняются до обращения к модели"""
+        with self._lock:
+            now = time.monotonic()
+            bucket = self._rates.get(user_id)
+            if bucket is None:
+                if len(self._rates) > 10000:
+                    self._prune_rates(now)
+                bucket = self._rates[user_id] = _TokenBucket(self.user_rate, max(1.0, self.user_burst), now)
+            bucket.refill(now)
+            if bucket.tokens < 1:
+                self.stats['rejected_rate'] += 1
+                retry_in = math.ceil((1 - bucket.tokens) / self.user_rate)
+                raise AdmissionRejected(f"Слишком много запросов. Попробуйте снова через {retry_in} с.")
+            bucket.tokens -= 1
+    
+    def _prune_rates(self, now):
+        for user_id, bucket in list(self._rates.items()):
+            bucket.refill(now)
+            if bucket.tokens >= bucket.capacity:
+                del self._rates[user_id]
+    
+    def _enqueue(self, ticket):
+        user_id = ticket.user_id
+        with self._lock:
+            load = self._user_load.get(user_id, 0)
+            if load >= self.user_concurrency:
+                self.stats['rejected_user'] += 1
+                raise AdmissionRejected("Дождитесь ответа на предыдущие запросы.")
+            if self._active < self.max_active and not self._queued:
+                self._user_load[user_id] = load + 1
+                self._active += 1
+                self.stats['admitted'] += 1
+                ticket.granted = True
+                return
+            if self._queued >= self.queue_size:
+                self.stats['rejected_queue'] += 1
+                raise AdmissionRejected("Сейчас слишком много запросов, очередь заполнена. Попробуйте через несколько минут.")
+            
+            self._user_load[user_id] = load + 1
+            tickets = self._waiting.get(user_id)
+            if tickets is None:
+                tickets = self._waiting[user_id] = deque()
+                self._ring.append(user_id)
+            tickets.append(ticket)
+            self._queued += 1
+            self.stats['queued'] += 1
+            self.stats['max_queue'] = max(self.stats['max_queue'], self._queued)
+    
+    def _grant_next(self):
+        """Выдает освободившиеся места по кругу: по одной заявке каждого пользователя"""
+        while self._active < self.max_active and self._ring:
+            user_id = self._ring.popleft()
+            tickets = self._waiting[user_id]
+            ticket = tickets.popleft()
+            if tickets:
+                self._ring.append(user_id)
+            else:
+                del self._waiting[user_id]
+            self._queued -= 1
+            self._active += 1
+            self.stats['admitted'] += 1
+            ticket.granted = True
+            if ticket.loop is not None:
+                ticket.loop.call_soon_threadsafe(ticket.event.set)
+            else:
+                ticket.event.set()
+    
+    def release(self, ticket):
+        """Освобождает место или снимает заявку из очереди"""
+        user_id = ticket.user_id
+        with self._lock:
+            if ticket.granted:
+                self._active -= 1
+            else:
+                tickets = self._waiting.get(user_id)
+                if tickets is None or ticket not in tickets:
+                    return
+                tickets.remove(ticket)
+                self._queued -= 1
+                if not tickets:
+                    del self._waiting[user_id]
+                    self._ring.remove(user_id)
+            load = self._user_load[user_id] - 1
+            if load:
+                self._user_load[user_id] = load
+            else:
+                del self._user_load[user_id]
+            self._grant_next()
+    
+    def position(self, ticket):
+        """Место заявки в очереди с учетом кругового порядка (0 - место у модели уже выдано)"""
+        with self._lock:
+            if ticket.granted:
+                return 0
+            index = self._waiting[ticket.user_id].index(ticket)
+            position = index + 1
+            before = True
+            for user_id in self._ring:
+                if user_id == ticket.user_id:
+                    before = False
+                    continue
+                # Пользователи впереди по кругу успеют получить на одно место больше
+                position += min(len(self._waiting[user_id]), index + (1 if before else 0))
+            return position
+    
+    def _record_wait(self, ticket):
+        waited = time.monotonic() - ticket.created
+        metrics.observe('admission_wait', waited)
+        with self._lock:
+            self.stats['wait_total'] += waited
+            self.stats['wait_max'] = max(self.stats['wait_max'], waited)
+    
+    def acquire(self, ticket, on_position=None):
+        """Ждет места у модели, сообщая on_position(место) при его изменении и on_position(0) при допуске"""
+        self._enqueue(ticket)
+        shown = None
+        try:
+            while not ticket.granted:
+                position = self.position(ticket)
+                if on_position and position and position != shown:
+                    shown = position
+                    self._notify(on_position, position)
+                ticket.event.wait(self.position_interval)
+        except BaseException:
+            self.release(ticket)
+            raise
+        self._record_wait(ticket)
+        if shown is not None:
+            self._notify(on_position, 0)
+    
+    async def acquire_async(self, ticket, on_position=None):
+        """Асинхронный acquire; on_position - корутина"""
+        self._enqueue(ticket)
+        shown = None
+        try:
+            while not ticket.granted:
+                position = self.position(ticket)
+                if on_position and position and position != shown:
+                    shown = position
+                    await self._notify_async(on_position, position)
+                try:
+                    await asyncio.wait_for(ticket.event.wait(), self.position_interval)
+                except asyncio.TimeoutError:
+                    pass
+        except BaseException:
+            self.release(ticket)
+            raise
+        self._record_wait(ticket)
+        if shown is not None:
+            await self._notify_async(on_position, 0)
+    
+    @staticmethod
+    def _notify(on_position, position):
+        try:
+            on_position(position)
+        except Exception as e:
+            logger.warning(f"Не удалось показать место в очереди: {e}")
+    
+    @staticmethod
+    async def _notify_async(on_position, position):
+        try:
+            await on_position(position)
+        except Exception as e:
+            logger.warning(f"Не удалось показать место в очереди: {e}")
+    
+    def get_stats(self):
+        with self._lock:
+            stats = dict(self.stats)
+            stats['active'] = self._active
+            stats['queue_length'] = self._queued
+            stats['waiting_users'] = len(self._ring)
+        stats['wait_avg'] = stats['wait_total'] / stats['admitted'] if stats['admitted'] else 0.0
+        return stats
+    
+    def reconfigure(self, max_active, queue_size, user_concurrency):
+        """Меняет лимиты на ходу; если мест у модели стало больше, ожидающие допускаются сразу"""
+        with self._lock:
+            self.max_active = max_active
+            self.queue_size = queue_size
+            self.user_concurrency = user_concurrency
+            self._grant_next()
+
+admission = AdmissionController()
+
+def queue_position_text(position):
+    """Текст статусного сообщения для места в очереди (0 - генерация началась)"""
+    if position == 0:
+        return "🔄 <i>Анализирую произведение...</i>"
+    return f"⏳ <i>Много запросов - вы {position}-й в очереди. Анализ начнется автоматически.</i>"
+
+# ===== Предварительная проверка запроса: посторонние темы отсекаются до обращения к модели =====
+
+LITERATURE_FILTER = os.getenv('LITERATURE_FILTER', '1') == '1'
+
+OFF_TOPIC_TEXT = ("📚 Я занимаюсь разбором литературных произведений и ничего более.\n\n"
+                  "Укажите название произведения и автора.\n"
+                  "<i>Пример:</i> 'Война и мир, Лев Толстой'")
+
+# Каталог: "Автор / вариант имени: Произведение = вариант названия; Произведение; ..." (по строке на автора)
+LITERATURE_CATALOG = """
+Александр Пушкин: Евгений Онегин; Капитанская дочка; Медный всадник; Борис Годунов; Пиковая дама; Дубровский; Повести Белкина; Руслан и Людмила; Станционный смотритель; Метель; Выстрел; Моцарт и Сальери; Скупой рыцарь; Каменный гость; Цыганы; Полтава; Кавказский пленник; Сказка о рыбаке и рыбке; Сказка о царе Салтане; Сказка о мертвой царевне; Я вас любил; Пророк; Анчар; Узник
+Михаил Лермонтов: Герой нашего времени; Мцыри; Демон; Бородино; Маскарад; Парус; Смерть поэта; Песня про купца Калашникова; Тамань; Бэла; Княжна Мери; Фаталист
+Николай Гоголь: Мертвые души; Ревизор; Шинель; Нос; Тарас Бульба; Вий; Женитьба; Вечера на хуторе близ Диканьки; Ночь перед Рождеством; Записки сумасшедшего; Старосветские помещики; Миргород; Портрет
+Лев Толстой: Война и мир; Анна Каренина; Воскресение; Детство; Отрочество; Юность; Севастопольские рассказы; Крейцерова соната; Смерть Ивана Ильича; Хаджи-Мурат; Кавказский пленник; После бала; Казаки
+Федор Достоевский: Преступление и наказание; Идиот; Братья Карамазовы; Бесы; Подросток; Белые ночи; Бедные люди; Игрок; Униженные и оскорбленные; Записки из подполья; Записки из мертвого дома; Неточка Незванова
+Иван Тургенев: Отцы и дети; Муму; Записки охотника; Дворянское гнездо; Накануне; Рудин; Ася; Первая любовь; Бежин луг; Дым; Новь; Вешние воды
+Антон Чехов: Вишневый сад; Чайка; Три сестры; Дядя Ваня; Палата номер шесть; Человек в футляре; Крыжовник; О любви; Ионыч; Дама с собачкой; Хамелеон; Толстый и тонкий; Смерть чиновника; Каштанка; Попрыгунья; Степь; Ванька; Злоумышленник; Тоска
+Иван Гончаров: Обломов; Обыкновенная история; Обрыв; Фрегат Паллада
+Александр Островский: Гроза; Бесприданница; Лес; Снегурочка; Свои люди сочтемся; Волки и овцы; На всякого мудреца довольно простоты
+Александр Грибоедов: Горе от ума
+Денис Фонвизин: Недоросль; Бригадир
+Николай Некрасов: Кому на Руси жить хорошо; Мороз Красный нос; Железная дорога; Русские женщины; Крестьянские дети
+Михаил Салтыков-Щедрин / Салтыков / Щедрин: История одного города; Господа Головлевы; Премудрый пискарь; Повесть о том как один мужик двух генералов прокормил; Дикий помещик
+Николай Лесков: Левша; Очарованный странник; Леди Макбет Мценского уезда; Тупейный художник
+Николай Карамзин: Бедная Лиза; История государства Российского
+Иван Крылов: Стрекоза и муравей; Ворона и лисица; Квартет; Слон и Моська; Лебедь рак и щука; Мартышка и очки; Волк на псарне
+Федор Тютчев: Silentium; Весенняя гроза; Умом Россию не понять
+Афанасий Фет: Шепот робкое дыханье; Я пришел к тебе с приветом
+Александр Блок: Двенадцать; Незнакомка; Скифы; Стихи о Прекрасной Даме; Ночь улица фонарь аптека
+Сергей Есенин: Анна Снегина; Черный человек; Письмо матери; Береза; Персидские мотивы; Пугачев
+Владимир Маяковский: Облако в штанах; Флейта-позвоночник; Хорошо; Клоп; Баня; Во весь голос; Стихи о советском паспорте
+Анна Ахматова: Реквием; Поэма без героя; Вечер; Четки
+Марина Цветаева: Тоска по родине; Мне нравится что вы больны не мной
+Борис Пастернак: Доктор Живаго; Сестра моя жизнь; Зимняя ночь
+Осип Мандельштам: Камень; Tristia
+Максим Горький: На дне; Мать; Старуха Изергиль; Челкаш; Песня о Буревестнике; Песня о Соколе; Детство; Жизнь Клима Самгина; Макар Чудра
+Иван Бунин: Темные аллеи; Легкое дыхание; Господин из Сан-Франциско; Антоновские яблоки; Чистый понедельник; Жизнь Арсеньева; Солнечный удар; Деревня
+Александр Куприн: Гранатовый браслет; Олеся; Поединок; Молох; Яма; Белый пудель; Чудесный доктор
+Леонид Андреев: Иуда Искариот; Красный смех; Жизнь Василия Фивейского
+Михаил Булгаков: Мастер и Маргарита; Собачье сердце; Белая гвардия; Дни Турбиных; Роковые яйца; Записки юного врача; Бег; Театральный роман
+Михаил Шолохов: Тихий Дон; Судьба человека; Поднятая целина; Донские рассказы
+Андрей Платонов: Котлован; Чевенгур; Юшка; Возвращение; Сокровенный человек
+Михаил Зощенко: Галоша; Аристократка; Баня; Голубая книга
+Илья Ильф / Евгений Петров: Двенадцать стульев; Золотой теленок
+Владимир Набоков: Лолита; Защита Лужина; Дар; Машенька; Приглашение на казнь; Другие берега
+Евгений Замятин: Мы
+Александр Твардовский: Василий Теркин; По праву памяти; Дом у дороги
+Александр Солженицын: Один день Ивана Денисовича; Матренин двор; Архипелаг ГУЛАГ; В круге первом; Раковый корпус
+Валентин Распутин: Прощание с Матерой; Живи и помни; Уроки французского; Последний срок
+Василий Шукшин: Чудик; Срезал; Калина красная; Микроскоп
+Виктор Астафьев: Царь-рыба; Васюткино озеро; Пастух и пастушка; Конь с розовой гривой
+Борис Васильев: А зори здесь тихие; В списках не значился; Завтра была война
+Василий Быков: Сотников; Обелиск; Альпийская баллада
+Константин Паустовский: Телеграмма; Теплый хлеб; Мещерская сторона
+Юрий Трифонов: Дом на набережной; Обмен
+Василий Гроссман: Жизнь и судьба
+Чингиз Айтматов: Плаха; Белый пароход; Буранный полустанок; Джамиля
+Аркадий Стругацкий / Борис Стругацкий / Стругацкие: Пикник на обочине; Трудно быть богом; Понедельник начинается в субботу; Улитка на склоне
+Иосиф Бродский: Часть речи; Письма римскому другу; Рождественский романс
+Венедикт Ерофеев: Москва-Петушки
+Виктор Пелевин: Generation П; Чапаев и Пустота; Омон Ра
+Евгений Водолазкин: Лавр; Авиатор
+Дмитрий Глуховский: Метро 2033; Текст
+Людмила Улицкая: Казус Кукоцкого; Зеленый шатер
+Захар Прилепин: Обитель; Санькя
+Уильям Шекспир / William Shakespeare / Шекспир: Гамлет = Hamlet; Ромео и Джульетта = Romeo and Juliet; Король Лир = King Lear; Макбет = Macbeth; Отелло = Othello; Буря; Сон в летнюю ночь; Двенадцатая ночь; Укрощение строптивой
+Мигель де Сервантес / Сервантес / Cervantes: Дон Кихот = Don Quixote
+Иоганн Вольфганг Гете / Гете / Goethe: Фауст = Faust; Страдания юного Вертера
+Данте Алигьери / Dante: Божественная комедия = Divine Comedy
+Гомер / Homer: Илиада = Iliad; Одиссея = Odyssey
+Виктор Гюго / Гюго / Victor Hugo: Отверженные = Les Miserables; Собор Парижской Богоматери; Человек который смеется
+Александр Дюма / Dumas: Три мушкетера; Граф Монте-Кристо = The Count of Monte Cristo
+Оноре де Бальзак / Бальзак / Balzac: Отец Горио; Гобсек; Шагреневая кожа; Человеческая комедия
+Гюстав Флобер / Флобер / Flaubert: Госпожа Бовари = Madame Bovary; Саламбо
+Стендаль / Stendhal: Красное и черное; Пармская обитель
+Чарльз Диккенс / Диккенс / Charles Dickens: Оливер Твист = Oliver Twist; Большие надежды = Great Expectations; Дэвид Копперфилд; Рождественская песнь
+Джейн Остин / Остин / Jane Austen: Гордость и предубеждение = Pride and Prejudice; Эмма; Разум и чувства
+Шарлотта Бронте / Бронте / Bronte: Джейн Эйр = Jane Eyre; Грозовой перевал = Wuthering Heights
+Джордж Оруэлл / Оруэлл / George Orwell / Orwell: 1984; Скотный двор = Animal Farm
+Олдос Хаксли / Хаксли / Huxley: О дивный новый мир = Brave New World
+Рэй Брэдбери / Брэдбери / Bradbury: 451 градус по Фаренгейту = Fahrenheit 451; Марсианские хроники; Вино из одуванчиков
+Эрнест Хемингуэй / Хемингуэй / Hemingway: Старик и море = The Old Man and the Sea; Прощай оружие; По ком звонит колокол; Фиеста
+Фрэнсис Скотт Фицджеральд / Фицджеральд / Fitzgerald: Великий Гэтсби = The Great Gatsby; Ночь нежна
+Джером Сэлинджер / Сэлинджер / Salinger: Над пропастью во ржи = The Catcher in the Rye
+Марк Твен / Mark Twain: Приключения Тома Сойера; Приключения Гекльберри Финна; Принц и нищий
+Джек Лондон / Jack London: Мартин Иден; Белый клык; Зов предков; Любовь к жизни
+Эдгар Аллан По / Edgar Allan Poe: Ворон = The Raven; Падение дома Ашеров
+Франц Кафка / Кафка / Kafka: Превращение = The Metamorphosis; Процесс; Замок
+Томас Манн / Thomas Mann: Волшебная гора; Будденброки; Смерть в Венеции
+Эрих Мария Ремарк / Ремарк / Remarque: Три товарища; На западном фронте без перемен; Триумфальная арка; Жизнь взаймы
+Альбер Камю / Камю / Camus: Посторонний; Чума; Миф о Сизифе
+Антуан де Сент-Экзюпери / Экзюпери / Saint-Exupery: Маленький принц = Le Petit Prince; Планета людей
+Габриэль Гарсиа Маркес / Маркес / Marquez: Сто лет одиночества; Любовь во время холеры; Полковнику никто не пишет
+Михаил Пришвин: Кладовая солнца
+Николай Островский: Как закалялась сталь
+Александр Фадеев: Молодая гвардия; Разгром
+Джоан Роулинг / Роулинг / Rowling: Гарри Поттер = Harry Potter
+Джон Толкин / Толкин / Tolkien: Властелин колец = The Lord of the Rings; Хоббит = The Hobbit
+Агата Кристи / Agatha Christie: Убийство в Восточном экспрессе; Десять негритят
+Артур Конан Дойл / Конан Дойл / Conan Doyle: Шерлок Холмс; Собака Баскервилей
+Жюль Верн / Jules Verne: Двадцать тысяч лье под водой; Таинственный остров; Дети капитана Гранта; Вокруг света за восемьдесят дней
+Даниель Дефо / Дефо / Defoe: Робинзон Крузо = Robinson Crusoe
+Джонатан Свифт / Свифт / Swift: Путешествия Гулливера
+Оскар Уайльд / Уайльд / Oscar Wilde: Портрет Дориана Грея = The Picture of Dorian Gray; Кентервильское привидение
+Льюис Кэрролл / Кэрролл / Carroll: Алиса в Стране чудес = Alice in Wonderland
+"""
+
+# Дополнительный каталог в том же формате (например, выгрузка из библиотечной базы)
+WORKS_CATALOG_PATH = os.getenv('WORKS_CATALOG_PATH', '')
+
+def parse_literature_catalog(text):
+    """Разбирает каталог в список произведений: (варианты имени автора, варианты названия)"""
+    works = []
+    for line in text.strip().splitlines():
+        if not line.strip() or line.startswith('#'):
+            continue
+        authors, _, titles = line.partition(':')
+        author_names = [name.strip() for name in authors.split('/') if name.strip()]
+        for title in titles.split(';'):
+            title_names = [name.strip() for name in title.split('=') if name.strip()]
+            if author_names and title_names:
+                works.append((author_names, title_names))
+    return works
+
+def load_literature_catalog():
+    """Встроенный каталог и файл WORKS_CATALOG_PATH, если он задан"""
+    works = parse_literature_catalog(LITERATURE_CATALOG)
+    if WORKS_CATALOG_PATH:
+        try:
+            with open(WORKS_CATALOG_PATH, encoding='utf-8') as catalog_file:
+                extra = parse_literature_catalog(catalog_file.read())
+            works.extend(extra)
+            logger.info(f"Загружен каталог произведений {WORKS_CATALOG_PATH}: {len(extra)} названий")
+        except OSError as e:
+            logger.warning(f"Не удалось прочитать каталог {WORKS_CATALOG_PATH}: {e}")
+    return works
+
+LITERATURE_WORKS = load_literature_catalog()
+
+# Основы слов, указывающие на литературный запрос
+LITERATURE_CUES = ('произведен', 'роман', 'повест', 'рассказ', 'поэм', 'поэз', 'стих', 'пьес', 'комеди',
+                   'трагеди', 'драм', 'басн', 'сказк', 'новелл', 'книг', 'автор', 'писател', 'поэт',
+                   'литератур', 'лирик', 'персонаж', 'сюжет', 'фабул', 'композици', 'анализ',
+                   'разбор', 'сочинени', 'эпилог', 'прочита', 'почитать', 'классик', 'эпос', 'метафор',
+                   'эпитет', 'аллегори', 'novel', 'poem', 'poetry', 'book', 'author', 'literatur', 'story')
+# Основы слов посторонних тем (совпадают с началом слова): без признаков литературы такой запрос получает отказ сразу
+OFF_TOPIC_CUES = ('погод', 'прогноз', 'курс доллар', 'курс евро', 'валют', 'биткоин', 'bitcoin', 'крипт',
+                  'рецепт', 'приготов', 'python', 'javascript', 'java ', 'код ', 'кода', 'программ',
+                  'скрипт', 'sql', 'сколько будет', 'реши уравнен', 'реши задач', 'как ты',
+                  'кто ты', 'что ты умеешь', 'анекдот', 'шутк', 'новост', 'футбол', 'матч', 'хоккей', 'президент', 'выбор', 'цена', 'стоимост', 'купить', 'продать', 'ремонт',
+                  'болит', 'лекарств', 'врач', 'диет', 'похуд', 'гороскоп', 'знакомств', 'такси', 'билет',
+                  'доставк', 'вакан', 'зарплат', 'кредит', 'ипотек', 'налог', 'telegram', 'телеграм',
+                  'weather', 'http', 'www', 'переведи', 'translate', 'посчитай', 'вычисли', 'роутер', 'ноутбук',
+                  'смартфон', 'компьютер', 'интернет', 'нейросет', 'блокчейн',
+                  'физик', 'математик', 'калори', 'фильм', 'сериал', 'гитар', 'магазин', 'подарит', 'инвестиц',
+                  'маркетинг', 'презентаци', 'английск', 'который час', 'сколько времени', 'сварить', 'аренд')
+
+_CATALOG_STOPWORDS = frozenset({'и', 'в', 'на', 'о', 'об', 'с', 'со', 'из', 'за', 'под', 'над', 'по', 'к',
+                                'у', 'от', 'до', 'не', 'the', 'of', 'and', 'in', 'a', 'le', 'de'})
+_WORD_RE = re.compile(r'[^\W_]+')
+
+class LiteratureClassifier:
+    """
+    Быстрая локальная проверка, похож ли запрос на литературный. Слова запроса
+    ищутся в каталоге авторов и произведений: точно, по основе (падежные
+    окончания) и по триграммам (опечатки); найденное слово каталога решает сразу.
+    Дальше учитываются слова-признаки литературы и посторонних тем. Отказ выдается только при явных признаках
+    постороннего запроса - сомнительные (в том числе вопросы без признаков:
+    "кто такой печорин") уходят к модели.
+    """
+    
+    def __init__(self, works=None, similarity=0.5, cache_size=50000):
+        self.similarity = similarity
+        self.cache_size = cache_size
+        # Слово каталога -> множество ролей ('author', 'title'); основа -> слова каталога
+        self._words = {}
+        self._stems = {}
+        self._trigrams = {}
+        # Значимые слова каждого названия
+        self._titles = []
+        self._match_cache = {}
+        self._lock = threading.Lock()
+        self.stats = {'checked': 0, 'rejected': 0, 'catalog': 0, 'cue': 0, 'form': 0}
+        self._cue_re = re.compile('|'.join(re.escape(cue) for cue in LITERATURE_CUES))
+        # Только с начала слова: "цена" не должна находиться в "сцена"
+        self._off_topic_re = re.compile(r'(?<![^\W_])(?:' + '|'.join(re.escape(cue) for cue in OFF_TOPIC_CUES) + ')')
+        
+        for authors, titles in (LITERATURE_WORKS if works is None else works):
+            for author in authors:
+                # Имена авторов слишком частые, признаком служит фамилия (последнее слово)
+                words = [word for word in self._normalize(author) if word not in _CATALOG_STOPWORDS]
+                if words:
+                    self._add_word(words[-1], 'author')
+            for title in titles:
+                words = self._significant(title)
+                if not words:
+                    continue
+                self._titles.append(frozenset(words))
+                for word in words:
+                    self._add_word(word, 'title')
+    
+    @staticmethod
+    def _normalize(text):
+        return _WORD_RE.findall(text.lower().replace('ё', 'е'))
+    
+    def _significant(self, text):
+        return [word for word in self._normalize(text) if len(word) >= 3 and word not in _CATALOG_STOPWORDS]
+    
+    @staticmethod
+    def _word_trigrams(word):
+        padded = f' {word} '
+        return {padded[i:i + 3] for i in range(len(padded) - 2)}
+    
+    def _add_word(self, word, role):
+        roles = self._words.get(word)
+        if roles is None:
+            roles = self._words[word] = set()
+            # Основы без 0-2 последних букв: "пушкин" находится по "пушкина", "пушкиным"
+            for length in range(max(4, len(word) - 2), len(word) + 1):
+                self._stems.setdefault(word[:length], set()).add(word)
+            if len(word) >= 5:
+                for trigram in self._word_trigrams(word):
+                    self._trigrams.setdefault(trigram, []).append(word)
+        roles.add(role)
+    
+    def match_word(self, word):
+        """
+        Возвращает (слова каталога, которым соответствует слово запроса; True, если
+        найдены только похожие по триграммам - возможная опечатка)
+        """
+        cached = self._match_cache.get(word)
+        if cached is not None:
+            return cached
+        
+        typo = False
+        if word in self._words:
+            matches = frozenset((word,))
+        else:
+            matches = frozenset()
+            for length in range(len(word) - 1, max(4, len(word) - 3) - 1, -1):
+                stem_matches = self._stems.get(word[:length])
+                if stem_matches:
+                    matches = frozenset(stem_matches)
+                    break
+            if not matches and len(word) >= 5:
+                # Опечатки: сходство Жаккара по триграммам
+                trigrams = self._word_trigrams(word)
+                shared = {}
+                for trigram in trigrams:
+                    for candidate in self._trigrams.get(trigram, ()):
+                        shared[candidate] = shared.get(candidate, 0) + 1
+                matches = frozenset(
+                    candidate for candidate, count in shared.items()
+                    if count / (len(trigrams) + len(self._word_trigrams(candidate)) - count) >= self.similarity
+                )
+                typo = bool(matches)
+        
+        if len(self._match_cache) >= self.cache_size:
+            self._match_cache.clear()
+        self._match_cache[word] = matches, typo
+        return matches, typo
+    
+    def classify(self, text):
+        """Возвращает (похоже на литературный запрос, признак, по которому принято решение)"""
+        lowered = text.lower().replace('ё', 'е')
+        matched = set()
+        similar = set()
+        for word in _WORD_RE.findall(lowered):
+            if word in _CATALOG_STOPWORDS:
+                continue
+            words, typo = self.match_word(word)
+            if any('author' in self._words[catalog_word] for catalog_word in words):
+                matched.update(words)
+            elif typo or len(word) < 4:
+                similar.update(words)
+            else:
+                matched.update(words)
+        
+        # Фамилия автора или слово названия ("онегина", "hamlet") решают сразу: посторонние
+        # слова рядом ("Привет! Расскажи про Онегина") отказа не вызывают
+        if matched:
+            return True, 'catalog'
+        
+        if self._cue_re.search(lowered):
+            return True, 'cue'
+        if self._off_topic_re.search(lowered + ' '):
+            return False, 'off_topic'
+        # Слово названия с опечаткой или короткое ("hello" - "othello", "как") - признак
+        # слабее постороннего: такие совпадения чаще случайны
+        if similar:
+            return True, 'catalog'
+        # Остальное - вопросы о героях ("кто такой печорин"), неизвестные каталогу произведения,
+        # короткие фрагменты ("метро глуховский"): решение остается за моделью
+        return True, 'form'
+    
+    def is_literature(self, text):
+        """classify() со счетчиками для /status и метрик"""
+        with metrics.time('classify'):
+            literature, reason = self.classify(text)
+        with self._lock:
+            self.stats['checked'] += 1
+            if literature:
+                self.stats[reason] += 1
+            else:
+                self.stats['rejected'] += 1
+        metrics.inc('prefilter_total', verdict='literature' if literature else 'off_topic', reason=reason)
+        return literature
+    
+    def get_stats(self):
+        with self._lock:
+            stats = dict(self.stats)
+        stats['catalog_words'] = len(self._words)
+        stats['catalog_titles'] = len(self._titles)
+        return stats
+
+literature_classifier = LiteratureClassifier()
+
 @bot.message_handler(func=lambda message: True)
+@metrics.timed('request')
 def text_handler(message):
     """Обработчик всех текстовых сообщений"""
     try:
@@ -415,7 +2676,7 @@ def text_handler(message):
         chat_id = message.chat.id
         prompt = str(message.text)
         
-        print(f"[LOG] Получен запрос от пользователя {user_id}: {prompt[:50]}...")
+        logger.info(f"Получен запрос от пользователя {user_id}: {prompt[:50]}...", user_id=user_id)
         
         if len(prompt) < 5:
             bot.send_message(
@@ -426,91 +2687,49 @@ def text_handler(message):
             )
             return
         
+        # Посторонние запросы получают отказ сразу, без обращения к модели
+        if LITERATURE_FILTER and not literature_classifier.is_literature(prompt):
+            bot.send_message(chat_id, OFF_TOPIC_TEXT, parse_mode='HTML')
+            logger.info(f"Запрос пользователя {user_id} не похож на литературный, модель не вызывается")
+            return
+        
+        # Слишком частые запросы отклоняем до обращения к модели
+        try:
+            admission.check(user_id)
+        except AdmissionRejected as e:
+            bot.send_message(chat_id, f"⏳ {e}")
+            logger.info(f"Запрос пользователя {user_id} отклонен: {e}")
+            return
+        
         # Отправляем сообщение о начале обработки
-        status_msg = bot.send_message(chat_id, "🔄 <i>Анализирую произведение...</i>", parse_mode='HTML')
+        status_msg = bot.send_message(chat_id, queue_position_text(0), parse_mode='HTML')
         status_message_id = status_msg.message_id
         
-        # Показываем индикатор печати каждые 5 секунд
-        def show_typing_indicator():
-            while not hasattr(show_typing_indicator, 'stop'):
-                try:
-                    bot.send_chat_action(chat_id, 'typing')
-                    time.sleep(5)
-                except:
-                    break
+        # Пока запрос ждет места у модели, в статусном сообщении показывается очередь
+        def show_queue_position(position):
+            bot.edit_message_text(queue_position_text(position), chat_id, status_message_id, parse_mode='HTML')
+        
+        # Показываем индикатор печати, пока готовится ответ
+        typing = chat_actions.start(chat_id)
         
-        # Запускаем индикатор печати в отдельном потоке
-        import threading
-        typing_thread = threading.Thread(target=show_typing_indicator)
-        typing_thread.daemon = True
-        typing_thread.start()
+        # При потоковой выдаче текст появляется в статусном сообщении по мере генерации
+        streaming_reply = StreamingReply(chat_id, status_message_id) if STREAM_RESPONSES else None
         
         try:
             # Получаем ответ от нейросети
-            response = get_answer(prompt)
+            response, formatted = get_cached_answer(
+                prompt,
+                on_delta=streaming_reply.feed if streaming_reply else None,
+                slot=admission.slot(user_id, on_position=show_queue_position)
+            )
             
             # Останавливаем индикатор печати
-            show_typing_indicator.stop = True
-            typing_thread.join(timeout=1)
-            
-            # Форматируем ответ
-            formatted_response = format_ai_response(response)
-            
-            # Проверяем длину ответа
-            if len(formatted_response) > 4000:
-                # Разбиваем на части
-                parts = []
-                current_part = ""
-                
-                for paragraph in formatted_response.split('\n\n'):
-                    if len(current_part) + len(paragraph) + 2 < 4000:
-                        current_part += paragraph + '\n\n'
-                    else:
-                        parts.append(current_part)
-                        current_part = paragraph + '\n\n'
-                
-                if current_part:
-                    parts.append(current_part)
-                
-                # Удаляем статусное сообщение
-                try:
-                    bot.delete_message(chat_id, status_message_id)
-                except:
-                    pass
-                
-                # Отправляем первую часть
-                first_part = parts[0]
-                if len(first_part) > 4000:
-                    first_part = first_part[:4000]
-                
-                sent_msg = bot.send_message(chat_id, first_part, parse_mode='HTML')
-                last_message_id = sent_msg.message_id
-                
-                # Отправляем остальные части как отдельные сообщения
-                for i, part in enumerate(parts[1:], 1):
-                    if len(part) > 4000:
-                        part = part[:4000]
-                    
-                    # Добавляем номер части
-                    part_with_number = f"<b>Часть {i+1}</b>\n\n{part}"
-                    sent_msg = bot.send_message(chat_id, part_with_number, parse_mode='HTML')
-                    last_message_id = sent_msg.message_id
-                    
-            else:
-                # Удаляем статусное сообщение
-                try:
-                    bot.delete_message(chat_id, status_message_id)
-                except:
-                    pass
-                
-                # Отправляем форматированный ответ
-                bot.send_message(chat_id, formatted_response, parse_mode='HTML')
+            typing.stop()
             
-            print(f'[LOG] Ответ успешно отправлен пользователю {user_id}, длина: {len(response)} символов')
-            
-        except Exception as e:
-            # Останавливаем индикатор печати
-            show_typing_indicator.stop = True
+            if streaming_reply and streaming_reply.started:
+                streaming_reply.finish()
+                logger.info(f'Ответ выдан потоково пользователю {user_id}, длина: {len(response)} символов, сообщений: {len(streaming_reply.message_ids)}')
+                return
             
             # Удаляем статусное сообщение
             try:
@@ -518,12 +2737,38 @@ def text_handler(message):
             except:
                 pass
             
+            # Отправляем форматированный ответ (длинный - несколькими сообщениями)
+            for part in build_reply_parts(formatted or format_ai_response(response)):
+                with metrics.time('send_message'):
+                    bot.send_message(chat_id, part, parse_mode='HTML')
+            
+            logger.info(f'Ответ успешно отправлен пользователю {user_id}, длина: {len(response)} символов')
+        
+        except AdmissionRejected as e:
+            typing.stop()
+            try:
+                bot.edit_message_text(f"⏳ {html.escape(str(e))}", chat_id, status_message_id, parse_mode='HTML')
+            except:
+                pass
+            logger.info(f"Запрос пользователя {user_id} отклонен: {e}")
+            
+        except Exception as e:
+            # Останавливаем индикатор печати
+            typing.stop()
+            
+            # Удаляем статусное сообщение (уже выданную потоком часть ответа оставляем)
+            if not (streaming_reply and streaming_reply.started):
+                try:
+                    bot.delete_message(chat_id, status_message_id)
+                except:
+                    pass
+            
             error_msg = f"Произошла ошибка при анализе произведения:\n\n<code>{str(e)[:200]}</code>"
             bot.send_message(chat_id, error_msg, parse_mode='HTML')
-            print(f"[ERROR] Ошибка при обработке запроса: {e}")
+            logger.error(f"Ошибка при обработке запроса: {e}")
             
     except Exception as e:
-        print(f"[ERROR] Критическая ошибка в обработчике: {e}")
+        logger.error(f"Критическая ошибка в обработчике: {e}")
         try:
             bot.send_message(
                 chat_id,
@@ -532,56 +2777,1780 @@ def text_handler(message):
         except:
             pass
 
-def get_answer(content):
-    """Функция для получения ответа от модели"""
-    client = OpenAI(
-        base_url="https://router.huggingface.co/v1",
-        api_key=HUGGINGFACE_TOKEN
-    )
+# Настройки подключения к модели
+LLM_BASE_URL = os.getenv('LLM_BASE_URL', 'https://router.huggingface.co/v1')
+LLM_MODEL = os.getenv('LLM_MODEL', 'deepseek-ai/DeepSeek-V3.2-Exp:novita')
+LLM_POOL_SIZE = int(os.getenv('LLM_POOL_SIZE', '10'))
+LLM_CONNECT_TIMEOUT = float(os.getenv('LLM_CONNECT_TIMEOUT', '10'))
+LLM_READ_TIMEOUT = float(os.getenv('LLM_READ_TIMEOUT', '120'))
+LLM_MAX_RETRIES = int(os.getenv('LLM_MAX_RETRIES', '3'))
+# Просить у модели статистику токенов в потоковом режиме (stream_options.include_usage)
+LLM_STREAM_USAGE = os.getenv('LLM_STREAM_USAGE', '1') == '1'
+# Дополнительные модели: "имя|base_url|модель|переменная окружения с ключом; ..." (без переменной - HUGGINGFACE_TOKEN).
+# Основная модель - LLM_BASE_URL и LLM_MODEL; запрос уходит той, что быстрее отвечала и не падала
+LLM_BACKENDS = os.getenv('LLM_BACKENDS', '')
+# Дублировать запрос следующей модели, если первая не начала отвечать дольше своего p95 (только при 2+ моделях)
+LLM_HEDGE = os.getenv('LLM_HEDGE', '1') == '1'
+# Задержка дубля, пока у модели мало замеров первого токена, и нижняя граница задержки
+LLM_HEDGE_DELAY = float(os.getenv('LLM_HEDGE_DELAY', '8'))
+LLM_HEDGE_MIN_DELAY = float(os.getenv('LLM_HEDGE_MIN_DELAY', '0.5'))
+# Доля запросов, которые можно дублировать: дубли не должны удваивать нагрузку при общем замедлении
+LLM_HEDGE_MAX_SHARE = float(os.getenv('LLM_HEDGE_MAX_SHARE', '0.1'))
+# Потоки для дублей (основная попытка идет в потоке запроса): доля от одновременных генераций
+LLM_HEDGE_WORKERS = max(1, math.ceil(LLM_HEDGE_MAX_SHARE * ADMISSION_MAX_ACTIVE))
+# После стольких ошибок подряд модель пропускается LLM_BACKEND_COOLDOWN секунд
+LLM_BACKEND_FAILURES = int(os.getenv('LLM_BACKEND_FAILURES', '3'))
+LLM_BACKEND_COOLDOWN = float(os.getenv('LLM_BACKEND_COOLDOWN', '30'))
 
-    completion = client.chat.completions.create(
-        model="deepseek-ai/DeepSeek-V3.2-Exp:novita",
-        messages=[
-            {
-                "role": "user",
-                "content": f'{content} (ТЕХНИЧЕСКОЕ ЗАДАНИЕ: Обязательно проверь, что до тех. задания я написал название литературного произведения и автора этого произведения. Если все соответствует - то сделай очень подробный анализ этого произведения. Если до тех. задания я вставил никак не относящийся к литературе запрос, то напиши текст о том, что ты занимаешься именно разбором литературных произведений и ничего более)'
-            }
-        ],
-        max_tokens=3500,
-        temperature=0.7,
-    )
+TECHNICAL_TASK = ('ТЕХНИЧЕСКОЕ ЗАДАНИЕ: Обязательно проверь, что до тех. задания я написал название литературного произведения и автора этого произведения. '
+                  'Если все соответствует - то сделай очень подробный анализ этого произведения. '
+                  'Если до тех. задания я вставил никак не относящийся к литературе запрос, то напиши текст о том, что ты занимаешься именно разбором литературных произведений и ничего более')
 
-    return completion.choices[0].message.content
+# Ответ модели по последнему пункту ТЗ: короткий текст о том, что она разбирает только произведения
+_MODEL_REFUSAL_RE = re.compile(r'занимаюсь\s+(?:\w+\s+){0,3}разбор\w*\s+литературн', re.IGNORECASE)
+MODEL_REFUSAL_MAX_CHARS = 1000
+
+def is_model_refusal(response):
+    """True, если модель не стала делать анализ, сочтя запрос не относящимся к литературе"""
+    return len(response) <= MODEL_REFUSAL_MAX_CHARS and _MODEL_REFUSAL_RE.search(response) is not None
+
+def _stream_line_content(line, response, usage=None):
+    """
+    Извлекает текст из строки server-sent events потокового ответа модели.
+    Статистика токенов из последнего чанка (stream_options.include_usage) попадает в usage.
+    """
+    if not line.startswith('data:'):
+        return None
+    data = line[5:].strip()
+    if not data or data == '[DONE]':
+        return None
+    chunk = json.loads(data)
+    if chunk.get('error'):
+        raise openai.APIError(str(chunk['error']), response.http_response.request, body=chunk['error'])
+    if usage is not None and chunk.get('usage'):
+        usage.update(chunk['usage'])
+    choices = chunk.get('choices')
+    if not choices:
+        return None
+    return (choices[0].get('delta') or {}).get('content')
+
+class _LLMCallScope:
+    """
+    Запрос к модели в текущем потоке (контекстная переменная _llm_call_scope): срок,
+    к которому он должен начать отвечать, и отмена из другого потока. Наступивший срок
+    вызывает on_deadline в потоке запроса, пока тот ждет ответа. Отмена закрывает сокет,
+    на котором запрос ждет, - блокирующее чтение прерывается сразу, и шлюз не повторяет запрос.
+    """
+    
+    def __init__(self):
+        self.deadline = None
+        self.on_deadline = None
+        self._cancelled = threading.Event()
+        self._lock = threading.Lock()
+        self._stream = None
+    
+    @property
+    def cancelled(self):
+        return self._cancelled.is_set()
+    
+    def attach(self, stream):
+        """Запоминает соединение, которым пользуется запрос; отмененный запрос им больше не пользуется"""
+        with self._lock:
+            if self.cancelled:
+                raise httpcore.ReadError('запрос к модели отменен')
+            self._stream = stream
+            stream.scope = self
+    
+    def detach(self):
+        """Запрос завершен: соединение вернулось в пул и отмена его больше не касается"""
+        with self._lock:
+            self._stream = None
+    
+    def wait_time(self):
+        """Секунды до срока (None - срока нет); наступивший срок срабатывает здесь же"""
+        if self.deadline is None:
+            return None
+        remaining = self.deadline - time.perf_counter()
+        if remaining > 0:
+            return remaining
+        self.deadline = None
+        self.on_deadline()
+        return None
+    
+    def sleep(self, seconds):
+        """Пауза перед повтором: прерывается отменой, срок за это время тоже срабатывает"""
+        until = time.perf_counter() + seconds
+        while not self.cancelled:
+            remaining = until - time.perf_counter()
+            if remaining <= 0:
+                return
+            wait = self.wait_time()
+            self._cancelled.wait(remaining if wait is None else min(wait, remaining))
+    
+    def cancel(self):
+        with self._lock:
+            self._cancelled.set()
+            stream = self._stream
+        if stream is not None:
+            stream.abort(self)
+
+_llm_call_scope = contextvars.ContextVar('llm_call_scope', default=None)
+
+class _LLMNetworkStream(httpcore.NetworkStream):
+    """Соединение шлюза модели: чтение учитывает срок и отмену запроса из _llm_call_scope"""
+    
+    def __init__(self, stream):
+        self._stream = stream
+        # Запрос, который пользовался соединением последним
+        self.scope = None
+    
+    def read(self, max_bytes, timeout=None):
+        scope = _llm_call_scope.get()
+        if scope is None:
+            return self._stream.read(max_bytes, timeout)
+        scope.attach(self)
+        while True:
+            wait = scope.wait_time()
+            if wait is None or (timeout is not None and timeout <= wait):
+                return self._stream.read(max_bytes, timeout)
+            # Ждем не дольше срока: по таймауту данные не теряются, чтение продолжается
+            try:
+                return self._stream.read(max_bytes, wait)
+            except httpcore.ReadTimeout:
+                if timeout is not None:
+                    timeout -= wait
+    
+    def write(self, buffer, timeout=None):
+        scope = _llm_call_scope.get()
+        if scope is not None:
+            scope.attach(self)
+        self._stream.write(buffer, timeout)
+    
+    def close(self):
+        self._stream.close()
+    
+    def start_tls(self, ssl_context, server_hostname=None, timeout=None):
+        return _LLMNetworkStream(self._stream.start_tls(ssl_context, server_hostname, timeout))
+    
+    def get_extra_info(self, info):
+        return self._stream.get_extra_info(info)
+    
+    def abort(self, scope):
+        """Прерывает ожидание запроса scope в другом потоке: recv будит shutdown, а не close"""
+        sock = self._stream.get_extra_info('socket')
+        if sock is not None and self.scope is scope:
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+class _LLMNetworkBackend(httpcore.SyncBackend):
+    def connect_tcp(self, *args, **kwargs):
+        return _LLMNetworkStream(super().connect_tcp(*args, **kwargs))
+
+class LLMGateway:
+    """
+    Долгоживущий клиент модели: общий пул keep-alive соединений,
+    повторные попытки с джиттером при 429/5xx и счетчики переиспользования соединений
+    """
+    
+    RETRYABLE_ERRORS = (openai.RateLimitError, openai.InternalServerError,
+                        openai.APIConnectionError, openai.APITimeoutError)
+    
+    def __init__(self, base_url, api_key, pool_size=10, connect_timeout=10.0,
+                 read_timeout=120.0, max_retries=3, backoff_base=1.0, backoff_cap=20.0):
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_cap = backoff_cap
+        self._lock = threading.Lock()
+        self.stats = {'requests': 0, 'retries': 0, 'errors': 0,
+                      'connection_hits': 0, 'connection_misses': 0,
+                      'prompt_tokens': 0, 'completion_tokens': 0}
+        
+        self.http_client, self.client = self._create_clients(
+            base_url, api_key,
+            httpx.Limits(max_connections=pool_size, max_keepalive_connections=pool_size),
+            httpx.Timeout(read_timeout, connect=connect_timeout),
+        )
+    
+    def _create_clients(self, base_url, api_key, limits, timeout):
+        transport = httpx.HTTPTransport(limits=limits)
+        # httpx не передает network_backend в пул соединений: без него запрос нельзя прервать из другого потока
+        transport._pool._network_backend = _LLMNetworkBackend()
+        http_client = httpx.Client(
+            transport=transport,
+            timeout=timeout,
+            event_hooks={'request': [self._on_request], 'response': [self._on_response]},
+        )
+        # Повторы выполняет сам шлюз, поэтому встроенные повторы клиента отключены
+        client = OpenAI(base_url=base_url, api_key=api_key, http_client=http_client, max_retries=0)
+        return http_client, client
+    
+    def _on_request(self, request):
+        """
+        Отслеживает, открывалось ли для запроса новое TCP-соединение. Отметка хранится
+        в самом запросе: при обрыве соединения ответа нет, и в шлюзе ничего не остается.
+        """
+        request.extensions['new_connection'] = False
+        
+        def trace(event_name, info):
+            if event_name == 'connection.connect_tcp.started':
+                request.extensions['new_connection'] = True
+        
+        request.extensions['trace'] = trace
+    
+    def _on_response(self, response):
+        """Учитывает попадание или промах пула соединений"""
+        new_connection = response.request.extensions.get('new_connection', False)
+        with self._lock:
+            self.stats['connection_misses' if new_connection else 'connection_hits'] += 1
+    
+    def _record_usage(self, prompt_tokens, completion_tokens):
+        """Учитывает расход токенов из completion.usage"""
+        with self._lock:
+            self.stats['prompt_tokens'] += prompt_tokens or 0
+            self.stats['completion_tokens'] += completion_tokens or 0
+        metrics.inc('llm_tokens_total', prompt_tokens or 0, kind='prompt')
+        metrics.inc('llm_tokens_total', completion_tokens or 0, kind='completion')
+    
+    def _stream_params(self, params):
+        if LLM_STREAM_USAGE:
+            params.setdefault('stream_options', {'include_usage': True})
+        return params
+    
+    def _backoff(self, attempt, error):
+        """Пауза перед повтором: Retry-After от сервера или экспонента с полным джиттером"""
+        response = getattr(error, 'response', None)
+        retry_after = response.headers.get('retry-after') if response is not None else None
+        if retry_after:
+            try:
+                return min(float(retry_after), self.backoff_cap)
+            except ValueError:
+                pass
+        return random.uniform(0, min(self.backoff_cap, self.backoff_base * 2 ** attempt))
+    
+    def _retry_delay(self, attempt, error):
+        """Возвращает паузу перед повтором либо пробрасывает ошибку, если попытки исчерпаны"""
+        scope = _llm_call_scope.get()
+        if scope is not None and scope.cancelled:
+            # Запрос отменил пул моделей: ответ уже дала другая модель
+            raise error
+        if attempt == self.max_retries:
+            with self._lock:
+                self.stats['errors'] += 1
+            raise error
+        wait_time = self._backoff(attempt, error)
+        logger.warning(f"Ошибка модели ({type(error).__name__}), повтор через {wait_time:.1f} с")
+        metrics.inc('llm_retries_total', type=type(error).__name__)
+        with self._lock:
+            self.stats['retries'] += 1
+        return wait_time
+    
+    def _before_retry(self, attempt, error):
+        """Ждет перед повтором либо пробрасывает ошибку, если попытки исчерпаны"""
+        wait_time = self._retry_delay(attempt, error)
+        scope = _llm_call_scope.get()
+        if scope is None:
+            time.sleep(wait_time)
+        else:
+            scope.sleep(wait_time)
+    
+    def complete(self, **params):
+        """Выполняет chat.completions.create с повторными попытками"""
+        with self._lock:
+            self.stats['requests'] += 1
+        
+        for attempt in range(self.max_retries + 1):
+            try:
+                completion = self.client.chat.completions.create(**params)
+            except self.RETRYABLE_ERRORS as e:
+                self._before_retry(attempt, e)
+                continue
+            except Exception:
+                with self._lock:
+                    self.stats['errors'] += 1
+                raise
+            if completion.usage is not None:
+                self._record_usage(completion.usage.prompt_tokens, completion.usage.completion_tokens)
+            return completion
+    
+    def stream(self, **params):
+        """
+        Генератор фрагментов текста ответа в потоковом режиме.
+        Повторяет запрос только пока не получен первый фрагмент.
+        """
+        with self._lock:
+            self.stats['requests'] += 1
+        
+        self._stream_params(params)
+        for attempt in range(self.max_retries + 1):
+            received = False
+            usage = {}
+            try:
+                # Поток разбирается вручную: модели openai на каждый чанк заметно дороже json.loads
+                with self.client.chat.completions.with_streaming_response.create(stream=True, **params) as response:
+                    for line in response.iter_lines():
+                        content = _stream_line_content(line, response, usage)
+                        if content:
+                            received = True
+                            yield content
+                if usage:
+                    self._record_usage(usage.get('prompt_tokens'), usage.get('completion_tokens'))
+                return
+            except self.RETRYABLE_ERRORS as e:
+                if received:
+                    with self._lock:
+                        self.stats['errors'] += 1
+                    raise
+                self._before_retry(attempt, e)
+            except Exception:
+                with self._lock:
+                    self.stats['errors'] += 1
+                raise
+    
+    def probe(self, timeout=10.0):
+        """
+        Легкий запрос к API (список моделей) без повторов и без учета в счетчиках запросов.
+        Исключение - API недоступен; 404 означает лишь, что сервер не отдает список моделей.
+        """
+        try:
+            self.client.with_options(timeout=timeout).models.list()
+        except openai.NotFoundError:
+            pass
+    
+    def get_stats(self):
+        """Возвращает копию счетчиков шлюза"""
+        with self._lock:
+            return dict(self.stats)
+
+class LLMBackend:
+    """
+    Одна модель за OpenAI-совместимым API: свой шлюз и оценки по последним запросам -
+    EWMA и p95 задержки (первого токена при потоковой выдаче, полного ответа без нее)
+    и доля ошибок. После LLM_BACKEND_FAILURES ошибок подряд модель временно пропускается.
+    """
+    
+    KINDS = ('first_token', 'complete')
+    # Вес нового замера в EWMA и число последних замеров для p95
+    EWMA_ALPHA = 0.2
+    WINDOW = 200
+    # Меньше замеров - p95 ненадежен, задержка дубля берется из настроек
+    MIN_SAMPLES = 20
+    
+    def __init__(self, name, model, gateway, failures=LLM_BACKEND_FAILURES, cooldown=LLM_BACKEND_COOLDOWN):
+        self.name = name
+        self.model = model
+        self.gateway = gateway
+        self.failures = failures
+        self.cooldown = cooldown
+        self._lock = threading.Lock()
+        self._latencies = {kind: deque(maxlen=self.WINDOW) for kind in self.KINDS}
+        self._ewma = dict.fromkeys(self.KINDS)
+        self.error_rate = 0.0
+        self.consecutive_failures = 0
+        self.down_until = 0.0
+        self.stats = {'attempts': 0, 'wins': 0, 'failures': 0, 'hedges': 0, 'cancelled': 0}
+    
+    def _update_ewma(self, kind, seconds):
+        previous = self._ewma[kind]
+        self._ewma[kind] = seconds if previous is None else previous + self.EWMA_ALPHA * (seconds - previous)
+    
+    def record_success(self, kind, seconds):
+        with self._lock:
+            self._latencies[kind].append(seconds)
+            self._update_ewma(kind, seconds)
+            self.error_rate -= self.EWMA_ALPHA * self.error_rate
+            self.consecutive_failures = 0
+            self.down_until = 0.0
+    
+    def record_failure(self):
+        with self._lock:
+            self.stats['failures'] += 1
+            self.error_rate += self.EWMA_ALPHA * (1 - self.error_rate)
+            self.consecutive_failures += 1
+            if self.consecutive_failures >= self.failures:
+                self.down_until = time.time() + self.cooldown
+    
+    def record_cancel(self, kind, seconds):
+        """Отмененная попытка так и не ответила за seconds: это нижняя оценка ее задержки"""
+        with self._lock:
+            self.stats['cancelled'] += 1
+            if self._ewma[kind] is None or seconds > self._ewma[kind]:
+                self._update_ewma(kind, seconds)
+    
+    def count(self, name):
+        with self._lock:
+            self.stats[name] += 1
+    
+    def healthy(self, now=None):
+        return self.down_until <= (time.time() if now is None else now)
+    
+    def expected_latency(self, kind):
+        """EWMA задержки; модель без замеров считается самой быстрой, чтобы получить первые замеры"""
+        with self._lock:
+            ewma = self._ewma[kind]
+        return 0.0 if ewma is None else ewma * (1 + self.error_rate)
+    
+    def hedge_delay(self, kind):
+        """Через сколько секунд без ответа дублировать запрос (None - не дублировать)"""
+        with self._lock:
+            latencies = sorted(self._latencies[kind])
+        if len(latencies) < self.MIN_SAMPLES:
+            # Полный ответ длится десятки секунд: без замеров дублировать его не по чему
+            return LLM_HEDGE_DELAY if kind == 'first_token' else None
+        return max(LLM_HEDGE_MIN_DELAY, latencies[int(0.95 * (len(latencies) - 1))])
+    
+    def get_stats(self):
+        with self._lock:
+            stats = dict(self.stats)
+            latencies = {kind: sorted(values) for kind, values in self._latencies.items()}
+            stats['ewma'] = dict(self._ewma)
+            stats['error_rate'] = self.error_rate
+        stats['name'] = self.name
+        stats['model'] = self.model
+        stats['healthy'] = self.healthy()
+        stats['p95'] = {kind: values[int(0.95 * (len(values) - 1))] if values else None
+                        for kind, values in latencies.items()}
+        return stats
+
+def parse_llm_backends(text):
+    """Разбирает LLM_BACKENDS в список (имя, base_url, модель, ключ)"""
+    backends = []
+    for item in re.split(r'[;\n]', text):
+        if not item.strip():
+            continue
+        parts = [part.strip() for part in item.split('|')]
+        if len(parts) not in (3, 4) or not all(parts[:3]):
+            raise ValueError(f"Неверное описание модели в LLM_BACKENDS: {item.strip()!r}")
+        api_key = os.getenv(parts[3], '') if len(parts) == 4 and parts[3] else HUGGINGFACE_TOKEN
+        backends.append((parts[0], parts[1], parts[2], api_key))
+    return backends
+
+def create_llm_backends(gateway_class):
+    """Основная модель (LLM_BASE_URL, LLM_MODEL) и дополнительные из LLM_BACKENDS, у каждой свой шлюз"""
+    specs = [('main', LLM_BASE_URL, LLM_MODEL, HUGGINGFACE_TOKEN)] + parse_llm_backends(LLM_BACKENDS)
+    return [
+        LLMBackend(name, model, gateway_class(
+            base_url=base_url,
+            api_key=api_key,
+            pool_size=LLM_POOL_SIZE,
+            connect_timeout=LLM_CONNECT_TIMEOUT,
+            read_timeout=LLM_READ_TIMEOUT,
+            max_retries=LLM_MAX_RETRIES,
+        ))
+        for name, base_url, model, api_key in specs
+    ]
+
+class _Attempt:
+    """Запрос к одной модели в рамках LLMBackendPool.run"""
+    __slots__ = ('backend', 'hedge', 'started', 'answered', 'finished', 'cancelled', 'task', 'scope')
+    
+    def __init__(self, backend, hedge):
+        self.backend = backend
+        self.hedge = hedge
+        self.started = time.perf_counter()
+        self.answered = False
+        self.finished = False
+        self.cancelled = threading.Event()
+        self.task = None
+        self.scope = _LLMCallScope()
+    
+    def cancel(self):
+        self.cancelled.set()
+        if self.task is not None:
+            self.task.cancel()
+        self.scope.cancel()
+
+class _Race:
+    """Попытки одного LLMBackendPool.run: побеждает первая ответившая, выбор - под блокировкой"""
+    __slots__ = ('lock', 'attempts', 'winner', 'results', 'pending', 'started')
+    
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.attempts = []
+        self.winner = None
+        # События дублей для вызывающего: ('delta' | 'done' | 'error', попытка, данные)
+        self.results = queue.Queue()
+        # Дубли, от которых еще ждем ответа (меняется только в потоке вызывающего)
+        self.pending = set()
+        self.started = time.perf_counter()
+
+class LLMBackendPool:
+    """
+    Набор моделей с выбором самой быстрой исправной. Если она не начала отвечать
+    дольше своего p95, тот же запрос уходит следующей модели (дубль); побеждает
+    первый ответ, проигравший запрос отменяется. Ошибка модели до ответа сразу
+    передает запрос следующей. Временно отключенные модели дублей не получают,
+    а после ошибки запрос уходит к ним, только если исправных не осталось.
+    
+    Основная попытка (и переданные после ошибки) выполняется в потоке вызывающего,
+    дубли - в пуле из hedge_workers потоков; если все они заняты, дубль не отправляется.
+    Фрагменты ответа передаются в on_delta в потоке вызывающего. Отмена закрывает
+    соединение проигравшей попытки, в том числе еще не начавшей отвечать.
+    """
+    
+    # Через сколько секунд снова пробовать отправить дубль, если все потоки дублей заняты
+    HEDGE_BUSY_RETRY = 0.05
+    
+    def __init__(self, backends, hedge=LLM_HEDGE, hedge_share=LLM_HEDGE_MAX_SHARE, hedge_workers=LLM_HEDGE_WORKERS):
+        self.backends = backends
+        self.hedge = hedge and len(backends) > 1
+        self.hedge_share = hedge_share
+        self._lock = threading.Lock()
+        self.stats = {'runs': 0, 'hedged': 0, 'hedge_wins': 0, 'hedge_busy': 0, 'failovers': 0, 'last_resort': 0}
+        # Потоки создаются при первом дубле
+        self._hedge_slots = threading.BoundedSemaphore(hedge_workers)
+        self._hedge_executor = ThreadPoolExecutor(max_workers=hedge_workers, thread_name_prefix='llm-hedge')
+    
+    @property
+    def primary(self):
+        return self.backends[0]
+    
+    def ranked(self, kind):
+        """Исправные модели по ожидаемой задержке, затем временно отключенные (на крайний случай)"""
+        now = time.time()
+        healthy = sorted((backend for backend in self.backends if backend.healthy(now)),
+                         key=lambda backend: backend.expected_latency(kind))
+        resting = sorted((backend for backend in self.backends if not backend.healthy(now)),
+                         key=lambda backend: backend.down_until)
+        return healthy + resting
+    
+    @staticmethod
+    def _prefer_healthy(candidates):
+        """
+        Ставит исправные модели в начало candidates, сохраняя порядок (за время запроса
+        модель могла отключиться или вернуться); True, если исправные есть
+        """
+        now = time.time()
+        candidates.sort(key=lambda backend: not backend.healthy(now))
+        return bool(candidates) and candidates[0].healthy(now)
+    
+    def _hedge_allowed(self, candidates):
+        """Дубль получает только исправная модель и только в пределах доли hedge_share"""
+        if not self._prefer_healthy(candidates):
+            return False
+        with self._lock:
+            if self.stats['hedged'] >= self.hedge_share * self.stats['runs']:
+                return False
+            self.stats['hedged'] += 1
+        return True
+    
+    def _new_attempt(self, candidates, hedge=False):
+        backend = candidates.pop(0)
+        attempt = _Attempt(backend, hedge)
+        backend.count('hedges' if hedge else 'attempts')
+        if hedge:
+            metrics.inc('llm_hedges_total', backend=backend.name)
+        return attempt
+    
+    def _cancel_others(self, winner, pending, kind):
+        winner.backend.count('wins')
+        if winner.hedge:
+            with self._lock:
+                self.stats['hedge_wins'] += 1
+        metrics.inc('llm_backend_wins_total', backend=winner.backend.name)
+        for attempt in pending:
+            if attempt is not winner:
+                attempt.cancel()
+                if not attempt.answered:
+                    attempt.backend.record_cancel(kind, time.perf_counter() - attempt.started)
+    
+    def _failover(self, attempt, error, candidates, pending):
+        """Учитывает ошибку попытки; True - запрос нужно отправить следующей модели"""
+        failover = bool(candidates) and not pending
+        last_resort = failover and not self._prefer_healthy(candidates)
+        logger.warning(f"Модель {attempt.backend.name} не ответила ({type(error).__name__}: {str(error)[:200]})"
+                       + (", исправных не осталось - запрос передан временно отключенной" if last_resort
+                          else ", запрос передан следующей" if failover else ''))
+        if failover:
+            with self._lock:
+                self.stats['failovers'] += 1
+                self.stats['last_resort'] += last_resort
+            metrics.inc('llm_failovers_total', backend=attempt.backend.name)
+            return True
+        return False
+    
+    def _claim(self, race, attempt, kind):
+        """Первая ответившая попытка побеждает и отменяет остальные; False - ответ уже дала другая"""
+        with race.lock:
+            if race.winner is not None:
+                return race.winner is attempt
+            race.winner = attempt
+            others = [other for other in race.attempts if not other.finished]
+        self._cancel_others(attempt, others, kind)
+        if kind == 'first_token':
+            metrics.observe('llm_first_token', time.perf_counter() - race.started)
+        return True
+    
+    def _attempt(self, attempt, params, kind, race, deliver):
+        """
+        Выполняет попытку в текущем потоке; фрагменты ответа после победы передаются в deliver.
+        Возвращает (победила ли попытка, текст ответа без потоковой выдачи).
+        """
+        backend = attempt.backend
+        params = dict(params, model=backend.model)
+        token = _llm_call_scope.set(attempt.scope)
+        try:
+            if kind == 'complete':
+                completion = backend.gateway.complete(**params)
+                attempt.answered = True
+                backend.record_success(kind, time.perf_counter() - attempt.started)
+                return self._claim(race, attempt, kind), completion.choices[0].message.content
+            stream = backend.gateway.stream(**params)
+            try:
+                for fragment in stream:
+                    if not attempt.answered:
+                        attempt.answered = True
+                        backend.record_success(kind, time.perf_counter() - attempt.started)
+                        if not self._claim(race, attempt, kind):
+                            return False, None
+                    deliver(fragment)
+            finally:
+                stream.close()
+            return self._claim(race, attempt, kind), None
+        except Exception:
+            if attempt.cancelled.is_set() and race.winner is not attempt:
+                return False, None
+            backend.record_failure()
+            raise
+        finally:
+            attempt.finished = True
+            _llm_call_scope.reset(token)
+            attempt.scope.detach()
+    
+    def _hedge(self, race, candidates, params, kind, scope):
+        """Основная попытка не ответила к сроку: дубль уходит следующей исправной модели"""
+        if not self._hedge_slots.acquire(blocking=False):
+            with self._lock:
+                self.stats['hedge_busy'] += 1
+            # Все потоки дублей заняты: проверим снова чуть позже, пока основная попытка ждет
+            scope.deadline = time.perf_counter() + self.HEDGE_BUSY_RETRY
+            return
+        if not self._hedge_allowed(candidates):
+            self._hedge_slots.release()
+            return
+        attempt = self._new_attempt(candidates, hedge=True)
+        with race.lock:
+            race.attempts.append(attempt)
+        race.pending.add(attempt)
+        # Поток получает копию контекста: записи журнала остаются в области текущего запроса
+        context = contextvars.copy_context()
+        self._hedge_executor.submit(context.run, self._run_hedge, attempt, params, kind, race)
+    
+    def _run_hedge(self, attempt, params, kind, race):
+        """Выполняется в пуле дублей: фрагменты и итог победившего дубля уходят вызывающему через очередь"""
+        try:
+            won, answer = self._attempt(attempt, params, kind, race,
+                                        lambda fragment: race.results.put(('delta', attempt, fragment)))
+            if won:
+                race.results.put(('done', attempt, answer))
+        except Exception as e:
+            race.results.put(('error', attempt, e))
+        finally:
+            self._hedge_slots.release()
+    
+    def run(self, params, on_delta=None):
+        """Возвращает текст ответа; on_delta получает фрагменты потокового ответа победившей модели"""
+        kind = 'complete' if on_delta is None else 'first_token'
+        with self._lock:
+            self.stats['runs'] += 1
+        candidates = self.ranked(kind)
+        race = _Race()
+        fragments = []
+        
+        def deliver(fragment):
+            fragments.append(fragment)
+            on_delta(fragment)
+        
+        attempt = self._new_attempt(candidates)
+        if self.hedge:
+            delay = attempt.backend.hedge_delay(kind)
+            if delay is not None:
+                # Срок проверяется, пока основная попытка ждет ответа в этом же потоке
+                attempt.scope.deadline = attempt.started + delay
+                attempt.scope.on_deadline = functools.partial(self._hedge, race, candidates, params, kind, attempt.scope)
+        
+        try:
+            while True:
+                if attempt is not None:
+                    with race.lock:
+                        race.attempts.append(attempt)
+                    try:
+                        won, answer = self._attempt(attempt, params, kind, race, deliver)
+                    except Exception as e:
+                        if race.winner is attempt:
+                            raise
+                        failed, error = attempt, e
+                    else:
+                        # Проигравшая дублю попытка: ответ придет через очередь
+                        if won:
+                            return answer if kind == 'complete' else ''.join(fragments)
+                        attempt = None
+                        continue
+                else:
+                    event, hedge, payload = race.results.get()
+                    if event == 'delta':
+                        deliver(payload)
+                        continue
+                    if event == 'done':
+                        return payload if kind == 'complete' else ''.join(fragments)
+                    race.pending.discard(hedge)
+                    if hedge is race.winner:
+                        raise payload
+                    failed, error = hedge, payload
+                
+                attempt = None
+                if self._failover(failed, error, candidates, race.pending):
+                    attempt = self._new_attempt(candidates)
+                elif not race.pending:
+                    raise error
+        finally:
+            # Ошибка в on_delta не должна оставлять генерацию работать впустую
+            for other in race.attempts:
+                other.cancel()
+    
+    def get_stats(self):
+        """Суммарные счетчики шлюзов (как LLMGateway.get_stats), счетчики дублей и 'backends' по моделям"""
+        totals = {}
+        for backend in self.backends:
+            for name, value in backend.gateway.get_stats().items():
+                totals[name] = totals.get(name, 0) + value
+        with self._lock:
+            totals.update(self.stats)
+        totals['backends'] = [backend.get_stats() for backend in self.backends]
+        return totals
+
+llm_pool = LLMBackendPool(create_llm_backends(LLMGateway))
+# Шлюз основной модели: ключ из /reset config и проверка доступности API
+llm_gateway = llm_pool.primary.gateway
+
+# ===== Фоновый сбор показателей ресурсов и проверка доступности модели =====
+RESOURCE_SAMPLE_INTERVAL = float(os.getenv('RESOURCE_SAMPLE_INTERVAL', '5'))
+# Глубина истории: кольцевой буфер на RESOURCE_HISTORY_MINUTES * 60 / RESOURCE_SAMPLE_INTERVAL замеров
+RESOURCE_HISTORY_MINUTES = float(os.getenv('RESOURCE_HISTORY_MINUTES', '15'))
+RESOURCE_DISK_PATH = os.getenv('RESOURCE_DISK_PATH', '/')
+LLM_PROBE_INTERVAL = float(os.getenv('LLM_PROBE_INTERVAL', '60'))
+LLM_PROBE_TIMEOUT = float(os.getenv('LLM_PROBE_TIMEOUT', '10'))
+
+SPARK_CHARS = '▁▂▃▄▅▆▇█'
+
+def sparkline(values, width=24, high=None):
+    """
+    Строка из символов ▁..█: значения усредняются по width столбцам.
+    Шкала от нуля до high (100 для процентов), иначе до максимума: небольшие колебания не выглядят скачками.
+    """
+    values = [value for value in values if value == value]
+    if not values:
+        return ''
+    if len(values) > width:
+        step = len(values) / width
+        values = [math.fsum(values[int(column * step):int((column + 1) * step)]) /
+                  (int((column + 1) * step) - int(column * step)) for column in range(width)]
+    span = high or max(values)
+    if span <= 0:
+        return SPARK_CHARS[0] * len(values)
+    top = len(SPARK_CHARS) - 1
+    return ''.join(SPARK_CHARS[max(0, min(top, int(value / span * top + 0.5)))] for value in values)
+
+def _read_proc(path):
+    with open(path, encoding='ascii') as proc_file:
+        return proc_file.read()
+
+class ResourceSampler:
+    """
+    Фоновый сбор показателей процесса и системы через равные промежутки времени.
+    История хранится в кольцевых буферах array('d') фиксированного размера,
+    поэтому память не растет, а /status берет готовые значения без замеров.
+    """
+    
+    # Показатель, подпись в /status, единица, верх шкалы спарклайна (None - максимум за период)
+    SERIES = (
+        ('cpu', 'CPU процесса', '%', 100.0),
+        ('system_cpu', 'CPU системы', '%', 100.0),
+        ('rss', 'Память процесса', ' MB', None),
+        ('memory', 'RAM системы', '%', 100.0),
+        ('disk', 'Диск', '%', 100.0),
+        ('threads', 'Потоков', '', None),
+        ('fds', 'Открытых файлов', '', None),
+    )
+    # Окна агрегатов для /status, с
+    WINDOWS = (60, 300, 900)
+    
+    def __init__(self, interval=RESOURCE_SAMPLE_INTERVAL, history_minutes=RESOURCE_HISTORY_MINUTES,
+                 disk_path=RESOURCE_DISK_PATH):
+        self.interval = interval
+        self.capacity = max(2, int(history_minutes * 60 / interval))
+        self.disk_path = disk_path
+        self._lock = threading.Lock()
+        self._times = array('d', [0.0]) * self.capacity
+        self._values = {name: array('d', [math.nan]) * self.capacity for name, *_ in self.SERIES}
+        self._next = 0
+        self._count = 0
+        self._process = psutil.Process() if psutil else None
+        # Предыдущие значения счетчиков для CPU в процентах за интервал между замерами
+        self._last_process_cpu = None
+        self._last_system_cpu = None
+        self._thread = None
+        self._stopped = threading.Event()
+        self.stats = {'samples': 0, 'errors': 0, 'sample_time_total': 0.0, 'sample_time_max': 0.0}
+    
+    def _system_cpu(self):
+        if psutil:
+            return psutil.cpu_percent(None)
+        fields = [int(value) for value in _read_proc('/proc/stat').split('\n', 1)[0].split()[1:]]
+        # idle + iowait - простой, остальное - работа
+        idle, total = fields[3] + fields[4], sum(fields)
+        last, self._last_system_cpu = self._last_system_cpu, (idle, total)
+        if last is None or total == last[1]:
+            return math.nan
+        return 100.0 * (1 - (idle - last[0]) / (total - last[1]))
+    
+    def _memory(self, values):
+        if psutil:
+            values['memory'] = psutil.virtual_memory().percent
+            with self._process.oneshot():
+                values['rss'] = self._process.memory_info().rss / 1024 / 1024
+                values['fds'] = self._process.num_fds() if hasattr(self._process, 'num_fds') else self._process.num_handles()
+            return
+        meminfo = dict(line.split(':', 1) for line in _read_proc('/proc/meminfo').splitlines() if ':' in line)
+        total = int(meminfo['MemTotal'].split()[0])
+        values['memory'] = 100.0 * (1 - int(meminfo['MemAvailable'].split()[0]) / total)
+        values['rss'] = int(_read_proc('/proc/self/statm').split()[1]) * os.sysconf('SC_PAGE_SIZE') / 1024 / 1024
+        values['fds'] = len(os.listdir('/proc/self/fd'))
+    
+    def measure(self):
+        """Один замер: {показатель: значение}; недоступный показатель - nan"""
+        values = dict.fromkeys(self._values, math.nan)
+        now = time.monotonic()
+        process_time = time.process_time()
+        last, self._last_process_cpu = self._last_process_cpu, (now, process_time)
+        if last is not None and now > last[0]:
+            values['cpu'] = 100.0 * (process_time - last[1]) / (now - last[0])
+        values['threads'] = threading.active_count()
+        system_cpu_known = last is not None
+        for measure_part in (lambda: values.update(system_cpu=self._system_cpu()),
+                             lambda: self._memory(values),
+                             lambda: values.update(disk=self._disk_percent())):
+            try:
+                measure_part()
+            except (OSError, KeyError, ValueError, IndexError, AttributeError) as e:
+                with self._lock:
+                    self.stats['errors'] += 1
+                logger.debug(f"Не удалось снять показатель ресурсов: {e}", category='resources')
+        if not system_cpu_known:
+            # psutil.cpu_percent(None) при первом вызове возвращает бессмысленное значение
+            values['system_cpu'] = math.nan
+        return values
+    
+    def _disk_percent(self):
+        usage = shutil.disk_usage(self.disk_path)
+        return 100.0 * usage.used / usage.total
+    
+    def record(self, values, now=None):
+        """Записывает замер в кольцевой буфер (старейший замер перезаписывается)"""
+        now = time.time() if now is None else now
+        with self._lock:
+            index = self._next
+            self._times[index] = now
+            for name, series in self._values.items():
+                series[index] = values.get(name, math.nan)
+            self._next = (index + 1) % self.capacity
+            self._count = min(self._count + 1, self.capacity)
+    
+    def sample(self):
+        started = time.perf_counter()
+        self.record(self.measure())
+        elapsed = time.perf_counter() - started
+        with self._lock:
+            self.stats['samples'] += 1
+            self.stats['sample_time_total'] += elapsed
+            self.stats['sample_time_max'] = max(self.stats['sample_time_max'], elapsed)
+    
+    def _run(self):
+        while not self._stopped.wait(self.interval):
+            try:
+                self.sample()
+            except Exception as e:
+                with self._lock:
+                    self.stats['errors'] += 1
+                logger.warning(f"Ошибка сбора показателей ресурсов: {e}", category='resources')
+    
+    def start(self):
+        """Запускает сбор в фоновом потоке (повторный вызов ничего не делает)"""
+        if self._thread is not None:
+            return self
+        # Первый замер задает отсчет для процентов CPU и сразу дает текущие значения
+        self.sample()
+        self._thread = threading.Thread(target=self._run, name='resource-sampler', daemon=True)
+        self._thread.start()
+        return self
+    
+    def stop(self):
+        self._stopped.set()
+    
+    def history(self):
+        """Копия буфера от старых замеров к новым: (времена, {показатель: значения})"""
+        with self._lock:
+            order = [(self._next - self._count + offset) % self.capacity for offset in range(self._count)]
+            return ([self._times[index] for index in order],
+                    {name: [series[index] for index in order] for name, series in self._values.items()})
+    
+    def summary(self, now=None):
+        """
+        {показатель: {'current', 'windows': {окно, с: (среднее, максимум)}, 'sparkline'}}
+        по истории; показатели без данных пропускаются.
+        """
+        now = time.time() if now is None else now
+        times, history = self.history()
+        result = {}
+        for name, _, _, high in self.SERIES:
+            values = history[name]
+            known = [value for value in values if value == value]
+            if not known:
+                continue
+            windows = {}
+            for window in self.WINDOWS:
+                start = bisect.bisect_left(times, now - window)
+                recent = [value for value in values[start:] if value == value]
+                if recent:
+                    windows[window] = (math.fsum(recent) / len(recent), max(recent))
+            result[name] = {'current': known[-1], 'windows': windows, 'sparkline': sparkline(values, high=high)}
+        return result
+    
+    def get_stats(self):
+        with self._lock:
+            stats = dict(self.stats)
+            stats['stored'] = self._count
+        stats['capacity'] = self.capacity
+        stats['interval'] = self.interval
+        stats['sample_time_avg'] = stats['sample_time_total'] / stats['samples'] if stats['samples'] else 0.0
+        stats['source'] = 'psutil' if psutil else '/proc'
+        return stats
+
+resource_sampler = ResourceSampler()
+
+class LLMHealthProbe:
+    """
+    Периодическая проверка доступности API модели легким запросом (список моделей)
+    в фоновом потоке. /status показывает результат последней проверки, а не константу.
+    Проверяется каждая модель пула (llm_probes), name - ее имя из LLM_BACKENDS.
+    """
+    
+    def __init__(self, gateway, name='main', interval=LLM_PROBE_INTERVAL, timeout=LLM_PROBE_TIMEOUT):
+        self.gateway = gateway
+        self.name = name
+        self.interval = interval
+        self.timeout = timeout
+        self._lock = threading.Lock()
+        self._thread = None
+        self._stopped = threading.Event()
+        self.stats = {'checks': 0, 'failures': 0, 'consecutive_failures': 0, 'healthy': None,
+                      'latency': None, 'checked_at': None, 'since': None, 'last_error': None}
+    
+    def check(self):
+        """Одна проверка; возвращает True, если API ответил"""
+        started = time.perf_counter()
+        try:
+            self.gateway.probe(self.timeout)
+        except Exception as e:
+            error = f"{type(e).__name__}: {str(e)[:200]}"
+        else:
+            error = None
+        latency = time.perf_counter() - started
+        healthy = error is None
+        metrics.observe('llm_probe', latency)
+        metrics.inc('llm_probe_total', result='ok' if healthy else 'fail', backend=self.name)
+        
+        with self._lock:
+            changed = self.stats['healthy'] is not healthy
+            self.stats['checks'] += 1
+            self.stats['healthy'] = healthy
+            self.stats['latency'] = latency
+            self.stats['checked_at'] = time.time()
+            if changed:
+                self.stats['since'] = self.stats['checked_at']
+            if healthy:
+                self.stats['consecutive_failures'] = 0
+            else:
+                self.stats['failures'] += 1
+                self.stats['consecutive_failures'] += 1
+                self.stats['last_error'] = error
+        
+        if changed and not healthy:
+            logger.warning(f"API модели недоступен ({self.name}): {error}", category='llm_probe')
+        elif changed:
+            logger.info(f"API модели доступен ({self.name}), ответ за {latency * 1000:.0f} мс", category='llm_probe')
+        return healthy
+    
+    def _run(self):
+        while True:
+            self.check()
+            if self._stopped.wait(self.interval):
+                return
+    
+    def start(self):
+        """Запускает проверки в фоновом потоке (повторный вызов ничего не делает)"""
+        if self._thread is None and self.interval > 0:
+            self._thread = threading.Thread(target=self._run, name=f'llm-probe-{self.name}', daemon=True)
+            self._thread.start()
+        return self
+    
+    def stop(self):
+        self._stopped.set()
+    
+    def status_text(self, now=None):
+        """Строка о доступности API для /status"""
+        stats = self.get_stats()
+        now = time.time() if now is None else now
+        if stats['healthy'] is None:
+            return '⏳ еще не проверялось' if self._thread else 'проверка выключена'
+        ago = f"проверено {now - stats['checked_at']:.0f} с назад"
+        if stats['healthy']:
+            return f"✅ отвечает за {stats['latency'] * 1000:.0f} мс ({ago})"
+        return (f"❌ недоступно с {time.strftime('%H:%M:%S', time.localtime(stats['since']))}, "
+                f"неудачных проверок подряд: {stats['consecutive_failures']} ({ago})\n"
+                f"  <code>{html.escape(stats['last_error'] or '')}</code>")
+    
+    def get_stats(self):
+        with self._lock:
+            return dict(self.stats)
+
+llm_probes = [LLMHealthProbe(backend.gateway, backend.name) for backend in llm_pool.backends]
+
+def llm_probes_text():
+    """Доступность API для /status: одна строка для одной модели, иначе по строке на модель"""
+    if len(llm_probes) == 1:
+        return llm_probes[0].status_text()
+    return ''.join(f"\n  {probe.name}: {probe.status_text()}" for probe in llm_probes)
+
+def get_answer(content, on_delta=None):
+    """
+    Функция для получения ответа от модели.
+    Если передан on_delta, ответ запрашивается потоково и каждый фрагмент передается в on_delta.
+    """
+    # Модель подставляет LLMBackendPool
+    params = dict(
+        messages=[
+            {
+                "role": "user",
+                "content": f'{content} ({TECHNICAL_TASK})'
+            }
+        ],
+        max_tokens=3500,
+        temperature=0.7,
+    )
+    
+    with metrics.time('llm'):
+        return llm_pool.run(params, on_delta)
+
+# Настройки кэша анализов
+ANALYSIS_CACHE_PATH = os.getenv('ANALYSIS_CACHE_PATH', 'analysis_cache.sqlite3')
+ANALYSIS_CACHE_TTL = float(os.getenv('ANALYSIS_CACHE_TTL_DAYS', '30')) * 24 * 3600
+ANALYSIS_CACHE_MAX_ENTRIES = int(os.getenv('ANALYSIS_CACHE_MAX_ENTRIES', '5000'))
+ANALYSIS_CACHE_MAX_MB = float(os.getenv('ANALYSIS_CACHE_MAX_MB', '200'))
+# Закрепленные записи (--precompute) не вытесняются и учитываются отдельно от обычных
+ANALYSIS_CACHE_PINNED_MAX_ENTRIES = int(os.getenv('ANALYSIS_CACHE_PINNED_MAX_ENTRIES', '20000'))
+ANALYSIS_CACHE_PINNED_MAX_MB = float(os.getenv('ANALYSIS_CACHE_PINNED_MAX_MB', '500'))
+
+_INITIALS_RE = re.compile(r'\b[^\W\d_]\.')
+_PUNCTUATION_RE = re.compile(r'[^\w\s]|_')
+
+def normalize_prompt(prompt):
+    """
+    Приводит запрос к ключу кэша: регистр, ё/е, пунктуация, инициалы автора
+    и порядок слов ("Пушкин, Евгений Онегин" == "Евгений Онегин, А.С. Пушкин").
+    Падежи не приводятся: "А.С. Пушкина" дает другой ключ - такие формулировки
+    объединяет resolve_prompt по каталогу произведений
+    """
+    text = prompt.lower().replace('ё', 'е')
+    text = _INITIALS_RE.sub(' ', text)
+    text = _PUNCTUATION_RE.sub(' ', text)
+    return ' '.join(sorted(text.split()))
+
+class AnalysisCache:
+    """
+    Хранилище готовых ответов модели в SQLite с TTL и вытеснением по LRU.
+    Рядом с ответом хранится его HTML для Telegram; закрепленные записи
+    (пакетная подготовка, --precompute) не устаревают и не вытесняются, поэтому
+    у них свои лимиты, а max_entries и max_bytes относятся только к обычным.
+    """
+    
+    def __init__(self, path, ttl, max_entries, max_bytes,
+                 pinned_max_entries=ANALYSIS_CACHE_PINNED_MAX_ENTRIES,
+                 pinned_max_bytes=ANALYSIS_CACHE_PINNED_MAX_MB * 1024 * 1024):
+        self.path = path
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.pinned_max_entries = pinned_max_entries
+        self.pinned_max_bytes = pinned_max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._db = None
+    
+    def open(self, path=None):
+        """Открывает базу (path - другой файл, например ':memory:') и создает таблицу"""
+        with self._lock:
+            if self._db is not None:
+                self._db.close()
+            self.path = path or self.path
+            self._db = sqlite3.connect(self.path, check_same_thread=False)
+            self._db.execute('PRAGMA journal_mode=WAL')
+            self._db.execute("""
+                CREATE TABLE IF NOT EXISTS analyses (
+                    key TEXT PRIMARY KEY,
+                    prompt TEXT NOT NULL,
+                    response TEXT NOT NULL,
+                    size INTEGER NOT NULL,
+                    created_at REAL NOT NULL,
+                    accessed_at REAL NOT NULL,
+                    hits INTEGER NOT NULL DEFAULT 0,
+                    formatted TEXT,
+                    pinned INTEGER NOT NULL DEFAULT 0
+                )
+            """)
+            # Кэш, созданный прежней версией, получает новые колонки
+            columns = {row[1] for row in self._db.execute('PRAGMA table_info(analyses)')}
+            if 'formatted' not in columns:
+                self._db.execute('ALTER TABLE analyses ADD COLUMN formatted TEXT')
+            if 'pinned' not in columns:
+                self._db.execute('ALTER TABLE analyses ADD COLUMN pinned INTEGER NOT NULL DEFAULT 0')
+            self._db.execute('CREATE INDEX IF NOT EXISTS analyses_accessed_at ON analyses (accessed_at)')
+            self._db.commit()
+        return self
+    
+    def get(self, key):
+        """Возвращает (ответ, HTML или None) или None; просроченные записи удаляются"""
+        now = time.time()
+        with self._lock:
+            row = self._db.execute(
+                'SELECT response, formatted, created_at, pinned FROM analyses WHERE key = ?', (key,)
+            ).fetchone()
+            if row and not row[3] and now - row[2] > self.ttl:
+                self._db.execute('DELETE FROM analyses WHERE key = ?', (key,))
+                self._db.commit()
+                row = None
+            
+            if row is None:
+                self.misses += 1
+                return None
+            
+            self.hits += 1
+            self._db.execute('UPDATE analyses SET accessed_at = ?, hits = hits + 1 WHERE key = ?', (now, key))
+            self._db.commit()
+            return row[0], row[1]
+    
+    def put(self, prompt, response, key=None, formatted=None, pinned=False):
+        """
+        Сохраняет ответ и вытесняет давно не запрашиваемые записи сверх лимитов.
+        RuntimeError, если закрепленная запись не помещается в лимиты закрепленных.
+        """
+        key = key or normalize_prompt(prompt)
+        now = time.time()
+        size = len(response.encode('utf-8'))
+        with self._lock:
+            if pinned:
+                entries, total_bytes = self._db.execute(
+                    'SELECT COUNT(*), COALESCE(SUM(size), 0) FROM analyses WHERE pinned = 1 AND key != ?', (key,)
+                ).fetchone()
+                if entries + 1 > self.pinned_max_entries or total_bytes + size > self.pinned_max_bytes:
+                    raise RuntimeError(f"закрепленные записи заняли лимит кэша ({entries} записей, "
+                                       f"{total_bytes / 1024 / 1024:.1f} МБ)")
+            self._db.execute(
+                'INSERT OR REPLACE INTO analyses (key, prompt, response, size, created_at, accessed_at, hits, formatted, pinned) '
+                'VALUES (?, ?, ?, ?, ?, ?, 0, ?, ?)',
+                (key, prompt, response, size, now, now, formatted, int(pinned))
+            )
+            self._evict()
+            self._db.commit()
+        return key
+    
+    def set_formatted(self, key, formatted):
+        """Сохраняет HTML ответа, отформатированного при первом обращении"""
+        with self._lock:
+            self._db.execute('UPDATE analyses SET formatted = ? WHERE key = ?', (formatted, key))
+            self._db.commit()
+    
+    def _evict(self):
+        """Удаляет просроченные записи, затем самые старые по обращению до соблюдения лимитов (закрепленные не в счет)"""
+        self._db.execute('DELETE FROM analyses WHERE created_at < ? AND pinned = 0', (time.time() - self.ttl,))
+        entries, total_bytes = self._db.execute(
+            'SELECT COUNT(*), COALESCE(SUM(size), 0) FROM analyses WHERE pinned = 0'
+        ).fetchone()
+        if entries <= self.max_entries and total_bytes <= self.max_bytes:
+            return
+        
+        evicted = 0
+        for key, size in self._db.execute('SELECT key, size FROM analyses WHERE pinned = 0 ORDER BY accessed_at').fetchall():
+            if entries <= self.max_entries and total_bytes <= self.max_bytes:
+                break
+            self._db.execute('DELETE FROM analyses WHERE key = ?', (key,))
+            entries -= 1
+            total_bytes -= size
+            evicted += 1
+        logger.info(f"Из кэша анализов вытеснено записей: {evicted}")
+    
+    def get_entry(self, key):
+        """Возвращает запись целиком (для администратора), не меняя статистику"""
+        with self._lock:
+            row = self._db.execute(
+                'SELECT key, prompt, response, size, created_at, accessed_at, hits, pinned FROM analyses WHERE key = ?',
+                (key,)
+            ).fetchone()
+        if row is None:
+            return None
+        return dict(zip(('key', 'prompt', 'response', 'size', 'created_at', 'accessed_at', 'hits', 'pinned'), row))
+    
+    def list_entries(self, limit=20):
+        """Возвращает последние запрошенные записи без текста ответа"""
+        with self._lock:
+            rows = self._db.execute(
+                'SELECT key, size, hits, accessed_at FROM analyses ORDER BY accessed_at DESC LIMIT ?', (limit,)
+            ).fetchall()
+        return [dict(zip(('key', 'size', 'hits', 'accessed_at'), row)) for row in rows]
+    
+    def delete(self, key):
+        """Удаляет одну запись, возвращает число удаленных"""
+        with self._lock:
+            removed = self._db.execute('DELETE FROM analyses WHERE key = ?', (key,)).rowcount
+            self._db.commit()
+        return removed
+    
+    def purge(self):
+        """Очищает кэш полностью, возвращает число удаленных записей"""
+        with self._lock:
+            removed = self._db.execute('DELETE FROM analyses').rowcount
+            self._db.commit()
+        return removed
+    
+    def get_stats(self):
+        """Возвращает число записей, объем и долю попаданий"""
+        with self._lock:
+            entries, total_bytes, pinned = self._db.execute(
+                'SELECT COUNT(*), COALESCE(SUM(size), 0), COALESCE(SUM(pinned), 0) FROM analyses'
+            ).fetchone()
+            requests_total = self.hits + self.misses
+            return {
+                'entries': entries,
+                'pinned': pinned,
+                'bytes': total_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_ratio': self.hits / requests_total if requests_total else 0.0,
+            }
+
+analysis_cache = AnalysisCache(
+    ANALYSIS_CACHE_PATH,
+    ttl=ANALYSIS_CACHE_TTL,
+    max_entries=ANALYSIS_CACHE_MAX_ENTRIES,
+    max_bytes=ANALYSIS_CACHE_MAX_MB * 1024 * 1024,
+)
+
+# ===== Канонические произведения: разные формулировки одного запроса получают общий ключ =====
+
+WORK_RESOLUTION = os.getenv('WORK_RESOLUTION', '1') == '1'
+
+# Слова запроса, не влияющие на выбор произведения ("анализ", "роман", "пожалуйста", ...)
+WORK_FILLER_WORDS = ('анализ', 'проанализируй', 'проанализировать', 'разбор', 'разбери', 'сделай', 'сделать',
+                     'напиши', 'дай', 'нужен', 'нужно', 'хочу', 'мне', 'про', 'пожалуйста', 'подробный',
+                     'подробно', 'полный', 'литературный', 'произведение', 'роман', 'повесть', 'рассказ',
+                     'поэма', 'пьеса', 'трагедия', 'комедия', 'драма', 'сказка', 'басня', 'новелла',
+                     'стихотворение', 'стихи', 'книга', 'автор', 'писатель', 'поэт',
+                     'analysis', 'analyze', 'novel', 'book', 'please')
+
+# Латиница -> кириллица для запросов вида "evgeniy onegin pushkin" (сочетания раньше одиночных букв)
+_TRANSLIT = {'shch': 'щ', 'sch': 'щ', 'zh': 'ж', 'kh': 'х', 'ch': 'ч', 'sh': 'ш', 'ts': 'ц', 'yu': 'ю',
+             'ya': 'я', 'yo': 'е', 'ye': 'е', 'iy': 'ий', 'yy': 'ый', 'oy': 'ой', 'ay': 'ай', 'ey': 'ей',
+             'a': 'а', 'b': 'б', 'c': 'к', 'd': 'д', 'e': 'е', 'f': 'ф', 'g': 'г', 'h': 'х', 'i': 'и',
+             'j': 'й', 'k': 'к', 'l': 'л', 'm': 'м', 'n': 'н', 'o': 'о', 'p': 'п', 'q': 'к', 'r': 'р',
+             's': 'с', 't': 'т', 'u': 'у', 'v': 'в', 'w': 'в', 'x': 'кс', 'y': 'ы', 'z': 'з'}
+_TRANSLIT_RE = re.compile('|'.join(sorted(_TRANSLIT, key=len, reverse=True)))
+
+def transliterate(word):
+    return _TRANSLIT_RE.sub(lambda match: _TRANSLIT[match.group()], word)
+
+def work_stem(word):
+    """Грубая основа слова: первые пять букв, у коротких слов - без гласного окончания"""
+    if len(word) > 5:
+        return word[:5]
+    if len(word) > 3 and word[-1] in 'аеиоуыэюяьй':
+        return word[:-1]
+    return word
+
+class WorkResolver:
+    """
+    Сопоставляет запрос с произведением каталога LITERATURE_WORKS. Слова
+    сводятся к основам; основы с опечаткой в одну букву находятся по
+    индексу вариантов с одной удаленной буквой, латиница транслитерируется.
+    Кандидаты собираются по обратному индексу "основа -> названия", поэтому
+    поиск не зависит от размера каталога. Произведение выбирается, только если
+    найдены все слова названия (половина - если назван автор), каждое слово
+    запроса объясняется названием или автором и соперников нет.
+    """
+    
+    def __init__(self, works=None, cache_size=50000):
+        self.cache_size = cache_size
+        # (ID, каноническое название, основы названия, основы имени автора, нужен ли автор)
+        self.works = []
+        self._postings = {}
+        self._vocabulary = set()
+        self._deletes = {}
+        self._token_cache = {}
+        self._fillers = frozenset(work_stem(word) for word in WORK_FILLER_WORDS)
+        self._lock = threading.Lock()
+        self.stats = {'resolved': 0, 'unresolved': 0, 'ambiguous': 0}
+        
+        for authors, titles in (LITERATURE_WORKS if works is None else works):
+            author_stems = frozenset(stem for author in authors for stem in self._stems(author, fillers=False))
+            work_id = f"{' '.join(self._normalize(titles[0]))}|{' '.join(self._normalize(authors[0]))}"
+            display = f"{titles[0]}, {authors[0]}"
+            self._vocabulary.update(author_stems)
+            for title in titles:
+                title_stems = frozenset(self._stems(title))
+                if not title_stems:
+                    continue
+                # Короткие однословные названия ("Нос", "Мать") совпадают с обычными словами
+                needs_author = len(title_stems) == 1 and len(''.join(self._normalize(title))) < 5
+                index = len(self.works)
+                self.works.append((work_id, display, title_stems, author_stems, needs_author))
+                self._vocabulary.update(title_stems)
+                for stem in title_stems:
+                    self._postings.setdefault(stem, []).append(index)
+        
+        for stem in self._vocabulary:
+            for variant in self._variants(stem):
+                self._deletes.setdefault(variant, set()).add(stem)
+    
+    @staticmethod
+    def _normalize(text):
+        return _WORD_RE.findall(text.lower().replace('ё', 'е'))
+    
+    def _stems(self, text, fillers=True):
+        stems = []
+        for word in self._normalize(text):
+            if len(word) < 2 or word in _CATALOG_STOPWORDS:
+                continue
+            stem = work_stem(word)
+            if not (fillers and stem in self._fillers):
+                stems.append(stem)
+        return stems
+    
+    @staticmethod
+    def _variants(stem):
+        """Сама основа и основы без одной буквы (для основ от 3 букв: "льв" ~ "лев")"""
+        if len(stem) < 3:
+            return (stem,)
+        return (stem,) + tuple(stem[:i] + stem[i + 1:] for i in range(len(stem)))
+    
+    def _token_stems(self, token):
+        """Основы каталога, совпадающие с основой слова или отличающиеся от нее одной буквой"""
+        cached = self._token_cache.get(token)
+        if cached is not None:
+            return cached
+        
+        stems = [work_stem(token)]
+        if token.isascii():
+            stems.append(work_stem(transliterate(token)))
+        matches = frozenset(stem for stem in stems if stem in self._vocabulary)
+        if not matches:
+            matches = frozenset(
+                match for stem in stems for variant in self._variants(stem) for match in self._deletes.get(variant, ())
+            )
+        
+        if len(self._token_cache) >= self.cache_size:
+            self._token_cache.clear()
+        self._token_cache[token] = matches
+        return matches
+    
+    def match(self, prompt):
+        """Возвращает (исход: resolved/unresolved/ambiguous, (ID произведения, "Название, Автор") или None)"""
+        token_stems = [
+            self._token_stems(token) for token in self._normalize(prompt)
+            if len(token) >= 2 and token not in _CATALOG_STOPWORDS and work_stem(token) not in self._fillers
+        ]
+        if not token_stems:
+            return 'unresolved', None
+        matched = set().union(*token_stems)
+        
+        counts = {}
+        for stem in matched:
+            for index in self._postings.get(stem, ()):
+                counts[index] = counts.get(index, 0) + 1
+        
+        candidates = []
+        for index, count in counts.items():
+            work_id, display, title_stems, author_stems, needs_author = self.works[index]
+            has_author = bool(matched & author_stems)
+            if count < len(title_stems):
+                # Неполное название ("Онегин Пушкина") - только вместе с автором и по длинному слову, не "мир"
+                partial = has_author and count * 2 >= len(title_stems)
+                if not (partial and any(len(stem) == 5 for stem in matched & title_stems)):
+                    continue
+            if needs_author and not has_author:
+                continue
+            # Лишние слова ("образ Татьяны в ...", другой автор) означают другой запрос
+            known = title_stems | author_stems
+            if any(not stems & known for stems in token_stems):
+                continue
+            candidates.append((has_author, count, work_id, display))
+        
+        if not candidates:
+            return 'unresolved', None
+        best = max(candidates)
+        if len({work_id for has_author, count, work_id, _ in candidates if (has_author, count) == best[:2]}) > 1:
+            return 'ambiguous', None
+        return 'resolved', (best[2], best[3])
+    
+    def resolve(self, prompt):
+        """match() со счетчиками для /status и метрик: произведение или None"""
+        with metrics.time('resolve'):
+            outcome, work = self.match(prompt)
+        with self._lock:
+            self.stats[outcome] += 1
+        metrics.inc('work_resolution_total', outcome=outcome)
+        return work
+    
+    def get_stats(self):
+        with self._lock:
+            stats = dict(self.stats)
+        stats['works'] = len({work[0] for work in self.works})
+        stats['stems'] = len(self._vocabulary)
+        return stats
+
+work_resolver = WorkResolver()
+
+def resolve_prompt(prompt):
+    """
+    Возвращает (ключ кэша и объединения запросов, текст для модели): для
+    произведения из каталога - его ID и каноническое название, иначе
+    нормализованный запрос и сам запрос
+    """
+    work = work_resolver.resolve(prompt) if WORK_RESOLUTION else None
+    if work:
+        return f"work:{work[0]}", work[1]
+    return normalize_prompt(prompt), prompt
+
+class _InFlightCall:
+    """Выполняющаяся генерация: накопленные фрагменты потока, результат или ошибка"""
+    
+    def __init__(self, condition):
+        self.condition = condition
+        self.fragments = []
+        self.finished = False
+        self.result = None
+        self.error = None
+        self.followers = 0
+        # Последнее сообщенное инициатором состояние (место в очереди), см. SingleFlight.reporter
+        self.progress = None
+
+class SingleFlight:
+    """
+    Объединяет одновременные запросы с одинаковым ключом в один вызов:
+    присоединившиеся получают тот же поток фрагментов и тот же результат или ошибку
+    """
+    
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+        self.stats = {'leaders': 0, 'coalesced': 0, 'failed_calls': 0, 'failed_followers': 0}
+    
+    def do(self, key, function, on_delta=None, on_progress=None):
+        """
+        Вызывает function(on_delta) один раз на ключ среди одновременных запросов;
+        присоединившийся получает через on_progress состояние, сообщенное инициатором
+        """
+        with self._lock:
+            call = self._calls.get(key)
+            if call is None:
+                call = self._calls[key] = _InFlightCall(threading.Condition(self._lock))
+                self.stats['leaders'] += 1
+                leader = True
+            else:
+                call.followers += 1
+                self.stats['coalesced'] += 1
+                leader = False
+        
+        if leader:
+            return self._lead(key, call, function, on_delta)
+        logger.debug(f"Запрос присоединен к уже выполняющейся генерации: {key}")
+        return self._follow(call, on_delta, on_progress)
+    
+    def reporter(self, key, callback=None):
+        """Обертка callback инициатора: значение передается и присоединившимся к его генерации"""
+        def report(value):
+            with self._lock:
+                call = self._calls.get(key)
+                if call is not None:
+                    call.progress = value
+                    call.condition.notify_all()
+            if callback:
+                callback(value)
+        return report
+    
+    def _lead(self, key, call, function, on_delta):
+        own_errors = []
+        
+        def publish(fragment):
+            with call.condition:
+                call.fragments.append(fragment)
+                call.condition.notify_all()
+            # Ошибка доставки в чат инициатора не должна прерывать генерацию для остальных
+            if not own_errors:
+                try:
+                    on_delta(fragment)
+                except Exception as e:
+                    own_errors.append(e)
+        
+        try:
+            call.result = function(publish if on_delta else None)
+        except Exception as e:
+            call.error = e
+            raise
+        except BaseException as e:
+            # KeyboardInterrupt и т.п. прерывают только инициатора: остальным - обычная ошибка
+            call.error = RuntimeError(f"генерация прервана: {type(e).__name__}")
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+                call.finished = True
+                if call.error is not None:
+                    self.stats['failed_calls'] += 1
+                    self.stats['failed_followers'] += call.followers
+                call.condition.notify_all()
+        
+        if own_errors:
+            raise own_errors[0]
+        return call.result
+    
+    def _follow(self, call, on_delta, on_progress=None):
+        delivered = 0
+        shown = None
+        while True:
+            with call.condition:
+                while delivered == len(call.fragments) and not call.finished and call.progress == shown:
+                    call.condition.wait()
+                fragments = call.fragments[delivered:]
+                finished = call.finished
+                progress = call.progress
+            delivered += len(fragments)
+            if progress != shown:
+                shown = progress
+                if on_progress:
+                    on_progress(progress)
+            if on_delta:
+                for fragment in fragments:
+                    on_delta(fragment)
+            if finished:
+                break
+        
+        if call.error is not None:
+            raise call.error
+        return call.result
+    
+    def get_stats(self):
+        with self._lock:
+            stats = dict(self.stats)
+            stats['in_flight'] = len(self._calls)
+        return stats
+
+answer_flights = SingleFlight()
+
+def _generate_and_store(content, key, on_delta=None, slot=None):
+    """
+    Запрашивает модель (дождавшись места у нее, если передан slot) и сохраняет ответ
+    в кэш до того, как генерация перестанет считаться выполняющейся
+    """
+    if slot is not None:
+        with slot:
+            return _generate_and_store(content, key, on_delta)
+    response = get_answer(content, on_delta=on_delta)
+    # Потоковый ответ форматируется по абзацам при выдаче, HTML целиком понадобится только при попадании
+    formatted = format_ai_response(response) if on_delta is None else None
+    _store_answer(content, key, response, formatted)
+    return response, formatted
+
+def _store_answer(content, key, response, formatted):
+    """Сохраняет анализ в кэш; отказ модели не сохраняется, чтобы следующий запрос получил новую попытку"""
+    if is_model_refusal(response):
+        logger.info(f"Модель отказалась анализировать запрос, ответ не сохранен в кэш: {key}")
+        metrics.inc('analysis_cache_skipped_total', reason='refusal')
+        return
+    analysis_cache.put(content, response, key=key, formatted=formatted)
+
+def _cached_answer(key, cached):
+    """Ответ и HTML из записи кэша; HTML старой или потоковой записи готовится и сохраняется один раз"""
+    logger.debug(f"Ответ взят из кэша: {key}")
+    response, formatted = cached
+    if formatted is None:
+        formatted = format_ai_response(response)
+        analysis_cache.set_formatted(key, formatted)
+    return response, formatted
+
+def get_cached_answer(content, on_delta=None, slot=None):
+    """
+    Возвращает (анализ, его HTML или None) из кэша, а при промахе запрашивает
+    модель и сохраняет ответ. HTML равен None только у потокового ответа.
+    Ключом служит каноническое произведение (resolve_prompt), поэтому разные
+    формулировки одного запроса обслуживаются одной записью и одной генерацией;
+    место у модели (slot) занимает только тот, кто ее запустил, а присоединившиеся
+    видят его место в очереди.
+    """
+    key, content = resolve_prompt(content)
+    with metrics.time('cache'):
+        cached = analysis_cache.get(key)
+    if cached is not None:
+        return _cached_answer(key, cached)
+    
+    show_position = slot.on_position if slot is not None else None
+    on_position = show_position and (lambda position: AdmissionController._notify(show_position, position))
+    if slot is not None:
+        slot.on_position = answer_flights.reporter(key, show_position)
+    while True:
+        try:
+            return answer_flights.do(
+                key, lambda on_fragment: _generate_and_store(content, key, on_fragment, slot), on_delta, on_position
+            )
+        except AdmissionRejected:
+            # Отказ получил инициатор генерации, к которой присоединился запрос (лимиты его
+            # пользователя или очередь); свой допуск запрос еще не проверял - пробует сам
+            if slot is None or slot.ticket is not None:
+                raise
+            logger.debug(f"Инициатору генерации отказано в допуске, запрос повторяется: {key}")
+
+# ===== Перечитывание настроек (/reset config) и запуск =====
+
+def reload_settings():
+    """
+    Перечитывает .env и применяет настройки, которые можно менять без перезапуска.
+    Возвращает имена изменившихся настроек.
+    """
+    global HUGGINGFACE_TOKEN, ADMIN_ID, LLM_MODEL, STREAM_RESPONSES, LLM_STREAM_USAGE
+    global ADMISSION_MAX_ACTIVE, ADMISSION_QUEUE_SIZE, ADMISSION_USER_CONCURRENCY
+    load_dotenv(override=True)
+    
+    before = (HUGGINGFACE_TOKEN, ADMIN_ID, LLM_MODEL, STREAM_RESPONSES, LLM_STREAM_USAGE,
+              ADMISSION_MAX_ACTIVE, ADMISSION_QUEUE_SIZE, ADMISSION_USER_CONCURRENCY)
+    HUGGINGFACE_TOKEN = os.getenv('HUGGINGFACE_TOKEN', HUGGINGFACE_TOKEN)
+    ADMIN_ID = os.getenv('ADMIN_ID', ADMIN_ID)
+    LLM_MODEL = os.getenv('LLM_MODEL', LLM_MODEL)
+    STREAM_RESPONSES = os.getenv('STREAM_RESPONSES', '1' if STREAM_RESPONSES else '0') == '1'
+    LLM_STREAM_USAGE = os.getenv('LLM_STREAM_USAGE', '1' if LLM_STREAM_USAGE else '0') == '1'
+    ADMISSION_MAX_ACTIVE = worker_share(int(os.getenv('ADMISSION_MAX_ACTIVE', ADMISSION_MAX_ACTIVE * WORKER_COUNT)))
+    ADMISSION_QUEUE_SIZE = worker_share(int(os.getenv('ADMISSION_QUEUE_SIZE', ADMISSION_QUEUE_SIZE * WORKER_COUNT)))
+    ADMISSION_USER_CONCURRENCY = int(os.getenv('ADMISSION_USER_CONCURRENCY', ADMISSION_USER_CONCURRENCY))
+    after = (HUGGINGFACE_TOKEN, ADMIN_ID, LLM_MODEL, STREAM_RESPONSES, LLM_STREAM_USAGE,
+             ADMISSION_MAX_ACTIVE, ADMISSION_QUEUE_SIZE, ADMISSION_USER_CONCURRENCY)
+    
+    # Клиенты модели подставляют ключ в заголовок при каждом запросе; модели из LLM_BACKENDS не меняются
+    llm_gateway.client.api_key = HUGGINGFACE_TOKEN
+    llm_pool.primary.model = LLM_MODEL
+    if BOT_RUNTIME == 'async':
+        from bot_async import async_llm_gateway, async_llm_pool
+        if async_llm_gateway is not None:
+            async_llm_gateway.client.api_key = HUGGINGFACE_TOKEN
+            async_llm_pool.primary.model = LLM_MODEL
+    admission.reconfigure(ADMISSION_MAX_ACTIVE, ADMISSION_QUEUE_SIZE, ADMISSION_USER_CONCURRENCY)
+    
+    names = ('HUGGINGFACE_TOKEN', 'ADMIN_ID', 'LLM_MODEL', 'STREAM_RESPONSES', 'LLM_STREAM_USAGE',
+             'ADMISSION_MAX_ACTIVE', 'ADMISSION_QUEUE_SIZE', 'ADMISSION_USER_CONCURRENCY')
+    changed = [name for name, old, new in zip(names, before, after) if old != new]
+    logger.info(f"Настройки перечитаны, изменены: {', '.join(changed) or 'нет'}", category='admin')
+    return changed
+
+def init_bot():
+    """
+    Запускает то, чего не делает импорт модуля: поток записи журнала, кэш анализов
+    на диске и подключение к Bot API (адрес и ограничитель запросов)
+    """
+    logger.start()
+    analysis_cache.open()
+    if TELEGRAM_API_URL:
+        telebot.apihelper.API_URL = TELEGRAM_API_URL
+    # Все исходящие вызовы Bot API проходят через ограничитель
+    if TELEGRAM_RATE_LIMIT:
+        telebot.apihelper.CUSTOM_REQUEST_SENDER = telegram_limiter.send
 
 if __name__ == "__main__":
+    # Режимы работы импортируют ядро как pushkin_bot: это должен быть этот же модуль, а не его копия
+    sys.modules['pushkin_bot'] = sys.modules[__name__]
+    init_bot()
+    
+    # Пакетная подготовка анализов выполняется вместо запуска бота
+    if '--precompute' in sys.argv:
+        from bot_precompute import run_precompute
+        sys.exit(run_precompute(sys.argv[1:]))
+    
+    import bot_webhook
+    from bot_async import async_last_update_id, run_async_bot, stop_async_polling
+    from bot_supervisor import supervisor
+    from bot_workers import UpdateRouter, run_worker
+    
+    # Процесс-обработчик, запущенный приемщиком: обновления приходят через stdin
+    if WORKER_INDEX is not None:
+        supervisor.metrics_server = start_metrics_server()
+        resource_sampler.start()
+        for probe in llm_probes:
+            probe.start()
+        run_worker()
+        sys.exit(0)
+    
     print("=" * 50)
     print("Pushkin AI Bot запущен!")
     print(f"Администратор: ID {ADMIN_ID}")
-    print(f"Подключен к Telegram")
-    print(f"Используется модель: DeepSeek-V3.2-Exp")
+    print("Подключен к Telegram")
+    print("Используется модель: DeepSeek-V3.2-Exp")
+    print(f"Режим работы: {'asyncio' if BOT_RUNTIME == 'async' else 'потоки'}")
+    print(f"Получение обновлений: {'webhook' if BOT_MODE == 'webhook' else 'long polling'}")
+    if BOT_PROCESSES > 1 and BOT_RUNTIME != 'async':
+        print(f"Процессов-обработчиков: {BOT_PROCESSES} (чаты распределяются по ID)")
     
     if os.path.exists("main.png"):
         file_size = os.path.getsize("main.png")
         print(f"Изображение main.png найдено, размер: {file_size/1024/1024:.2f}MB")
     else:
-        print(f"Изображение main.png не найдено в текущей директории")
+        print("Изображение main.png не найдено в текущей директории")
         print(f"Текущая директория: {os.getcwd()}")
     
     print("=" * 50)
     print("Ожидаю запросы...")
     print("Административные команды:")
-    print(f"  • /admin - панель администратора")
-    print(f"  • /reset - сброс и перезапуск")
-    print(f"  • /status - статус системы")
+    print("  • /admin - панель администратора")
+    print("  • /reset - перезапуск без простоя (/reset config - перечитать настройки)")
+    print("  • /status - статус системы")
+    print("Пакетная подготовка анализов: --precompute works.csv [--workers N]")
+    print("Несколько процессов-обработчиков: --processes N")
     
-    try:
-        bot.polling(none_stop=True, interval=1, timeout=30)
-    except Exception as e:
-        print(f"[CRITICAL ERROR] Бот остановлен: {e}")
-        print(f"[INFO] Перезапуск через 5 секунд...")
-        time.sleep(5)
-        # Автоматический перезапуск
-        python_executable = sys.executable
-        script_path = os.path.abspath(__file__)
-        subprocess.Popen([python_executable, script_path])
-        sys.exit(0)
\ No newline at end of file
+    if BOT_MODE == 'webhook' and BOT_RUNTIME != 'async' and bot_webhook.webhook_config_error():
+        logger.error(bot_webhook.webhook_config_error(), category='security')
+        sys.exit(2)
+    
+    # Запущенный по /reset процесс начинает работу, только когда прежний остановил прием обновлений
+    supervisor.wait_for_handoff()
+    supervisor.metrics_server = start_metrics_server()
+    resource_sampler.start()
+    for probe in llm_probes:
+        probe.start()
+    
+    if BOT_PROCESSES > 1:
+        if BOT_RUNTIME == 'async':
+            logger.warning("Режим нескольких процессов поддерживается только потоковой версией, работает один процесс")
+        else:
+            # Этот процесс только принимает обновления и раздает их обработчикам
+            bot.router = UpdateRouter(BOT_PROCESSES).start()
+            atexit.register(bot.router.stop)
+    
+    if BOT_RUNTIME == 'async':
+        if BOT_MODE == 'webhook':
+            logger.warning("Режим webhook поддерживается только потоковой версией, используется long polling")
+        supervisor.run(lambda: asyncio.run(run_async_bot()), stop_async_polling, async_last_update_id)
+    elif BOT_MODE == 'webhook':
+        supervisor.run(bot_webhook.run_webhook, lambda: bot_webhook.webhook_server.shutdown())
+    else:
+        # Пока зарегистрирован webhook, getUpdates отвечает ошибкой 409
+        try:
+            bot.remove_webhook()
+        except Exception as e:
+            logger.warning(f"Не удалось снять webhook: {e}")
+        supervisor.run(lambda: bot.polling(none_stop=True, interval=1, timeout=30), bot.stop_polling)
\ No newline at end of file
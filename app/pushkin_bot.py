@@ -0,0 +1,15 @@
+"""
+Ядро бота под импортируемым именем: файл "model2 — копия.py" запускается как скрипт,
+а режимы работы (bot_async, bot_webhook, bot_supervisor, bot_workers, bot_precompute),
+тесты и бенчмарки импортируют его как pushkin_bot. Импорт ничего не запускает:
+журнал, кэш анализов и подключение к Bot API включает init_bot().
+"""
+import importlib.util
+import os
+import sys
+
+_spec = importlib.util.spec_from_file_location(
+    __name__, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'model2 — копия.py'))
+_module = importlib.util.module_from_spec(_spec)
+sys.modules[__name__] = _module
+_spec.loader.exec_module(_module)
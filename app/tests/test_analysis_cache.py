@@ -0,0 +1,78 @@
+"""
+Проверки кэша анализов: ключи запросов, вытеснение при закрепленных записях
+и то, что отказы модели не сохраняются.
+
+Запуск: python -m unittest discover -s tests
+"""
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'benchmarks'))
+
+from _bot import load_answers, load_bot_module
+
+bot_module = load_bot_module()
+
+class NormalizePromptTest(unittest.TestCase):
+
+    def test_case_punctuation_initials_and_word_order(self):
+        normalize = bot_module.normalize_prompt
+        self.assertEqual(normalize('Пушкин, Евгений Онегин'), normalize('Евгений Онегин, А.С. Пушкин'))
+        self.assertEqual(normalize('Отцы и дети'), normalize('отцы и  ДЕТИ!'))
+        self.assertEqual(normalize('Мёртвые души'), normalize('Мертвые души'))
+
+    def test_word_forms_are_left_to_resolve_prompt(self):
+        self.assertNotEqual(bot_module.normalize_prompt('Пушкин, Евгений Онегин'),
+                            bot_module.normalize_prompt('Евгений Онегин А.С. Пушкина'))
+        self.assertEqual(bot_module.resolve_prompt('Пушкин, Евгений Онегин')[0],
+                         bot_module.resolve_prompt('Евгений Онегин А.С. Пушкина')[0])
+
+class ModelRefusalTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        bot_module.analysis_cache.open(':memory:')
+
+    def test_corpus_answers(self):
+        refusals = [answer for answer in load_answers() if bot_module.is_model_refusal(answer)]
+        self.assertEqual(len(refusals), 1)
+        self.assertTrue(refusals[0].startswith('Извините'))
+
+    def test_refusal_is_not_cached(self):
+        cache = bot_module.analysis_cache
+        refusal = next(answer for answer in load_answers() if bot_module.is_model_refusal(answer))
+        bot_module._store_answer('Сколько стоит ноутбук', 'test:refusal', refusal, None)
+        self.assertIsNone(cache.get_entry('test:refusal'))
+        bot_module._store_answer('Отцы и дети, Тургенев', 'test:analysis', load_answers()[0], None)
+        self.assertIsNotNone(cache.get_entry('test:analysis'))
+        cache.delete('test:analysis')
+
+class AnalysisCacheEvictionTest(unittest.TestCase):
+
+    def make_cache(self, **kwargs):
+        return bot_module.AnalysisCache(':memory:', ttl=3600, max_entries=3, max_bytes=10 ** 6, **kwargs).open()
+
+    def test_pinned_rows_do_not_evict_new_entries(self):
+        cache = self.make_cache()
+        for index in range(3):
+            cache.put(f'закрепленный {index}', 'анализ', key=f'p{index}', pinned=True)
+        cache.put('обычный', 'анализ', key='u1')
+        self.assertIsNotNone(cache.get('u1'))
+        for index in range(2, 5):
+            cache.put(f'обычный {index}', 'анализ', key=f'u{index}')
+        stats = cache.get_stats()
+        self.assertEqual((stats['entries'], stats['pinned']), (6, 3))
+        self.assertIsNone(cache.get_entry('u1'))
+        self.assertIsNotNone(cache.get_entry('u4'))
+
+    def test_pinned_budget(self):
+        cache = self.make_cache(pinned_max_entries=2)
+        cache.put('a', 'анализ', key='p1', pinned=True)
+        cache.put('b', 'анализ', key='p2', pinned=True)
+        cache.put('b', 'новый анализ', key='p2', pinned=True)
+        with self.assertRaises(RuntimeError):
+            cache.put('c', 'анализ', key='p3', pinned=True)
+
+if __name__ == '__main__':
+    unittest.main()
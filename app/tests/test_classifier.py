@@ -0,0 +1,47 @@
+"""
+Проверки предварительного фильтра запросов (LiteratureClassifier) на размеченной
+выборке benchmarks/corpus/prompts_labeled.tsv: ложных отказов нет, лишних вызовов
+модели - в пределах порога.
+
+Запуск: python -m unittest discover -s tests
+"""
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'benchmarks'))
+
+from _bot import CORPUS_DIR, load_bot_module
+from classifier_benchmark import load_sample
+
+bot_module = load_bot_module()
+
+MIN_PRECISION = 0.85
+MIN_RECALL = 1.0
+
+class LiteratureClassifierTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.classifier = bot_module.LiteratureClassifier()
+        cls.sample = load_sample(os.path.join(CORPUS_DIR, 'prompts_labeled.tsv'))
+
+    def test_precision_and_recall(self):
+        predicted = [(expected, self.classifier.classify(text)[0]) for expected, text in self.sample]
+        true_positive = sum(1 for expected, literature in predicted if expected and literature)
+        precision = true_positive / sum(1 for _, literature in predicted if literature)
+        recall = true_positive / sum(1 for expected, _ in predicted if expected)
+        self.assertGreaterEqual(precision, MIN_PRECISION)
+        self.assertGreaterEqual(recall, MIN_RECALL)
+
+    def test_catalog_match_wins_over_off_topic_words(self):
+        for text in ('Привет! Расскажи про Онегина', 'Hello, analyze Hamlet', 'Как дела у Раскольникова в конце',
+                     'Сколько стоит прочитать Гамлета'):
+            self.assertTrue(self.classifier.classify(text)[0], text)
+
+    def test_off_topic_without_catalog_words(self):
+        for text in ('Какой сейчас курс доллара', 'Рецепт борща', 'Сколько будет 2+2*2'):
+            self.assertEqual(self.classifier.classify(text), (False, 'off_topic'), text)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,102 @@
+"""
+Проверки LLMGateway против локального OpenAI-совместимого сервера (benchmarks/fake_llm.py):
+переиспользование соединений, повторы при 429/503, потоковая выдача и обрывы соединений.
+
+Запуск: python -m unittest discover -s tests
+"""
+import asyncio
+import gc
+import os
+import socket
+import sys
+import unittest
+import weakref
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'benchmarks'))
+
+from _bot import load_bot_module
+from fake_llm import FakeLLMServer
+
+bot_module = load_bot_module()
+bot_async = load_bot_module('bot_async')
+
+MESSAGES = [{'role': 'user', 'content': 'Евгений Онегин, Пушкин'}]
+
+def free_port():
+    """Порт, на котором никто не слушает: соединение с ним обрывается сразу"""
+    with socket.socket() as probe:
+        probe.bind(('127.0.0.1', 0))
+        return probe.getsockname()[1]
+
+def make_gateway(base_url, gateway_class=None, **kwargs):
+    kwargs.setdefault('backoff_base', 0.01)
+    kwargs.setdefault('backoff_cap', 0.05)
+    return (gateway_class or bot_module.LLMGateway)(base_url, 'test-key', **kwargs)
+
+class LLMGatewayTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.server = FakeLLMServer(latency=0.0, answers=['Первый ответ модели', 'Второй ответ модели']).start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+
+    def setUp(self):
+        self.server.error_rate = 0.0
+
+    def test_connection_reused_between_requests(self):
+        gateway = make_gateway(self.server.base_url)
+        connections = self.server.connections
+        for _ in range(3):
+            completion = gateway.complete(model='fake', messages=MESSAGES)
+            self.assertIn(completion.choices[0].message.content, self.server.answers)
+        stats = gateway.get_stats()
+        self.assertEqual(self.server.connections - connections, 1)
+        self.assertEqual((stats['connection_misses'], stats['connection_hits']), (1, 2))
+        self.assertGreater(stats['completion_tokens'], 0)
+
+    def test_retries_overload_then_raises(self):
+        self.server.error_rate = 1.0
+        gateway = make_gateway(self.server.base_url, max_retries=2)
+        with self.assertRaises((bot_module.openai.RateLimitError, bot_module.openai.InternalServerError)):
+            gateway.complete(model='fake', messages=MESSAGES)
+        stats = gateway.get_stats()
+        self.assertEqual((stats['requests'], stats['retries'], stats['errors']), (1, 2, 1))
+
+    def test_stream_yields_answer_and_usage(self):
+        gateway = make_gateway(self.server.base_url)
+        text = ''.join(gateway.stream(model='fake', messages=MESSAGES))
+        self.assertIn(text.strip(), self.server.answers)
+        self.assertGreater(gateway.get_stats()['completion_tokens'], 0)
+
+    def test_connection_errors_leave_no_state(self):
+        gateway = make_gateway(f"http://127.0.0.1:{free_port()}/v1", max_retries=1)
+        requests = weakref.WeakSet()
+        gateway.http_client.event_hooks['request'].append(requests.add)
+        with self.assertRaises(bot_module.openai.APIConnectionError):
+            gateway.complete(model='fake', messages=MESSAGES)
+        gc.collect()
+        self.assertEqual(len(requests), 0)
+        stats = gateway.get_stats()
+        self.assertEqual((stats['retries'], stats['errors'], stats['connection_hits'], stats['connection_misses']),
+                         (1, 1, 0, 0))
+
+    def test_async_gateway_reuses_connection(self):
+        async def run():
+            gateway = make_gateway(self.server.base_url, bot_async.AsyncLLMGateway)
+            try:
+                await gateway.complete(model='fake', messages=MESSAGES)
+                fragments = [fragment async for fragment in gateway.stream(model='fake', messages=MESSAGES)]
+            finally:
+                await gateway.http_client.aclose()
+            return gateway.get_stats(), ''.join(fragments)
+
+        stats, text = asyncio.run(run())
+        self.assertIn(text.strip(), self.server.answers)
+        self.assertEqual((stats['connection_misses'], stats['connection_hits']), (1, 1))
+
+if __name__ == '__main__':
+    unittest.main()
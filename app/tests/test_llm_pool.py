@@ -0,0 +1,103 @@
+"""
+Проверки LLMBackendPool против локальных OpenAI-совместимых серверов (benchmarks/fake_llm.py):
+временно отключенная модель не получает дублей и получает запрос после ошибки
+только тогда, когда исправных моделей не осталось; основная попытка идет в потоке
+вызывающего и прерывается, если первым ответил дубль.
+
+Запуск: python -m unittest discover -s tests
+"""
+import os
+import socket
+import sys
+import threading
+import time
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'benchmarks'))
+
+from _bot import load_bot_module
+from fake_llm import FakeLLMServer
+
+bot_module = load_bot_module()
+
+PARAMS = {'messages': [{'role': 'user', 'content': 'Евгений Онегин, Пушкин'}], 'max_tokens': 100}
+
+def closed_url():
+    """Адрес, на котором никто не слушает: запрос сразу завершается ошибкой соединения"""
+    with socket.socket() as probe:
+        probe.bind(('127.0.0.1', 0))
+        return f"http://127.0.0.1:{probe.getsockname()[1]}/v1"
+
+def make_backend(name, base_url, cooling=False, hedge_delay=None):
+    gateway = bot_module.LLMGateway(base_url=base_url, api_key='test-key', max_retries=0)
+    backend = bot_module.LLMBackend(name, 'fake', gateway)
+    if cooling:
+        backend.down_until = time.time() + 60
+    if hedge_delay is not None:
+        backend.hedge_delay = lambda kind: hedge_delay
+    return backend
+
+class LLMBackendPoolTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.server = FakeLLMServer(latency=0.3).start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+
+    def test_cooling_backend_gets_no_hedges(self):
+        slow = make_backend('slow', self.server.base_url, hedge_delay=0.05)
+        cooling = make_backend('cooling', closed_url(), cooling=True)
+        pool = bot_module.LLMBackendPool([slow, cooling], hedge=True, hedge_share=1.0)
+        fragments = []
+        self.assertTrue(pool.run(dict(PARAMS), on_delta=fragments.append))
+        self.assertEqual(pool.get_stats()['hedged'], 0)
+        self.assertEqual(cooling.get_stats()['hedges'], 0)
+
+    def test_hedge_interrupts_blocked_primary(self):
+        slow_server = FakeLLMServer(latency=5.0).start()
+        try:
+            slow = make_backend('slow', slow_server.base_url, hedge_delay=0.05)
+            fast = make_backend('fast', self.server.base_url)
+            pool = bot_module.LLMBackendPool([slow, fast], hedge=True, hedge_share=1.0, hedge_workers=1)
+            pool.ranked = lambda kind: [slow, fast]
+            threads = []
+            started = time.perf_counter()
+            text = pool.run(dict(PARAMS), on_delta=lambda fragment: threads.append(threading.current_thread()))
+            self.assertLess(time.perf_counter() - started, 2.0)
+        finally:
+            slow_server.shutdown()
+            slow_server.server_close()
+        self.assertTrue(text)
+        self.assertEqual(set(threads), {threading.current_thread()})
+        stats = pool.get_stats()
+        self.assertEqual((stats['hedged'], stats['hedge_wins']), (1, 1))
+        self.assertEqual((slow.get_stats()['cancelled'], slow.get_stats()['failures']), (1, 0))
+        self.assertEqual(slow.gateway.get_stats()['retries'], 0)
+
+    def test_failover_prefers_healthy_backend(self):
+        failing = make_backend('failing', closed_url())
+        cooling = make_backend('cooling', closed_url(), cooling=True)
+        healthy = make_backend('healthy', self.server.base_url)
+        # Модель, отключившаяся после ранжирования, тоже пропускается
+        pool = bot_module.LLMBackendPool([failing, cooling, healthy], hedge=False)
+        pool.ranked = lambda kind: [failing, cooling, healthy]
+        self.assertTrue(pool.run(dict(PARAMS)))
+        stats = pool.get_stats()
+        self.assertEqual((stats['failovers'], stats['last_resort']), (1, 0))
+        self.assertEqual(cooling.get_stats()['attempts'], 0)
+
+    def test_cooling_backend_is_last_resort(self):
+        failing = make_backend('failing', closed_url())
+        cooling = make_backend('cooling', self.server.base_url, cooling=True)
+        pool = bot_module.LLMBackendPool([failing, cooling], hedge=False)
+        self.assertTrue(pool.run(dict(PARAMS)))
+        stats = pool.get_stats()
+        self.assertEqual((stats['failovers'], stats['last_resort']), (1, 1))
+        self.assertEqual(cooling.get_stats()['wins'], 1)
+
+if __name__ == '__main__':
+    unittest.main()
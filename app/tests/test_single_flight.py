@@ -0,0 +1,168 @@
+"""
+Проверки SingleFlight и AsyncSingleFlight: присоединившиеся к генерации получают
+ее фрагменты, место инициатора в очереди и результат, а при ошибке или отмене
+инициатора - ошибку, а не None; отказ инициатору в допуске к модели не становится
+отказом присоединившимся.
+
+Запуск: python -m unittest discover -s tests
+"""
+import asyncio
+import os
+import sys
+import threading
+import time
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'benchmarks'))
+
+from _bot import load_bot_module
+
+bot_module = load_bot_module()
+bot_async = load_bot_module('bot_async')
+
+class SingleFlightTest(unittest.TestCase):
+
+    def test_followers_share_fragments_and_result(self):
+        flights = bot_module.SingleFlight()
+        started, release = threading.Event(), threading.Event()
+        follower_fragments, results = [], {}
+
+        def generate(on_delta):
+            on_delta('а')
+            started.set()
+            release.wait(5)
+            on_delta('б')
+            return 'аб'
+
+        leader = threading.Thread(target=lambda: results.setdefault('leader', flights.do('key', generate, lambda _: None)))
+        leader.start()
+        started.wait(5)
+        follower = threading.Thread(target=lambda: results.setdefault(
+            'follower', flights.do('key', generate, follower_fragments.append)))
+        follower.start()
+        while not flights.get_stats()['coalesced']:
+            time.sleep(0.001)
+        release.set()
+        leader.join(5)
+        follower.join(5)
+
+        self.assertEqual(results, {'leader': 'аб', 'follower': 'аб'})
+        self.assertEqual(follower_fragments, ['а', 'б'])
+
+    def test_followers_see_leader_queue_position(self):
+        flights = bot_module.SingleFlight()
+        joined, positions = threading.Event(), []
+
+        def generate(on_delta):
+            report = flights.reporter('key')
+            joined.wait(5)
+            report(2)
+            report(1)
+            report(0)
+            return 'ответ'
+
+        leader = threading.Thread(target=flights.do, args=('key', generate))
+        leader.start()
+        while not flights.get_stats()['leaders']:
+            time.sleep(0.001)
+        follower = threading.Thread(target=flights.do, args=('key', generate, None, positions.append))
+        follower.start()
+        while not flights.get_stats()['coalesced']:
+            time.sleep(0.001)
+        joined.set()
+        leader.join(5)
+        follower.join(5)
+
+        self.assertEqual(positions[-1], 0)
+        self.assertEqual(positions, sorted(set(positions), reverse=True))
+
+class GetCachedAnswerTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        bot_module.analysis_cache.open(':memory:')
+
+    def test_rejected_leader_does_not_reject_followers(self):
+        generate_and_store = bot_module._generate_and_store
+        joined = threading.Event()
+        calls, results = [], {}
+
+        def fake_generate_and_store(content, key, on_delta=None, slot=None):
+            calls.append(slot)
+            if len(calls) == 1:
+                slot.ticket = bot_module.AdmissionTicket(slot.user_id)
+                joined.wait(5)
+                raise bot_module.AdmissionRejected("Дождитесь ответа на предыдущие запросы.")
+            return 'ответ', None
+
+        def ask(name):
+            slot = bot_module.admission.slot(name)
+            try:
+                results[name] = bot_module.get_cached_answer('Тестовое произведение без кэша', slot=slot)
+            except Exception as e:
+                results[name] = e
+
+        bot_module._generate_and_store = fake_generate_and_store
+        try:
+            leader = threading.Thread(target=ask, args=('leader',))
+            leader.start()
+            while not calls:
+                time.sleep(0.001)
+            coalesced = bot_module.answer_flights.get_stats()['coalesced']
+            follower = threading.Thread(target=ask, args=('follower',))
+            follower.start()
+            while bot_module.answer_flights.get_stats()['coalesced'] == coalesced:
+                time.sleep(0.001)
+            joined.set()
+            leader.join(5)
+            follower.join(5)
+        finally:
+            bot_module._generate_and_store = generate_and_store
+
+        self.assertIsInstance(results['leader'], bot_module.AdmissionRejected)
+        self.assertEqual(results['follower'], ('ответ', None))
+        self.assertEqual(len(calls), 2)
+
+class AsyncSingleFlightTest(unittest.TestCase):
+
+    def test_cancelled_leader_fails_followers(self):
+        async def run():
+            flights = bot_async.AsyncSingleFlight()
+            started = asyncio.Event()
+
+            async def generate(on_delta):
+                started.set()
+                await asyncio.sleep(10)
+                return 'ответ'
+
+            leader = asyncio.ensure_future(flights.do('key', generate))
+            await started.wait()
+            follower = asyncio.ensure_future(flights.do('key', generate))
+            await asyncio.sleep(0)
+            leader.cancel()
+            with self.assertRaises(asyncio.CancelledError):
+                await leader
+            with self.assertRaises(RuntimeError):
+                await asyncio.wait_for(follower, 5)
+            return flights.get_stats()
+
+        stats = asyncio.run(run())
+        self.assertEqual((stats['failed_calls'], stats['failed_followers'], stats['in_flight']), (1, 1, 0))
+
+    def test_leader_error_reaches_followers(self):
+        async def run():
+            flights = bot_async.AsyncSingleFlight()
+
+            async def generate(on_delta):
+                await asyncio.sleep(0.01)
+                raise ValueError('модель недоступна')
+
+            return await asyncio.gather(flights.do('key', generate), flights.do('key', generate),
+                                        return_exceptions=True)
+
+        leader_result, follower_result = asyncio.run(run())
+        self.assertIsInstance(leader_result, ValueError)
+        self.assertIs(follower_result, leader_result)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,93 @@
+"""
+Проверки split_html_message на случайных HTML-текстах: сообщения не длиннее лимита,
+теги в каждом сбалансированы, а текст не теряется и не склеивается.
+
+Запуск: python -m unittest discover -s tests
+"""
+import os
+import random
+import re
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'benchmarks'))
+
+from _bot import load_bot_module
+from split_benchmark import is_balanced, visible_text
+
+bot_module = load_bot_module()
+
+CASES = 500
+SEED = 0
+
+def random_html(rng):
+    """Случайный корректный HTML из абзацев, вложенных тегов, сущностей и эмодзи"""
+    words = ['слово', 'Онегин', 'роман', '«Евгений', 'Онегин»', '&amp;', '&lt;', '😀', 'очень' * 30, '\n']
+    paragraphs = []
+    # Теги могут переходить через границу абзаца
+    stack = []
+    for _ in range(rng.randint(1, 40)):
+        pieces = []
+        for _ in range(rng.randint(0, 300)):
+            roll = rng.random()
+            if roll < 0.08 and len(stack) < 3:
+                tag = rng.choice(['b', 'i', 'code'])
+                stack.append(tag)
+                pieces.append(f'<{tag}>')
+            elif roll < 0.16 and stack:
+                pieces.append(f'</{stack.pop()}>')
+            else:
+                pieces.append(rng.choice(words) + ' ')
+        paragraphs.append(''.join(pieces))
+    return '\n\n'.join(paragraphs) + ''.join(f'</{tag}>' for tag in reversed(stack))
+
+def normalize_spaces(text):
+    return re.sub(r'\s+', ' ', visible_text(text)).strip()
+
+def text_preserved(text, chunks):
+    """
+    Видимый текст сообщений подряд совпадает с исходным с точностью до схлопывания
+    пробельных символов; теряться они могут только на границах сообщений
+    """
+    expected = normalize_spaces(text)
+    position = 0
+    for chunk in chunks:
+        part = normalize_spaces(chunk)
+        if not expected.startswith(part, position):
+            return False
+        position += len(part)
+        if expected.startswith(' ', position):
+            position += 1
+    return position >= len(expected)
+
+class SplitHtmlMessageTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        rng = random.Random(SEED)
+        cls.cases = []
+        for _ in range(CASES):
+            text = random_html(rng)
+            limit = rng.choice([50, 300, 1000, 4096])
+            cls.cases.append((text, limit, bot_module.split_html_message(text, limit)))
+
+    def count_failures(self, check):
+        return sum(1 for text, limit, chunks in self.cases if not check(text, limit, chunks))
+
+    def test_chunks_fit_limit(self):
+        self.assertEqual(self.count_failures(
+            lambda text, limit, chunks: all(bot_module.html_visible_len(chunk) <= limit for chunk in chunks)), 0)
+
+    def test_tags_balanced(self):
+        self.assertEqual(self.count_failures(lambda text, limit, chunks: all(map(is_balanced, chunks))), 0)
+
+    def test_no_text_lost(self):
+        self.assertEqual(self.count_failures(lambda text, limit, chunks: text_preserved(text, chunks)), 0)
+
+    def test_text_preserved_detects_glued_words(self):
+        self.assertTrue(text_preserved('<b>слово  слово</b>\n\nроман', ['<b>слово слово</b>', 'роман']))
+        self.assertFalse(text_preserved('слово слово', ['слово', 'слов']))
+        self.assertFalse(text_preserved('слово слово роман', ['словослово', 'роман']))
+
+if __name__ == '__main__':
+    unittest.main()